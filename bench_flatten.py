@@ -0,0 +1,148 @@
+import argparse
+import copy
+import json
+import time
+import tracemalloc
+import ujson
+
+from records import compact
+from ringest import flatten_comments, iter_flattened_comments
+
+# Benchmarks flatten_comments on synthetic threads built by cloning the
+# comments in flatten_comments_in.json, e.g.
+#
+#   python bench_flatten.py --comments 50000 --branching 4 --deep 100000
+
+
+def recursive_flatten_comments(link_doc):
+    # the original recursive implementation, kept here as a baseline
+    comments = link_doc["comments"]
+    flattened_comments = []
+
+    def traverse(comment_listing):
+        assert comment_listing["kind"] == "Listing"
+        for child in comment_listing["data"]["children"]:
+            clone = dict(child)
+            clone["data"] = {k:v for (k,v) in clone["data"].items() if k != "replies"}
+            flattened_comments.append(clone)
+            if child["data"].get("replies"):
+                traverse(child["data"]["replies"])
+
+    for cl in comments[1:]:
+        traverse(cl)
+
+    return dict(link_doc,flattened_comments=flattened_comments)
+
+
+def comment_template(link_doc):
+    comment = link_doc["comments"][1]["data"]["children"][0]
+    data = dict(comment["data"], replies='')
+    return {"kind": comment["kind"], "data": data}
+
+
+def listing(children):
+    return {"kind": "Listing", "data": {"children": children}}
+
+
+def make_comment(template, n):
+    comment = dict(template)
+    comment["data"] = dict(template["data"], id='c%d' % n, name='t1_c%d' % n)
+    return comment
+
+
+def wide_tree(link_doc, n_comments, branching):
+    # breadth-first fill: every comment gets up to `branching` replies
+    template = comment_template(link_doc)
+    roots = [make_comment(template, i) for i in range(min(branching, n_comments))]
+    queue = list(roots)
+    made = len(roots)
+    while queue and made < n_comments:
+        parent = queue.pop(0)
+        replies = []
+        for _ in range(min(branching, n_comments - made)):
+            replies.append(make_comment(template, made))
+            made += 1
+        parent["data"]["replies"] = listing(replies)
+        queue.extend(replies)
+    return dict(link_doc, comments=[link_doc["comments"][0], listing(roots)])
+
+
+def deep_tree(link_doc, depth):
+    # a single reply chain `depth` comments long
+    template = comment_template(link_doc)
+    root = make_comment(template, 0)
+    parent = root
+    for i in range(1, depth):
+        child = make_comment(template, i)
+        parent["data"]["replies"] = listing([child])
+        parent = child
+    return dict(link_doc, comments=[link_doc["comments"][0], listing([root])])
+
+
+def run(name, fn, link_doc):
+    tracemalloc.start()
+    st = time.perf_counter()
+    try:
+        n = fn(link_doc)
+    except RecursionError:
+        tracemalloc.stop()
+        print('%-28s RecursionError' % name)
+        return
+    elapsed = time.perf_counter() - st
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%-28s %8d comments %8.3fs %10.0f comments/s peak %7.1f MiB' %
+          (name, n, elapsed, n / elapsed if elapsed > 0 else 0,
+           peak / (1024 * 1024)))
+
+
+def held(name, fn, line):
+    # memory still held by what fn(line) returns, e.g. a queued link's
+    # flattened comments
+    tracemalloc.start()
+    comments = fn(line)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%-28s %8d comments held in %7.1f MiB' %
+          (name, len(comments), current / (1024 * 1024)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, default='flatten_comments_in.json')
+    parser.add_argument('--comments', type=int, default=50000)
+    parser.add_argument('--branching', type=int, default=4)
+    parser.add_argument('--deep', type=int, default=100000)
+    args = parser.parse_args()
+
+    with open(args.input) as f:
+        link_doc = json.load(f)
+
+    trees = [
+        ('fixture', copy.deepcopy(link_doc)),
+        ('wide(%d,%d)' % (args.comments, args.branching),
+         wide_tree(link_doc, args.comments, args.branching)),
+        ('deep(%d)' % args.deep, deep_tree(link_doc, args.deep)),
+    ]
+    for tree_name, tree in trees:
+        print(tree_name)
+        run('  recursive (baseline)',
+            lambda d: len(recursive_flatten_comments(d)["flattened_comments"]),
+            tree)
+        run('  flatten_comments',
+            lambda d: len(flatten_comments(d)["flattened_comments"]), tree)
+        run('  iter_flattened_comments',
+            lambda d: sum(1 for _ in iter_flattened_comments(d)), tree)
+
+    # flattened comments as dicts, as parsed from a response (ujson and
+    # ijson don't share keys between dicts like json does), against
+    # CommentRecords
+    line = ujson.dumps(flatten_comments(trees[1][1])["flattened_comments"])
+    print(trees[1][0])
+    held('  dicts', ujson.loads, line)
+    held('  CommentRecords',
+         lambda l: [compact(c) for c in ujson.loads(l)], line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+import argparse
+import gzip
+import io
+import logging
+import resource
+import threading
+import ujson
+
+from datetime import datetime, timedelta, timezone
+from fake_reddit import FakeReddit
+from ringest import Ringest
+from sessions import SessionPool
+from time import perf_counter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Runs Ringest.do_ringest end to end against a local FakeReddit and reports
+# throughput, latency and memory, without touching real credentials, the
+# auth_library table or S3, e.g.
+#
+#   python bench_ringest.py --minutes 10 --tokens 4 --latency-ms 50
+
+
+class MemoryS3(object):
+    # just enough of the boto3 S3 client for S3GzipSink
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def create_multipart_upload(self, Bucket, Key):
+        with self.lock:
+            upload_id = 'upload-%d' % len(self.uploads)
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': '"%d"' % PartNumber}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b''.join(
+            parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+
+class TimedSessionPool(SessionPool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    def get(self, url: str, key=None, **kwargs):
+        st = perf_counter()
+        try:
+            return super().get(url, key=key, **kwargs)
+        finally:
+            self.latencies.append(perf_counter() - st)
+
+
+class BenchRingest(Ringest):
+    password_map = {'bench%02d' % i: 'secret' for i in range(64)}
+
+    def lock_creds(self, count: int=2, reservation_hours: int=0,
+                   reservation_minutes: int=10) -> list:
+        return sorted(self.password_map)[:count]
+
+    def release_creds(self):
+        self.unames = []
+
+
+def count_comments(link_doc: dict) -> int:
+    # t1s in flattened_comments plus the ones fetched into "more" nodes
+    count = 0
+    for comment in link_doc['flattened_comments']:
+        if comment['kind'] == 't1':
+            count += 1
+        elif comment['kind'] == 'more':
+            for response in comment['data']['children']:
+                count += len(response.get('json', dict()).
+                             get('data', dict()).get('things', []))
+    return count
+
+
+def percentile(values: list, p: float) -> float:
+    if len(values) < 1:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)]
+
+
+def run(args) -> dict:
+    fake = FakeReddit(seed=args.seed, fixture_path=args.fixture,
+                      trace_path=args.trace, density=args.density,
+                      mean_comments=args.mean_comments,
+                      latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                      error_rate=args.error_rate,
+                      throttle_rate=args.throttle_rate,
+                      max_url_length=args.max_url_length,
+                      ratelimit_budget=args.ratelimit_budget,
+                      ratelimit_window=args.ratelimit_window,
+                      id_slots=args.id_slots).start()
+    s3 = MemoryS3()
+    try:
+        r = BenchRingest(None, bucket_name='bench', api_url=fake.url,
+                         auth_url=fake.url, pool_size=args.pool_size)
+        r.sessions = TimedSessionPool(headers=Ringest.base_headers(),
+                                      pool_size=args.pool_size)
+        sessions = r.sessions
+        start_time = datetime(2018, 4, 1, 12, 0, tzinfo=timezone.utc)
+        end_time = start_time + timedelta(minutes=args.minutes)
+
+        st = perf_counter()
+        r.do_ringest(start_time=start_time, end_time=end_time,
+                     token_count=args.tokens, request_sleep=args.request_sleep,
+                     workers=args.workers, s3_client=s3,
+                     stream_comments=args.stream_comments,
+                     compact_records=args.compact_records,
+                     shards=args.shards, codec=args.codec,
+                     discovery=args.discovery)
+        elapsed = perf_counter() - st
+    finally:
+        fake.stop()
+
+    links = 0
+    comments = 0
+    for (_, key), body in s3.objects.items():
+        if key.endswith('.json.gz'):
+            body = gzip.decompress(body)
+        elif key.endswith('.json.zst'):
+            # one frame per part
+            body = zstandard.ZstdDecompressor().stream_reader(
+                io.BytesIO(body), read_across_frames=True).read()
+        else:
+            # manifests
+            continue
+        for line in body.splitlines():
+            links += 1
+            comments += count_comments(ujson.loads(line))
+
+    server = fake.stats()
+    n_requests = sum(server['requests'].values())
+    return {
+        'elapsed_seconds': elapsed,
+        'requests': n_requests,
+        'requests_per_second': n_requests / elapsed,
+        'links': links,
+        'links_per_second': links / elapsed,
+        'comments': comments,
+        'latency_p50_ms': percentile(sessions.latencies, 0.5) * 1000,
+        'latency_p99_ms': percentile(sessions.latencies, 0.99) * 1000,
+        'rate_limit_sleep_seconds': r.scheduler.sleep_seconds,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'server': server,
+        'metrics': r.metrics.summary()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--minutes', type=float, default=5)
+    parser.add_argument('--tokens', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--request-sleep', type=float, default=0)
+    parser.add_argument('--stream-comments', action='store_true')
+    parser.add_argument('--compact-records', action='store_true')
+    parser.add_argument('--discovery', type=str, default='search',
+                        choices=['search', 'ids'])
+    parser.add_argument('--id-slots', type=int, default=64)
+    parser.add_argument('--shards', type=int, default=None)
+    parser.add_argument('--codec', type=str, default='gzip',
+                        choices=['gzip', 'zstd'])
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fixture', type=str,
+                        default='flatten_comments_in.json')
+    parser.add_argument('--trace', type=str, default=None)
+    parser.add_argument('--density', type=float, default=0.2)
+    parser.add_argument('--mean-comments', type=float, default=30)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--max-url-length', type=int, default=8192)
+    parser.add_argument('--ratelimit-budget', type=int, default=100000)
+    parser.add_argument('--ratelimit-window', type=int, default=600)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    result = run(args)
+    if args.json:
+        print(ujson.dumps(result, indent=2))
+        return
+
+    print('%(elapsed_seconds).2fs, %(requests)d requests '
+          '(%(requests_per_second).1f/s), %(links)d links '
+          '(%(links_per_second).1f/s), %(comments)d comments' % result)
+    print('latency p50 %(latency_p50_ms).1fms p99 %(latency_p99_ms).1fms, '
+          'rate limit sleep %(rate_limit_sleep_seconds).1fs, '
+          'peak RSS %(peak_rss_mb).1f MiB' % result)
+    print('server: %r' % result['server'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import logging
+import os
+import threading
+import ujson
+
+
+class Checkpoint(object):
+    # Append-only journal of one do_ringest output object, kept in a local
+    # file so that an interrupted run can be resumed.  Each line is one JSON
+    # event:
+    #
+    #   {"key": ...}                            output key the journal is for
+    #   {"upload_id": ...}                      multipart upload was started
+    #   {"part": {...}, "links": [...]}         part uploaded, with its link ids
+    #                                           (part is null when a resumed
+    #                                           journal lists the links once)
+    #   {"window": [start, end], "links": [...]}  search window was searched
+    #   {"complete": true}                      output was fully uploaded
+    #
+    # A link is finished once it is in an uploaded part, and a search window
+    # is finished once all of its links are.  On resume the open multipart
+    # upload is continued, finished windows aren't searched again and
+    # finished links aren't fetched again.
+
+    def __init__(self, path: str, key: str):
+        self.path = path
+        self.key = key
+        self.upload_id = None
+        self.parts = []
+        self.links = set()
+        self.windows = []
+        self.complete = False
+        self.f = None
+        self.lock = threading.Lock()
+
+    def open(self, resume: bool=False):
+        if resume and os.path.exists(self.path):
+            self.load()
+        if self.upload_id is None and not self.complete:
+            # nothing durable to resume from
+            self.parts = []
+            self.links = set()
+            self.windows = []
+
+        # (re)write the journal from what was loaded, which also drops a
+        # torn last line, then swap it in atomically
+        self.f = open(self.path + '.tmp', 'w')
+        self.record({'key': self.key})
+        if self.upload_id is not None:
+            self.record({'upload_id': self.upload_id})
+            logging.info('Resuming %s from %s: %d parts, %d links, %d windows'
+                         % (self.key, self.path, len(self.parts),
+                            len(self.links), len(self.done_windows())))
+        for part in self.parts:
+            self.record({'part': part, 'links': []})
+        if len(self.parts) > 0:
+            self.record({'part': None, 'links': sorted(self.links)})
+        for window, link_ids in self.windows:
+            self.record({'window': list(window), 'links': sorted(link_ids)})
+        if self.complete:
+            self.record({'complete': True})
+        self.f.close()
+        os.replace(self.path + '.tmp', self.path)
+        self.f = open(self.path, 'a')
+        return self
+
+    def load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    event = ujson.loads(line)
+                except ValueError:
+                    # a torn last line from a crash mid-write
+                    break
+
+                if 'key' in event and event['key'] != self.key:
+                    logging.warning('Checkpoint %s is for %s, not %s; '
+                                    'starting over' %
+                                    (self.path, event['key'], self.key))
+                    return
+                elif 'upload_id' in event:
+                    self.upload_id = event['upload_id']
+                elif 'part' in event:
+                    if event['part'] is not None:
+                        self.parts.append(event['part'])
+                    self.links.update(event['links'])
+                elif 'window' in event:
+                    self.windows.append((tuple(event['window']),
+                                         set(event['links'])))
+                elif event.get('complete'):
+                    self.complete = True
+
+    def record(self, event: dict):
+        with self.lock:
+            self.f.write('%s\n' % ujson.dumps(event))
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def upload_started(self, upload_id: str):
+        self.upload_id = upload_id
+        self.record({'upload_id': upload_id})
+
+    def part_uploaded(self, part: dict, link_ids: list):
+        with self.lock:
+            self.parts.append(part)
+            self.links.update(link_ids)
+        self.record({'part': part, 'links': link_ids})
+
+    def window_searched(self, window: tuple, link_ids: list):
+        with self.lock:
+            self.windows.append((tuple(window), set(link_ids)))
+        self.record({'window': list(window), 'links': link_ids})
+
+    def finished(self):
+        self.complete = True
+        self.record({'complete': True})
+
+    def link_done(self, link_id: str) -> bool:
+        return link_id in self.links
+
+    def done_windows(self) -> list:
+        with self.lock:
+            return sorted(window for window, link_ids in self.windows
+                          if link_ids <= self.links)
@@ -0,0 +1,100 @@
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# prefixes (in ijson's notation) of the things in a /comments response: the
+# children of each top-level Listing and of every t1's replies Listing
+TOP_THING_PREFIX = 'item.data.children.item'
+REPLY_THING_SUFFIX = '.replies.data.children.item'
+
+
+def is_thing(prefix: str) -> bool:
+    return prefix == TOP_THING_PREFIX or prefix.endswith(REPLY_THING_SUFFIX)
+
+
+def iter_comments(link_doc: dict):
+    # data of every comment of a flattened link document, including those
+    # fetched into "more" nodes by do_morechildren
+    for comment in link_doc['flattened_comments']:
+        if comment.get('kind') == 't1':
+            yield comment.get('data', dict())
+        elif comment.get('kind') == 'more':
+            for response in comment.get('data', dict()).get('children', []):
+                if not isinstance(response, dict):
+                    continue
+                for thing in response.get('json', dict()).\
+                        get('data', dict()).get('things', []):
+                    if thing.get('kind') == 't1':
+                        yield thing.get('data', dict())
+
+
+def parse_comments(f, record=None) -> tuple:
+    # Parses a /comments response from the file-like f (e.g. response.raw)
+    # as it is read and returns (link thing, flattened comments), where the
+    # flattened comments are exactly what iter_flattened_comments would give
+    # for the parsed response: every t1 and more thing in depth-first order,
+    # without its "replies".
+    #
+    # Each thing is moved out of the tree as soon as it has been parsed, so
+    # the nested response is never held in memory; at any point only the
+    # chain of things still being parsed (and their empty Listings) is.
+    # With record, each comment is replaced by record(comment) once parsed
+    # (e.g. records.compact).
+    if ijson is None:
+        raise ImportError('ijson is required to stream comments')
+
+    link = None
+    flattened = []
+    containers = []
+    # (index in containers, slot in flattened) of each thing being parsed
+    things = []
+    top_level = -1
+    key = None
+
+    def attach(value):
+        if len(containers) < 1:
+            return
+        parent = containers[-1]
+        if isinstance(parent, dict):
+            parent[key] = value
+        else:
+            parent.append(value)
+
+    for prefix, event, value in ijson.parse(f, use_float=True):
+        if event == 'map_key':
+            key = value
+        elif event == 'start_map' or event == 'start_array':
+            node = dict() if event == 'start_map' else []
+            attach(node)
+            containers.append(node)
+            if event == 'start_map':
+                if prefix == 'item':
+                    top_level += 1
+                elif is_thing(prefix):
+                    # the first Listing holds the link itself; a comment's
+                    # slot is taken when it starts, so it comes before its
+                    # replies like in iter_flattened_comments
+                    slot = None
+                    if top_level > 0:
+                        slot = len(flattened)
+                        flattened.append(None)
+                    things.append((len(containers) - 1, slot))
+        elif event == 'end_map' or event == 'end_array':
+            node = containers.pop()
+            if event == 'end_map' and len(things) > 0 and \
+                    things[-1][0] == len(containers):
+                _, slot = things.pop()
+                # done with it: take it out of its Listing
+                containers[-1].pop()
+                data = node.get('data')
+                if isinstance(data, dict):
+                    data.pop('replies', None)
+                if slot is None:
+                    link = node
+                else:
+                    flattened[slot] = node if record is None else record(node)
+        else:
+            attach(value)
+
+    return link, flattened
@@ -1,6 +1,8 @@
 import argparse
+import os
 
 from cmpcfg import ComponentConfig
+from coordinator import Coordinator
 from datetime import datetime, timezone
 from ringest import Ringest
 
@@ -14,10 +16,58 @@ class Component(object):
 
     def __call__(self,credentials):
         args = self.parse_args()
-        r = Ringest(credentials,bucket_name=args.bucket)
+        # RINGEST_TOKEN_CACHE_KEY, a Fernet key, encrypts the token cache
+        token_cache_key = os.environ.get('RINGEST_TOKEN_CACHE_KEY')
+        if args.token_cache_file is not None and not token_cache_key:
+            # tokens are credentials: never written out in plaintext
+            raise ValueError('--token-cache-file requires '
+                             'RINGEST_TOKEN_CACHE_KEY')
+        ringest_kwargs = dict(pool_size=args.pool_size,
+                              request_timeout=args.request_timeout,
+                              token_cache_path=args.token_cache_file,
+                              token_cache_key=token_cache_key.encode()
+                              if token_cache_key else None)
+        ingest_kwargs = dict(token_count=args.token_count,
+                             request_sleep=args.request_sleep,
+                             reservation_hours=args.reservation_hours,
+                             reservation_minutes=args.reservation_minutes,
+                             workers=args.workers,
+                             density_path=args.density_file,
+                             cache_path=args.cache_file,
+                             cache_ttl_seconds=args.cache_ttl_seconds,
+                             cache_max_bytes=args.cache_max_mb * 1024 * 1024,
+                             output_format=args.output_format,
+                             stream_comments=args.stream_comments,
+                             compact_records=args.compact_records,
+                             delta_index_path=args.delta_index_file,
+                             delta=args.delta,
+                             dedupe_bloom_path=args.dedupe_bloom_file,
+                             shards=args.shards, codec=args.codec,
+                             shard_max_bytes=args.shard_max_mb * 1024 * 1024
+                             if args.shard_max_mb else None,
+                             shard_max_records=args.shard_max_records,
+                             discovery=args.discovery)
+        if args.coordinate:
+            # split the range into jobs in the ringest_jobs table and work
+            # through them; run the same command on more hosts to share them
+            Coordinator(credentials, bucket_name=args.bucket,
+                        processes=args.processes, job_hours=args.job_hours,
+                        lease_seconds=args.lease_seconds,
+                        max_attempts=args.max_attempts,
+                        checkpoint_dir=args.checkpoint_dir,
+                        metrics_port=args.metrics_port,
+                        ringest_kwargs=ringest_kwargs,
+                        ingest_kwargs=ingest_kwargs).\
+                run(start_time=args.start_time, end_time=args.end_time)
+            return
+
+        r = Ringest(credentials,bucket_name=args.bucket, **ringest_kwargs)
         r.do_ringest(start_time=args.start_time, end_time=args.end_time,
-                     token_count=args.token_count,
-                     request_sleep=args.request_sleep)
+                     checkpoint_path=args.checkpoint_file,
+                     resume=args.resume,
+                     metrics_path=args.metrics_file,
+                     metrics_port=args.metrics_port,
+                     **ingest_kwargs)
 
     @staticmethod
     def parse_args():
@@ -26,7 +76,39 @@ class Component(object):
         parser.add_argument('--start-time', type=cli_time)
         parser.add_argument('--end-time', type=cli_time)
         parser.add_argument('--token-count', type=int, default=2)
-        parser.add_argument('--request-sleep', type=int, default=1)
+        parser.add_argument('--request-sleep', type=float, default=0)
+        parser.add_argument('--output-format', choices=('json', 'parquet'),
+                            default='json')
+        parser.add_argument('--stream-comments', action='store_true')
+        parser.add_argument('--compact-records', action='store_true')
+        parser.add_argument('--delta-index-file', type=str, default=None)
+        parser.add_argument('--delta', action='store_true')
+        parser.add_argument('--dedupe-bloom-file', type=str, default=None)
+        parser.add_argument('--discovery', type=str, default='search',
+                            choices=['search', 'ids'])
+        parser.add_argument('--shards', type=int, default=None)
+        parser.add_argument('--codec', type=str, default='gzip',
+                            choices=['gzip', 'zstd'])
+        parser.add_argument('--shard-max-mb', type=int, default=None)
+        parser.add_argument('--shard-max-records', type=int, default=None)
+        parser.add_argument('--workers', type=int, default=None)
+        parser.add_argument('--density-file', type=str, default=None)
+        parser.add_argument('--checkpoint-file', type=str, default=None)
+        parser.add_argument('--resume', action='store_true')
+        parser.add_argument('--cache-file', type=str, default=None)
+        parser.add_argument('--cache-ttl-seconds', type=float, default=3600)
+        parser.add_argument('--cache-max-mb', type=int, default=1024)
+        parser.add_argument('--metrics-file', type=str, default=None)
+        parser.add_argument('--metrics-port', type=int, default=None)
+        parser.add_argument('--token-cache-file', type=str, default=None)
+        parser.add_argument('--pool-size', type=int, default=10)
+        parser.add_argument('--request-timeout', type=float, default=30)
+        parser.add_argument('--coordinate', action='store_true')
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument('--job-hours', type=float, default=1)
+        parser.add_argument('--lease-seconds', type=float, default=600)
+        parser.add_argument('--max-attempts', type=int, default=3)
+        parser.add_argument('--checkpoint-dir', type=str, default=None)
         parser.add_argument('--reservation-hours', type=int, default=2)
         parser.add_argument('--reservation-minutes', type=int, default=0)
         return parser.parse_args()
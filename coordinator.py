@@ -0,0 +1,250 @@
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+
+from contextlib import closing
+from credentials import ConnectionPool, CredentialLeaser
+from datetime import timedelta
+from ringest import Ringest
+
+
+class JobQueue(object):
+    # The ringest_jobs table, one row per hour (job_hours) of a backfill,
+    # created by the component's migration (migrations/ringest_jobs.sql).
+    # Jobs are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so any number
+    # of processes on any number of hosts can work through the same table
+    # without claiming a job twice.
+    #
+    # A job is "pending" until a worker claims it, "running" while that
+    # worker keeps renewing its lease, then "done" or, after max_attempts
+    # failures, "failed".  A running job whose lease ran out (its worker
+    # died) is claimable again, or failed if that was its last attempt.
+
+    def __init__(self, conn, bucket: str, lease_seconds: float=600,
+                 max_attempts: int=3):
+        self.conn = conn
+        self.bucket = bucket
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+
+    def execute(self, q: str, params: tuple=None) -> list:
+        with self.lock, self.conn.cursor() as curs:
+            try:
+                curs.execute(q, params)
+                rows = curs.fetchall() if curs.description is not None else []
+            except Exception:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+            return rows
+
+    def enqueue(self, start_time, end_time, job_hours: float=1) -> int:
+        # Adds a job per job_hours between start_time and end_time.  Jobs
+        # that already exist are left alone, so every host of a backfill can
+        # enqueue the same range.
+        step = timedelta(hours=job_hours)
+        added = 0
+        t = start_time
+        while t < end_time:
+            added += len(self.execute(
+                """INSERT INTO ringest_jobs (bucket, start_time, end_time)
+                   VALUES (%s, %s, %s)
+                   ON CONFLICT (bucket, start_time) DO NOTHING
+                   RETURNING start_time""",
+                (self.bucket, t, min(t + step, end_time))))
+            t += step
+        return added
+
+    def expire(self, start_time, end_time) -> int:
+        # Fails running jobs whose worker died on their last attempt, which
+        # would otherwise never be claimed or finished.
+        return len(self.execute(
+            """UPDATE ringest_jobs
+                  SET state = 'failed', leased_until = NULL,
+                      error = COALESCE(error, 'lease expired'),
+                      updated = CURRENT_TIMESTAMP
+                WHERE bucket = %s AND start_time >= %s AND start_time < %s
+                  AND state = 'running' AND attempts >= %s
+                  AND leased_until < CURRENT_TIMESTAMP
+            RETURNING start_time""",
+            (self.bucket, start_time, end_time, self.max_attempts)))
+
+    def claim(self, owner: str, start_time, end_time):
+        expired = self.expire(start_time, end_time)
+        if expired > 0:
+            logging.warning('%d jobs failed after their last lease expired' %
+                            expired)
+        rows = self.execute(
+            """UPDATE ringest_jobs
+                  SET state = 'running', owner = %(owner)s,
+                      attempts = attempts + 1, error = NULL,
+                      leased_until = CURRENT_TIMESTAMP +
+                                     %(lease)s * interval '1 second',
+                      updated = CURRENT_TIMESTAMP
+                WHERE (bucket, start_time) = (
+                       SELECT bucket, start_time
+                         FROM ringest_jobs
+                        WHERE bucket = %(bucket)s
+                          AND start_time >= %(start)s AND start_time < %(end)s
+                          AND attempts < %(max_attempts)s
+                          AND (state = 'pending' OR
+                               (state = 'running' AND
+                                leased_until < CURRENT_TIMESTAMP))
+                        ORDER BY start_time
+                        LIMIT 1
+                          FOR UPDATE SKIP LOCKED)
+            RETURNING start_time, end_time""",
+            {'owner': owner, 'lease': self.lease_seconds,
+             'bucket': self.bucket, 'start': start_time, 'end': end_time,
+             'max_attempts': self.max_attempts})
+        return rows[0] if len(rows) > 0 else None
+
+    def renew(self, owner: str, start_time):
+        self.execute(
+            """UPDATE ringest_jobs
+                  SET leased_until = CURRENT_TIMESTAMP +
+                                     %s * interval '1 second'
+                WHERE bucket = %s AND start_time = %s AND owner = %s
+                  AND state = 'running'""",
+            (self.lease_seconds, self.bucket, start_time, owner))
+
+    def finish(self, owner: str, start_time, error: str=None):
+        # on error the job goes back to pending until it has used up
+        # max_attempts
+        self.execute(
+            """UPDATE ringest_jobs
+                  SET state = CASE WHEN %(error)s IS NULL THEN 'done'
+                                   WHEN attempts >= %(max_attempts)s
+                                   THEN 'failed'
+                                   ELSE 'pending' END,
+                      error = %(error)s, leased_until = NULL,
+                      updated = CURRENT_TIMESTAMP
+                WHERE bucket = %(bucket)s AND start_time = %(start)s
+                  AND owner = %(owner)s""",
+            {'error': error, 'max_attempts': self.max_attempts,
+             'bucket': self.bucket, 'start': start_time, 'owner': owner})
+
+    def counts(self, start_time, end_time) -> dict:
+        return dict(self.execute(
+            """SELECT state, count(*) FROM ringest_jobs
+                WHERE bucket = %s AND start_time >= %s AND start_time < %s
+                GROUP BY state""",
+            (self.bucket, start_time, end_time)))
+
+
+class Coordinator(object):
+    # Splits start_time..end_time into job_hours jobs in ringest_jobs and
+    # runs them with processes local worker processes, each of which claims
+    # one job at a time and runs Ringest.do_ringest for it with its own
+    # credentials.  Running the same coordinator on several hosts spreads the
+    # backfill over all of them.
+    #
+    # ringest_kwargs go to the Ringest constructor and ingest_kwargs to every
+    # do_ringest call.  With checkpoint_dir each job keeps a checkpoint there
+    # and resumes from it if it is claimed again after a failure.
+
+    def __init__(self, component_credentials, bucket_name: str='cortico-data',
+                 processes: int=1, job_hours: float=1,
+                 lease_seconds: float=600, max_attempts: int=3,
+                 checkpoint_dir: str=None, metrics_port: int=None,
+                 ringest_kwargs: dict=None, ingest_kwargs: dict=None):
+        self.component_credentials = component_credentials
+        self.bucket_name = bucket_name
+        self.processes = processes
+        self.job_hours = job_hours
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.checkpoint_dir = checkpoint_dir
+        self.metrics_port = metrics_port
+        self.ringest_kwargs = ringest_kwargs or dict()
+        self.ingest_kwargs = ingest_kwargs or dict()
+
+    def job_queue(self, conn) -> JobQueue:
+        return JobQueue(conn, bucket=self.bucket_name,
+                        lease_seconds=self.lease_seconds,
+                        max_attempts=self.max_attempts)
+
+    def run(self, start_time, end_time) -> dict:
+        with closing(self.component_credentials.get_db_connection()) as conn:
+            jobs = self.job_queue(conn)
+            logging.info('Enqueued %d new jobs' %
+                         jobs.enqueue(start_time, end_time,
+                                      job_hours=self.job_hours))
+
+        if self.processes <= 1:
+            self.work(0, start_time, end_time)
+        else:
+            # fork, so component_credentials doesn't have to be picklable
+            ctx = multiprocessing.get_context('fork')
+            procs = [ctx.Process(target=self.work, name='ringest-%d' % i,
+                                 args=(i, start_time, end_time))
+                     for i in range(self.processes)]
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join()
+                if p.exitcode != 0:
+                    logging.warning('%s exited with %s' % (p.name, p.exitcode))
+
+        with closing(self.component_credentials.get_db_connection()) as conn:
+            counts = self.job_queue(conn).counts(start_time, end_time)
+        logging.info('Jobs by state: %r' % counts)
+        return counts
+
+    def work(self, index: int, start_time, end_time):
+        owner = '%s:%d:%d' % (socket.gethostname(), os.getpid(), index)
+        # every job of this worker reserves its credentials over the same
+        # pooled connections
+        leaser = CredentialLeaser(ConnectionPool(
+            self.component_credentials.get_db_connection))
+        try:
+            with closing(self.component_credentials.get_db_connection()) \
+                    as conn:
+                jobs = self.job_queue(conn)
+                while True:
+                    job = jobs.claim(owner, start_time, end_time)
+                    if job is None:
+                        return
+                    self.run_job(jobs, leaser, owner, index, *job)
+        finally:
+            leaser.pool.close()
+
+    def run_job(self, jobs: JobQueue, leaser: CredentialLeaser, owner: str,
+                index: int, job_start, job_end):
+        logging.info('%s running %s - %s' % (owner, job_start, job_end))
+        stop = threading.Event()
+
+        def heartbeat():
+            # keeps the lease alive for as long as the job runs
+            while not stop.wait(self.lease_seconds / 3):
+                try:
+                    jobs.renew(owner, job_start)
+                except Exception as e:
+                    logging.warning('Unable to renew lease: %r' % e)
+
+        renewer = threading.Thread(target=heartbeat, daemon=True)
+        renewer.start()
+        kwargs = dict(self.ingest_kwargs)
+        if self.checkpoint_dir is not None:
+            kwargs.update(checkpoint_path=os.path.join(
+                self.checkpoint_dir,
+                job_start.strftime('%Y%m%d-%H%M') + '.checkpoint'),
+                resume=True)
+        if self.metrics_port is not None:
+            kwargs.update(metrics_port=self.metrics_port + index)
+        error = None
+        try:
+            # a fresh Ringest per job, so no state leaks between hours
+            Ringest(self.component_credentials, bucket_name=self.bucket_name,
+                    credential_leaser=leaser, **self.ringest_kwargs).\
+                do_ringest(start_time=job_start, end_time=job_end, **kwargs)
+        except Exception as e:
+            logging.exception('Job %s failed' % job_start)
+            error = repr(e)
+        finally:
+            stop.set()
+            renewer.join()
+        jobs.finish(owner, job_start, error=error)
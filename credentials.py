@@ -0,0 +1,165 @@
+import logging
+import random
+import threading
+
+from contextlib import contextmanager
+from time import monotonic, sleep
+
+
+class ConnectionPool(object):
+    # Reuses DB connections made by connect() (e.g.
+    # component_credentials.get_db_connection) instead of opening one per
+    # query.  A connection that raised is closed rather than reused.
+
+    def __init__(self, connect, max_idle: int=4):
+        self.connect = connect
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        with self.lock:
+            conn = self.idle.pop() if len(self.idle) > 0 else None
+        if conn is None:
+            conn = self.connect()
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            finally:
+                conn.close()
+            raise
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+class CredentialLease(object):
+    # Credentials reserved in auth_library until released.  While held, a
+    # heartbeat thread pushes the reservation forward every lease_seconds / 3
+    # so that runs longer than the lease keep their credentials, while those
+    # of a process that died become available again within lease_seconds.
+    #
+    #   with leaser.lease(count=4, lease_seconds=600) as lease:
+    #       ... lease.unames ...
+
+    def __init__(self, leaser, unames: list, lease_seconds: float):
+        self.leaser = leaser
+        self.unames = unames
+        self.lease_seconds = lease_seconds
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self.renew_loop,
+                                          name='credential-lease',
+                                          daemon=True)
+        self.heartbeat.start()
+
+    def renew_loop(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            try:
+                self.leaser.renew(self.unames, self.lease_seconds)
+            except Exception as e:
+                logging.warning('Unable to renew credential lease: %r' % e)
+
+    def release(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.heartbeat.join()
+        self.leaser.release(self.unames)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class CredentialLeaser(object):
+    # Reserves credentials of one platform in auth_library.  A reservation is
+    # a single UPDATE over SELECT ... LIMIT count FOR UPDATE SKIP LOCKED, so
+    # concurrent workers never see or block on each other's rows, and it
+    # commits only if all count credentials were claimed (otherwise nothing
+    # is written and the claim is retried with jittered backoff for up to
+    # wait_seconds).  The least recently released credentials are handed out
+    # first, which spreads use evenly over all of them.
+
+    claim_q = """   UPDATE auth_library
+                       SET available = CURRENT_TIMESTAMP +
+                                       %(lease)s * interval '1 second'
+                     WHERE uname IN (
+                            SELECT uname
+                              FROM auth_library
+                             WHERE platform = %(platform)s
+                               AND available < CURRENT_TIMESTAMP
+                             ORDER BY available
+                             LIMIT %(count)s
+                               FOR UPDATE SKIP LOCKED)
+                 RETURNING uname"""
+    renew_q = """   UPDATE auth_library
+                       SET available = CURRENT_TIMESTAMP +
+                                       %(lease)s * interval '1 second'
+                     WHERE platform = %(platform)s AND uname = ANY(%(unames)s)"""
+    release_q = """ UPDATE auth_library
+                       SET available = CURRENT_TIMESTAMP
+                     WHERE platform = %(platform)s AND uname = ANY(%(unames)s)"""
+
+    def __init__(self, pool: ConnectionPool, platform: str='reddit',
+                 wait_seconds: float=60):
+        self.pool = pool
+        self.platform = platform
+        self.wait_seconds = wait_seconds
+
+    def claim(self, count: int, lease_seconds: float) -> list:
+        with self.pool.connection() as conn, conn.cursor() as curs:
+            curs.execute(self.claim_q, {'lease': lease_seconds,
+                                        'platform': self.platform,
+                                        'count': count})
+            unames = [r[0] for r in curs.fetchall()]
+            if len(unames) < count:
+                conn.rollback()
+                return []
+            conn.commit()
+            return unames
+
+    def lease(self, count: int, lease_seconds: float) -> CredentialLease:
+        logging.info('Reserving %d auth creds...' % count)
+        deadline = monotonic() + self.wait_seconds
+        delay = 0.1
+        while True:
+            unames = self.claim(count, lease_seconds)
+            if len(unames) == count:
+                logging.info('Done.')
+                return CredentialLease(self, unames, lease_seconds)
+            if monotonic() + delay > deadline:
+                raise ConnectionError("Unable to reserve credentials.")
+            sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, 5)
+
+    def renew(self, unames: list, lease_seconds: float):
+        self.execute(self.renew_q, {'lease': lease_seconds,
+                                    'platform': self.platform,
+                                    'unames': list(unames)})
+
+    def release(self, unames: list):
+        if len(unames) < 1:
+            return
+        logging.info('Releasing auth creds...')
+        self.execute(self.release_q, {'platform': self.platform,
+                                      'unames': list(unames)})
+        logging.info('Done.')
+
+    def execute(self, q: str, params: dict):
+        with self.pool.connection() as conn, conn.cursor() as curs:
+            curs.execute(q, params)
+            conn.commit()
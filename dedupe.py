@@ -0,0 +1,174 @@
+import fcntl
+import hashlib
+import logging
+import math
+import os
+import struct
+import threading
+
+from collections import Counter
+from contextlib import contextmanager
+
+BLOOM_MAGIC = b'RBF1'
+BLOOM_HEADER = struct.Struct('<4sQQQ')
+
+
+@contextmanager
+def file_lock(path: str):
+    # exclusive lock on path (created if need be) across processes
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class BloomFilter(object):
+    # Fixed-size Bloom filter sized for capacity keys at error_rate false
+    # positives, saved to and loaded from a file as a small header plus the
+    # bit array.  Not thread-safe; DedupeIndex locks around it.
+
+    def __init__(self, capacity: int=10000000, error_rate: float=0.001):
+        self.bits_count = max(int(-capacity * math.log(error_rate) /
+                                  math.log(2) ** 2), 8)
+        self.hash_count = max(int(round(self.bits_count / capacity *
+                                        math.log(2))), 1)
+        self.bits = bytearray((self.bits_count + 7) // 8)
+        self.count = 0
+
+    def positions(self, key: str):
+        digest = hashlib.blake2b(key.encode('utf8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.bits_count
+
+    def add(self, key: str):
+        for p in self.positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7))
+                   for p in self.positions(key))
+
+    @classmethod
+    def load(cls, path: str, capacity: int=10000000,
+             error_rate: float=0.001):
+        bloom = cls(capacity=capacity, error_rate=error_rate)
+        if path is None or not os.path.exists(path):
+            return bloom
+        with open(path, 'rb') as f:
+            header = f.read(BLOOM_HEADER.size)
+            magic, bits_count, hash_count, count = \
+                BLOOM_HEADER.unpack(header) if \
+                len(header) == BLOOM_HEADER.size else (None, 0, 0, 0)
+            if magic != BLOOM_MAGIC:
+                logging.warning('%s is not a Bloom filter, starting empty' %
+                                path)
+                return bloom
+            # the file's sizing wins over capacity and error_rate
+            bloom.bits_count = bits_count
+            bloom.hash_count = hash_count
+            bloom.count = count
+            bloom.bits = bytearray(f.read())
+        return bloom
+
+    def merge(self, other) -> bool:
+        # adds every key of other, a filter of the same sizing
+        if (other.bits_count, other.hash_count) != \
+                (self.bits_count, self.hash_count):
+            return False
+        self.bits = bytearray(
+            (int.from_bytes(self.bits, 'little') |
+             int.from_bytes(other.bits, 'little')).to_bytes(len(self.bits),
+                                                            'little'))
+        # keys in both are counted once, so this is only a lower bound
+        self.count = max(self.count, other.count)
+        return True
+
+    def save(self, path: str):
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(BLOOM_HEADER.pack(BLOOM_MAGIC, self.bits_count,
+                                      self.hash_count, self.count))
+            f.write(self.bits)
+        os.replace(tmp_path, path)
+
+
+class DedupeIndex(object):
+    # Tells whether a link (by fullname) was already seen, so duplicates from
+    # paging and overlapping search windows are neither fetched nor written
+    # twice.  Links seen in this run are kept in a set.  With bloom_path,
+    # links written by earlier runs are remembered in a Bloom filter kept in
+    # that file (added to by written() and saved by save()), and skipped too;
+    # at error_rate a new link can be mistaken for a known one.
+    #
+    # The filter is scoped by output: scope (e.g. the output key) is recorded
+    # with every written link, and a link written under the same scope before
+    # is not skipped, so rerunning an hour rewrites all of its links instead
+    # of replacing its output with an empty one.
+    #
+    # Several processes can share bloom_path (e.g. coordinator workers):
+    # save() merges with whatever is on disk under a lock, so links written
+    # by jobs that ran at the same time are kept.
+    #
+    # Comment duplicates are detected by the caller (per link) and only
+    # counted here via record().  stats() reports checks and duplicates by
+    # kind.
+
+    def __init__(self, bloom_path: str=None, capacity: int=10000000,
+                 error_rate: float=0.001, scope: str=None):
+        self.bloom_path = bloom_path
+        self.scope = scope
+        self.bloom = BloomFilter.load(bloom_path, capacity=capacity,
+                                      error_rate=error_rate) \
+            if bloom_path is not None else None
+        self.links = set()
+        self.checked = Counter()
+        self.duplicates = Counter()
+        self.lock = threading.Lock()
+
+    def new_link(self, name: str) -> bool:
+        with self.lock:
+            self.checked['link'] += 1
+            if name in self.links or \
+                    (self.bloom is not None and name in self.bloom and
+                     self.scoped(name) not in self.bloom):
+                self.duplicates['link'] += 1
+                return False
+            self.links.add(name)
+            return True
+
+    def scoped(self, name: str) -> str:
+        return '%s %s' % (self.scope, name)
+
+    def written(self, name: str):
+        if self.bloom is not None:
+            with self.lock:
+                self.bloom.add(name)
+                self.bloom.add(self.scoped(name))
+
+    def record(self, kind: str, duplicate: bool):
+        with self.lock:
+            self.checked[kind] += 1
+            if duplicate:
+                self.duplicates[kind] += 1
+
+    def save(self):
+        if self.bloom is None:
+            return
+        with self.lock, file_lock(self.bloom_path + '.lock'):
+            if os.path.exists(self.bloom_path) and not self.bloom.merge(
+                    BloomFilter.load(self.bloom_path)):
+                logging.warning('%s is sized differently, replacing it' %
+                                self.bloom_path)
+            self.bloom.save(self.bloom_path)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {kind: {'checked': n,
+                           'duplicates': self.duplicates[kind],
+                           'duplicate_rate': self.duplicates[kind] / n}
+                    for kind, n in self.checked.items() if n > 0}
@@ -0,0 +1,84 @@
+import logging
+import sqlite3
+import threading
+import ujson
+import zlib
+
+from comment_stream import iter_comments
+from time import time
+
+
+def comment_state(data: dict) -> float:
+    # what tells a changed comment apart: its edit time (edited is false for
+    # comments that were never edited)
+    edited = data.get('edited')
+    return float(edited) if isinstance(edited, (int, float)) and \
+        not isinstance(edited, bool) else 0.0
+
+
+class DeltaIndex(object):
+    # Local SQLite index of the links that were ingested and the comments
+    # seen on each, for delta runs (Ringest.do_delta_nibble):
+    #
+    #   links(name, created_utc, num_comments, fetched, comments)
+    #
+    # where comments is the zlib-compressed JSON {comment id: comment_state}
+    # of every comment seen so far.  A link's row is replaced whenever it is
+    # fetched again.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS links (
+                    name TEXT PRIMARY KEY,
+                    created_utc REAL,
+                    num_comments INTEGER,
+                    fetched REAL,
+                    comments BLOB)""")
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS links_created_utc
+                    ON links (created_utc)""")
+            self.conn.commit()
+
+    def links(self, start_uts: float, end_uts: float) -> dict:
+        # {name: num_comments} of the links created in [start_uts, end_uts)
+        with self.lock:
+            return dict(self.conn.execute(
+                'SELECT name, num_comments FROM links '
+                'WHERE created_utc >= ? AND created_utc < ?',
+                (start_uts, end_uts)).fetchall())
+
+    def comments(self, name: str) -> dict:
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT comments FROM links WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return dict()
+        return ujson.loads(zlib.decompress(row[0]))
+
+    def put(self, name: str, created_utc: float, num_comments: int,
+            comments: dict):
+        body = zlib.compress(ujson.dumps(comments).encode('utf8'))
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?)',
+                (name, created_utc, num_comments, time(), body))
+            self.conn.commit()
+
+    def record(self, link_doc: dict):
+        # adds what a full run fetched for a link
+        data = link_doc['link']['data']
+        self.put(data.get('name') or 't3_' + data['id'],
+                 created_utc=data.get('created_utc'),
+                 num_comments=data.get('num_comments'),
+                 comments={c['id']: comment_state(c)
+                           for c in iter_comments(link_doc) if 'id' in c})
+
+    def close(self):
+        with self.lock:
+            n = self.conn.execute('SELECT COUNT(*) FROM links').fetchone()[0]
+            self.conn.close()
+        logging.info('Delta index: %d links' % n)
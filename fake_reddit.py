@@ -0,0 +1,465 @@
+import argparse
+import base64
+import gzip
+import hashlib
+import logging
+import random
+import re
+import threading
+import ujson
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep, time
+from urllib.parse import parse_qs, urlsplit
+
+# Local stand-in for the parts of the Reddit API that Ringest uses:
+#
+#   POST /api/v1/access_token
+#   GET  /search.json?q=(and timestamp:a..b)&limit=&after=
+#   GET  /comments/<id>.json?limit=&sort=
+#   GET  /api/morechildren?link_id=&children=
+#   GET  /api/info?id=<fullname>,...
+#
+# Links and comment trees are generated deterministically from a seed (so
+# repeated runs see the same data), using the link and comment documents in
+# flatten_comments_in.json as templates.  Responses carry X-Ratelimit-*
+# headers from a per-token budget, and latency, 429/5xx errors and 414s for
+# long URIs can be injected.  Recorded responses can be replayed from a
+# JSON-lines trace of {"path": ..., "status": ..., "body": ...} records, where
+# path may include the query string.
+#
+# comment_fraction is the share of each link's eventual comments that exist
+# so far; raising it between runs makes threads grow like real ones do.
+#
+#   python fake_reddit.py --port 8080 --density 0.5 --latency-ms 50
+
+SEARCH_Q = re.compile(r'timestamp:(\d+)\.\.(\d+)')
+BASE36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def base36(n: int) -> str:
+    s = ''
+    while True:
+        n, r = divmod(n, 36)
+        s = BASE36[r] + s
+        if n == 0:
+            return s
+
+
+def listing(children: list, after: str=None) -> dict:
+    return {'kind': 'Listing',
+            'data': {'after': after, 'before': None, 'children': children}}
+
+
+class FakeReddit(object):
+
+    def __init__(self, host: str='127.0.0.1', port: int=0, seed: int=0,
+                 fixture_path: str='flatten_comments_in.json',
+                 trace_path: str=None, density: float=0.2,
+                 mean_comments: float=30, latency_ms: float=0,
+                 jitter_ms: float=0, error_rate: float=0,
+                 throttle_rate: float=0, max_url_length: int=8192,
+                 ratelimit_budget: int=600, ratelimit_window: int=600,
+                 comment_fraction: float=1.0, id_slots: int=64):
+        self.seed = seed
+        self.density = density
+        self.mean_comments = mean_comments
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_url_length = max_url_length
+        self.ratelimit_budget = ratelimit_budget
+        self.ratelimit_window = ratelimit_window
+        self.comment_fraction = comment_fraction
+        # link ids are ts * id_slots + k for the kth link at second ts, so
+        # fewer slots make ids denser (at most id_slots links a second)
+        self.id_slots = id_slots
+
+        with open(fixture_path) as f:
+            fixture = ujson.load(f)
+        self.link_template = fixture['link']['data']
+        self.comment_template = dict(
+            fixture['comments'][1]['data']['children'][0]['data'], replies='')
+
+        self.trace = {}
+        if trace_path is not None:
+            with open(trace_path) as f:
+                for line in f:
+                    record = ujson.loads(line)
+                    self.trace[record['path']] = record
+
+        self.lock = threading.Lock()
+        self.budgets = {}
+        self.token_count = 0
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.bytes_sent = 0
+        self.rng = random.Random(seed)
+
+        fake = self
+
+        class Handler(FakeRedditHandler):
+            server_state = fake
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='fake-reddit', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'requests': dict(self.requests),
+                    'statuses': {str(k): v for k, v in self.statuses.items()},
+                    'bytes_sent': self.bytes_sent}
+
+    # -- rate limits and fault injection --------------------------------
+
+    def ratelimit(self, token: str) -> tuple:
+        # returns (used, remaining, reset) after charging one request
+        with self.lock:
+            now = monotonic()
+            window_start, used = self.budgets.get(token, (now, 0))
+            if now - window_start >= self.ratelimit_window:
+                window_start, used = now, 0
+            used += 1
+            self.budgets[token] = (window_start, used)
+            reset = self.ratelimit_window - (now - window_start)
+            return used, self.ratelimit_budget - used, int(reset) + 1
+
+    def roll(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self.lock:
+            return self.rng.random() < rate
+
+    def delay(self):
+        if self.latency_ms > 0 or self.jitter_ms > 0:
+            with self.lock:
+                jitter = self.rng.uniform(0, self.jitter_ms)
+            sleep((self.latency_ms + jitter) / 1000.0)
+
+    # -- synthetic data -------------------------------------------------
+
+    def rng_for(self, *key) -> random.Random:
+        digest = hashlib.md5(('%d:%r' % (self.seed, key)).encode()).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+
+    def link_count(self, ts: int) -> int:
+        rng = self.rng_for('links', ts)
+        count = int(self.density)
+        if rng.random() < self.density - count:
+            count += 1
+        return min(count, self.id_slots)
+
+    def links_at(self, ts: int) -> list:
+        # links created at local-epoch second ts, newest first
+        return [self.link(ts, k)
+                for k in range(self.link_count(ts) - 1, -1, -1)]
+
+    def link(self, ts: int, k: int) -> dict:
+        link_id = base36(ts * self.id_slots + k)
+        rng = self.rng_for('num_comments', link_id)
+        num_comments = int(rng.expovariate(1.0 / self.mean_comments)) \
+            if self.mean_comments > 0 else 0
+        # comments are generated in order, so the first num_comments of them
+        # are the thread as it was when only that many existed
+        num_comments = int(num_comments * self.comment_fraction)
+        data = dict(self.link_template, id=link_id, name='t3_' + link_id,
+                    created=float(ts), created_utc=float(ts - 28800),
+                    num_comments=num_comments,
+                    permalink='/comments/%s/' % link_id)
+        return {'kind': 't3', 'data': data}
+
+    def link_from_id(self, link_id: str) -> dict:
+        n = int(link_id, 36)
+        return self.link(n // self.id_slots, n % self.id_slots)
+
+    def link_exists(self, link_id: str) -> bool:
+        n = int(link_id, 36)
+        return n % self.id_slots < self.link_count(n // self.id_slots) and \
+            n // self.id_slots <= time() + 28800
+
+    def comment_tree(self, link: dict, newest_first: bool=False) -> list:
+        # [(comment_id, parent_id or None), ...] in depth-first order, oldest
+        # or newest sibling first
+        link_id = link['data']['id']
+        rng = self.rng_for('tree', link_id)
+        parents = [None]
+        tree = []
+        for i in range(link['data']['num_comments']):
+            parent = parents[int(rng.random() ** 2 * len(parents))] \
+                if rng.random() < 0.7 else None
+            comment_id = '%s%s' % (link_id, base36(i))
+            tree.append((comment_id, parent))
+            parents.append(comment_id)
+        children = {}
+        for comment_id, parent in tree:
+            children.setdefault(parent, []).append(comment_id)
+        if newest_first:
+            for siblings in children.values():
+                siblings.reverse()
+
+        ordered = []
+        stack = list(reversed(children.get(None, [])))
+        while stack:
+            comment_id = stack.pop()
+            ordered.append(comment_id)
+            stack.extend(reversed(children.get(comment_id, [])))
+        parent_of = dict(tree)
+        return [(c, parent_of[c]) for c in ordered]
+
+    def comment(self, link: dict, comment_id: str, parent: str) -> dict:
+        data = dict(self.comment_template, id=comment_id,
+                    name='t1_' + comment_id, link_id=link['data']['name'],
+                    parent_id='t1_' + parent if parent is not None
+                    else link['data']['name'],
+                    created_utc=link['data']['created_utc'])
+        return {'kind': 't1', 'data': data}
+
+    def more(self, link: dict, parent: str, child_ids: list) -> dict:
+        return {'kind': 'more',
+                'data': {'count': len(child_ids), 'name': 't1_' + child_ids[0],
+                         'id': child_ids[0], 'children': child_ids,
+                         'parent_id': 't1_' + parent if parent is not None
+                         else link['data']['name'], 'depth': 0}}
+
+    # -- endpoints ------------------------------------------------------
+
+    def search(self, query: dict) -> tuple:
+        match = SEARCH_Q.search(query.get('q', [''])[0])
+        if match is None:
+            return 400, {'message': 'Bad Request', 'error': 400}
+        start_ts, end_ts = int(match.group(1)), int(match.group(2))
+        limit = int(query.get('limit', ['25'])[0])
+        after = query.get('after', [None])[0]
+
+        links = []
+        for ts in range(end_ts, start_ts - 1, -1):
+            links.extend(self.links_at(ts))
+        if after is not None:
+            names = [l['data']['name'] for l in links]
+            links = links[names.index(after) + 1:] if after in names else []
+        page = links[:limit]
+        next_after = page[-1]['data']['name'] if len(links) > limit else None
+        return 200, listing(page, after=next_after)
+
+    def comments(self, link_id: str, query: dict) -> tuple:
+        link = self.link_from_id(link_id)
+        limit = int(query.get('limit', ['200'])[0])
+        tree = self.comment_tree(
+            link, newest_first=query.get('sort', [''])[0] == 'new')
+        shown = tree[:limit]
+        shown_ids = set(c for c, _ in shown)
+
+        nodes = {}
+        top = []
+        for comment_id, parent in shown:
+            node = self.comment(link, comment_id, parent)
+            nodes[comment_id] = node
+            if parent is None:
+                top.append(node)
+            else:
+                replies = nodes[parent]['data']['replies']
+                if not replies:
+                    replies = nodes[parent]['data']['replies'] = listing([])
+                replies['data']['children'].append(node)
+
+        # hidden comments go in a "more" under their shown parent, or in
+        # one top-level "more"
+        hidden = {}
+        for comment_id, parent in tree[limit:]:
+            key = parent if parent in shown_ids else None
+            hidden.setdefault(key, []).append(comment_id)
+        for parent, child_ids in hidden.items():
+            more = self.more(link, parent, child_ids)
+            if parent is None:
+                top.append(more)
+            else:
+                replies = nodes[parent]['data']['replies']
+                if not replies:
+                    replies = nodes[parent]['data']['replies'] = listing([])
+                replies['data']['children'].append(more)
+
+        return 200, [listing([link]), listing(top)]
+
+    def morechildren(self, query: dict) -> tuple:
+        link_name = query.get('link_id', [''])[0]
+        link = self.link_from_id(link_name.partition('_')[2])
+        child_ids = query.get('children', [''])[0].split(',')
+        parent_of = dict(self.comment_tree(link))
+        things = [self.comment(link, c, parent_of[c])
+                  for c in child_ids if c in parent_of]
+        return 200, {'json': {'errors': [], 'data': {'things': things}}}
+
+    def info(self, query: dict) -> tuple:
+        things = []
+        for name in query.get('id', [''])[0].split(','):
+            kind, _, thing_id = name.partition('_')
+            # like Reddit, ids that don't exist (yet) are left out
+            if kind == 't3' and thing_id and self.link_exists(thing_id):
+                things.append(self.link_from_id(thing_id))
+        return 200, listing(things)
+
+    def access_token(self, auth: str) -> tuple:
+        if not auth.startswith('Basic '):
+            return 401, {'message': 'Unauthorized', 'error': 401}
+        user = base64.b64decode(auth[6:]).decode().partition(':')[0]
+        with self.lock:
+            self.token_count += 1
+            token = 'fake-%s-%d' % (user, self.token_count)
+        return 200, {'access_token': token, 'token_type': 'bearer',
+                     'expires_in': 3600, 'scope': '*'}
+
+
+class FakeRedditHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes; without this, Nagle plus
+    # delayed ACKs add ~40ms to every keep-alive response
+    disable_nagle_algorithm = True
+    server_state = None
+
+    def log_message(self, format, *args):
+        logging.debug('fake_reddit: ' + format % args)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length > 0:
+            self.rfile.read(length)
+        self.handle_request('POST')
+
+    def handle_request(self, method: str):
+        fake = self.server_state
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        headers = {}
+
+        if parts.path.startswith('/comments/'):
+            endpoint = 'comments'
+        elif parts.path == '/api/morechildren':
+            endpoint = 'morechildren'
+        elif parts.path == '/search.json':
+            endpoint = 'search'
+        elif parts.path == '/api/info':
+            endpoint = 'info'
+        elif parts.path == '/api/v1/access_token':
+            endpoint = 'token'
+        else:
+            endpoint = 'other'
+        with fake.lock:
+            fake.requests[endpoint] += 1
+
+        fake.delay()
+        if endpoint != 'token':
+            token = self.headers.get('Authorization', '')
+            used, remaining, reset = fake.ratelimit(token)
+            headers['X-Ratelimit-Used'] = '%d' % used
+            headers['X-Ratelimit-Remaining'] = '%.1f' % max(remaining, 0)
+            headers['X-Ratelimit-Reset'] = '%d' % reset
+
+        if len(self.path) > fake.max_url_length:
+            status, body = 414, {'message': 'URI Too Long', 'error': 414}
+        elif endpoint != 'token' and remaining < 0:
+            status, body = 429, {'message': 'Too Many Requests', 'error': 429}
+            headers['Retry-After'] = '%d' % reset
+        elif fake.roll(fake.throttle_rate):
+            status, body = 429, {'message': 'Too Many Requests', 'error': 429}
+            headers['Retry-After'] = '1'
+        elif fake.roll(fake.error_rate):
+            status = random.choice((500, 502, 503))
+            body = {'message': 'Server Error', 'error': status}
+        elif self.path in fake.trace or parts.path in fake.trace:
+            record = fake.trace.get(self.path) or fake.trace[parts.path]
+            status, body = record.get('status', 200), record['body']
+        elif endpoint == 'comments':
+            link_id = parts.path[len('/comments/'):].split('.')[0].split('/')[0]
+            status, body = fake.comments(link_id, query)
+        elif endpoint == 'morechildren':
+            status, body = fake.morechildren(query)
+        elif endpoint == 'search':
+            status, body = fake.search(query)
+        elif endpoint == 'info':
+            status, body = fake.info(query)
+        elif endpoint == 'token' and method == 'POST':
+            status, body = fake.access_token(
+                self.headers.get('Authorization', ''))
+        else:
+            status, body = 404, {'message': 'Not Found', 'error': 404}
+
+        payload = ujson.dumps(body).encode('utf8')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            payload = gzip.compress(payload, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        with fake.lock:
+            fake.statuses[status] += 1
+            fake.bytes_sent += len(payload)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(payload)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fixture', type=str,
+                        default='flatten_comments_in.json')
+    parser.add_argument('--trace', type=str, default=None)
+    parser.add_argument('--density', type=float, default=0.2)
+    parser.add_argument('--mean-comments', type=float, default=30)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--max-url-length', type=int, default=8192)
+    parser.add_argument('--ratelimit-budget', type=int, default=600)
+    parser.add_argument('--ratelimit-window', type=int, default=600)
+    parser.add_argument('--comment-fraction', type=float, default=1.0)
+    parser.add_argument('--id-slots', type=int, default=64)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    fake = FakeReddit(host=args.host, port=args.port, seed=args.seed,
+                      fixture_path=args.fixture, trace_path=args.trace,
+                      density=args.density, mean_comments=args.mean_comments,
+                      latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                      error_rate=args.error_rate,
+                      throttle_rate=args.throttle_rate,
+                      max_url_length=args.max_url_length,
+                      ratelimit_budget=args.ratelimit_budget,
+                      ratelimit_window=args.ratelimit_window,
+                      comment_fraction=args.comment_fraction,
+                      id_slots=args.id_slots)
+    logging.info('Serving fake Reddit API on %s' % fake.url)
+    try:
+        fake.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+BASE36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+class IdRangeError(Exception):
+    pass
+
+
+def base36(n: int) -> str:
+    # link ids are base 36 integers, e.g. 't3_' + base36(n) is a fullname
+    s = ''
+    while True:
+        n, r = divmod(n, 36)
+        s = BASE36[r] + s
+        if n == 0:
+            return s
+
+
+def fullnames(start: int, count: int) -> list:
+    return ['t3_' + base36(n) for n in range(start, start + count)]
+
+
+def is_deleted(data: dict) -> bool:
+    # deleted by their author (removed links still have their comments)
+    return data.get('removed_by_category') == 'deleted' or \
+        (data.get('author') == '[deleted]' and
+         data.get('selftext') == '[deleted]')
+
+
+class IdRange(object):
+    # Tracks the binary search for the first link id created at or after a
+    # time, over probes of batch_size consecutive ids (see
+    # Ringest.find_link_id).  Link ids are handed out in creation order, so
+    # created_utc grows with the id.
+    #
+    # Probes go to next(); record(n, created_utc) takes what the oldest link
+    # in n..n+batch_size-1 was created at, or None if none of them exist.
+    # lo only moves up to a probe that found a link created before the
+    # time, so it never passes the id sought, and a walk from lo is complete
+    # whatever the gaps; hi only bounds the search.
+    #
+    # Id ranges can be sparse, so an empty probe is followed by probes of
+    # the batches after it; only max_gap empty batches in a row are taken to
+    # be past the newest link.
+
+    def __init__(self, uts: float, batch_size: int=100, max_gap: int=50):
+        self.uts = uts
+        self.batch_size = batch_size
+        self.max_gap = max_gap
+        self.lo = 0
+        self.hi = batch_size
+        # while growing hi exponentially to get past uts
+        self.growing = True
+        # first of the empty batches being stepped over, and how many
+        self.gap_start = None
+        self.gap = 0
+        self.probes = 0
+
+    def next(self) -> int:
+        # id to probe next, or None once lo is within a batch of hi
+        if self.gap_start is not None:
+            return self.gap_start + self.gap * self.batch_size
+        if self.growing:
+            return self.hi
+        if self.hi - self.lo <= self.batch_size:
+            return None
+        return (self.lo + self.hi) // 2
+
+    def record(self, n: int, created_utc: float):
+        self.probes += 1
+        if created_utc is None:
+            if self.gap_start is None:
+                self.gap_start = n
+            self.gap += 1
+            if self.gap < self.max_gap:
+                return
+            # nothing for max_gap batches: past the newest link
+        # none of the ids from the start of a gap up to n exist
+        first = self.gap_start if self.gap_start is not None else n
+        self.gap_start = None
+        self.gap = 0
+        if created_utc is not None and created_utc < self.uts:
+            self.lo = max(self.lo, n)
+            self.hi = max(self.hi, 2 * n) if self.growing else \
+                max(self.hi, n + self.batch_size)
+        else:
+            self.growing = False
+            self.hi = max(min(self.hi, first), self.lo)
@@ -0,0 +1,231 @@
+import threading
+
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+                   float('inf'))
+
+
+def endpoint_for(url: str) -> str:
+    if '/api/morechildren' in url:
+        return 'morechildren'
+    elif '/comments/' in url:
+        return 'comments'
+    elif '/search' in url:
+        return 'search'
+    elif '/access_token' in url:
+        return 'token'
+    elif '/api/info' in url:
+        return 'info'
+    return 'other'
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'total', 'count', 'max')
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the q-th observation
+        if self.count < 1:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count > 0 else 0.0,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'max': self.max}
+
+
+class Metrics(object):
+    # In-process counters for one Ringest run:
+    #
+    # - per endpoint: calls, status codes, retries, bytes received and a
+    #   latency histogram (request)
+    # - seconds slept, by reason (e.g. "retry")
+    # - busy seconds per processing stage (flatten/encode/gzip), via timer()
+    # - gauges: callables read at export time, for values owned by other
+    #   objects such as the rate limit scheduler's sleep total
+    #
+    # summary() returns everything as a JSON-able dict and prometheus() as
+    # Prometheus text exposition; serve() exposes the latter over HTTP.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = perf_counter()
+        self.calls = Counter()
+        self.statuses = Counter()
+        self.retries = Counter()
+        self.bytes = Counter()
+        self.latency = {}
+        self.sleep = Counter()
+        self.stages = Counter()
+        self.stage_counts = Counter()
+        self.skipped = Counter()
+        self.gauges = {}
+        self.server = None
+
+    def request(self, endpoint: str, seconds: float, status: int=None,
+                n_bytes: int=0):
+        with self.lock:
+            self.calls[endpoint] += 1
+            self.statuses[(endpoint, status)] += 1
+            self.bytes[endpoint] += n_bytes
+            self.latency.setdefault(endpoint, Histogram()).observe(seconds)
+
+    def retry(self, endpoint: str):
+        with self.lock:
+            self.retries[endpoint] += 1
+
+    def add_sleep(self, reason: str, seconds: float):
+        with self.lock:
+            self.sleep[reason] += seconds
+
+    def add_stage(self, stage: str, seconds: float):
+        with self.lock:
+            self.stages[stage] += seconds
+            self.stage_counts[stage] += 1
+
+    def skip(self, stage: str, error: str):
+        # an item dropped by a pipeline stage after error
+        with self.lock:
+            self.skipped[(stage, error)] += 1
+
+    @contextmanager
+    def timer(self, stage: str):
+        st = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(stage, perf_counter() - st)
+
+    def gauge(self, name: str, fn):
+        self.gauges[name] = fn
+
+    def summary(self) -> dict:
+        with self.lock:
+            endpoints = {}
+            for endpoint in sorted(self.calls):
+                endpoints[endpoint] = {
+                    'calls': self.calls[endpoint],
+                    'retries': self.retries[endpoint],
+                    'bytes': self.bytes[endpoint],
+                    'statuses': {str(status): n for (e, status), n
+                                 in self.statuses.items() if e == endpoint},
+                    'latency': self.latency[endpoint].summary()
+                }
+            request_seconds = sum(h.total for h in self.latency.values())
+            summary = {
+                'wall_seconds': perf_counter() - self.started,
+                'request_seconds': request_seconds,
+                'endpoints': endpoints,
+                'sleep_seconds': dict(self.sleep),
+                'stages': {stage: {'seconds': self.stages[stage],
+                                   'count': self.stage_counts[stage]}
+                           for stage in sorted(self.stages)},
+                'skipped': {'%s/%s' % key: n
+                            for key, n in sorted(self.skipped.items())}
+            }
+        summary['gauges'] = {name: fn() for name, fn in self.gauges.items()}
+        return summary
+
+    def prometheus(self) -> str:
+        lines = []
+
+        def metric(name: str, kind: str, samples: list, family: str=None):
+            if kind is not None:
+                lines.append('# TYPE ringest_%s %s' % (family or name, kind))
+            for labels, value in samples:
+                label_str = ','.join('%s="%s"' % kv for kv in labels)
+                lines.append('ringest_%s%s %s' %
+                             (name, '{%s}' % label_str if label_str else '',
+                              repr(float(value))))
+
+        with self.lock:
+            metric('requests_total', 'counter',
+                   [((('endpoint', e), ('status', s)), n)
+                    for (e, s), n in sorted(self.statuses.items(),
+                                            key=lambda kv: str(kv[0]))])
+            metric('retries_total', 'counter',
+                   [((('endpoint', e),), n) for e, n in self.retries.items()])
+            metric('response_bytes_total', 'counter',
+                   [((('endpoint', e),), n) for e, n in self.bytes.items()])
+            samples = []
+            for e, h in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS, h.counts):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append(((('endpoint', e), ('le', le)), cumulative))
+            metric('request_seconds_bucket', 'histogram', samples,
+                   family='request_seconds')
+            metric('request_seconds_sum', None,
+                   [((('endpoint', e),), h.total)
+                    for e, h in sorted(self.latency.items())])
+            metric('request_seconds_count', None,
+                   [((('endpoint', e),), h.count)
+                    for e, h in sorted(self.latency.items())])
+            metric('sleep_seconds_total', 'counter',
+                   [((('reason', r),), s) for r, s in self.sleep.items()])
+            metric('stage_seconds_total', 'counter',
+                   [((('stage', s),), t) for s, t in self.stages.items()])
+            metric('skipped_total', 'counter',
+                   [((('stage', s), ('error', e)), n)
+                    for (s, e), n in sorted(self.skipped.items())])
+        for name, fn in self.gauges.items():
+            metric(name, 'gauge', [((), fn() or 0)])
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int, host: str='127.0.0.1'):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever,
+                         name='metrics', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,16 @@
+-- Job queue of coordinator.py: one row per hour of a backfill.  Jobs are
+-- claimed with SELECT ... FOR UPDATE SKIP LOCKED, so any number of processes
+-- on any number of hosts can work through the same table without claiming a
+-- job twice.
+CREATE TABLE IF NOT EXISTS ringest_jobs (
+    bucket       text        NOT NULL,
+    start_time   timestamptz NOT NULL,
+    end_time     timestamptz NOT NULL,
+    state        text        NOT NULL DEFAULT 'pending',
+    owner        text,
+    attempts     integer     NOT NULL DEFAULT 0,
+    leased_until timestamptz,
+    error        text,
+    updated      timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (bucket, start_time)
+);
@@ -0,0 +1,191 @@
+import ujson
+
+from comment_stream import iter_comments
+from datetime import datetime
+from s3sink import S3Sink
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# (column, type) of the links and comments tables.  Every row also keeps the
+# whole thing as JSON in a "json" column, for fields without a column of
+# their own.
+LINK_COLUMNS = (
+    ('id', 'string'),
+    ('name', 'string'),
+    ('subreddit', 'string'),
+    ('subreddit_id', 'string'),
+    ('author', 'string'),
+    ('title', 'string'),
+    ('selftext', 'string'),
+    ('url', 'string'),
+    ('domain', 'string'),
+    ('permalink', 'string'),
+    ('created_utc', 'timestamp'),
+    ('score', 'int64'),
+    ('num_comments', 'int64'),
+    ('upvote_ratio', 'float64'),
+    ('over_18', 'bool'),
+    ('is_self', 'bool'),
+    ('stickied', 'bool'),
+    ('json', 'string'),
+)
+COMMENT_COLUMNS = (
+    ('link_id', 'string'),
+    ('id', 'string'),
+    ('name', 'string'),
+    ('parent_id', 'string'),
+    ('subreddit', 'string'),
+    ('author', 'string'),
+    ('body', 'string'),
+    ('created_utc', 'timestamp'),
+    ('score', 'int64'),
+    ('controversiality', 'int64'),
+    ('gilded', 'int64'),
+    ('depth', 'int64'),
+    ('distinguished', 'string'),
+    ('stickied', 'bool'),
+    ('json', 'string'),
+)
+
+
+def to_string(v):
+    return v if isinstance(v, str) else None
+
+
+def to_int(v):
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        return None
+    return int(v)
+
+
+def to_float(v):
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        return None
+    return float(v)
+
+
+def to_bool(v):
+    return v if isinstance(v, bool) else None
+
+
+def to_timestamp(v):
+    # epoch seconds -> epoch milliseconds
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        return None
+    return int(v * 1000)
+
+
+CONVERTERS = {'string': to_string, 'int64': to_int, 'float64': to_float,
+              'bool': to_bool, 'timestamp': to_timestamp}
+
+
+def arrow_schema(columns: tuple):
+    types = {'string': pa.string(), 'int64': pa.int64(),
+             'float64': pa.float64(), 'bool': pa.bool_(),
+             'timestamp': pa.timestamp('ms', tz='UTC')}
+    return pa.schema([(name, types[t]) for name, t in columns])
+
+
+def row_values(data: dict, columns: tuple) -> list:
+    return [ujson.dumps(data) if name == 'json' else
+            CONVERTERS[t](data.get(name)) for name, t in columns]
+
+
+class ParquetTableWriter(object):
+    # Streams one Parquet file to S3.  Rows are buffered column-wise and
+    # written out as a row group every row_group_rows rows, so memory is
+    # bounded by one row group plus the sink's pending parts.
+
+    def __init__(self, s3_client, bucket: str, key: str, columns: tuple,
+                 row_group_rows: int=20000, compression: str='snappy',
+                 part_size: int=8 * 1024 * 1024):
+        self.columns = columns
+        self.schema = arrow_schema(columns)
+        self.row_group_rows = row_group_rows
+        self.sink = S3Sink(s3_client=s3_client, bucket=bucket, key=key,
+                           part_size=part_size)
+        self.writer = pq.ParquetWriter(self.sink, self.schema,
+                                       compression=compression)
+        self.buffer = [[] for _ in columns]
+        self.rows = 0
+
+    def append(self, data: dict):
+        for values, value in zip(self.buffer, row_values(data, self.columns)):
+            values.append(value)
+        if len(self.buffer[0]) >= self.row_group_rows:
+            self.flush()
+
+    def flush(self):
+        n = len(self.buffer[0])
+        if n < 1:
+            return
+        self.writer.write_table(pa.Table.from_arrays(
+            [pa.array(values, type=field.type)
+             for values, field in zip(self.buffer, self.schema)],
+            schema=self.schema), row_group_size=n)
+        self.rows += n
+        self.buffer = [[] for _ in self.columns]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        self.sink.close()
+
+    def abort(self):
+        self.sink.abort()
+
+
+class ParquetOutput(object):
+    # Writes link documents as two Parquet tables, links and comments (one
+    # row per flattened comment), under Hive-style partitions:
+    #
+    #   <prefix>/links/dt=YYYY-MM-DD/hour=HH/HHMM.parquet
+    #   <prefix>/comments/dt=YYYY-MM-DD/hour=HH/HHMM.parquet
+    #
+    # keyed by the start of the ingested window.  Requires pyarrow.  Used as
+    # a context manager both files are completed on a clean exit and their
+    # uploads aborted otherwise.
+
+    def __init__(self, s3_client, bucket: str, start_time: datetime,
+                 prefix: str='reddit/parquet', row_group_rows: int=20000,
+                 compression: str='snappy'):
+        if pa is None:
+            raise ImportError('pyarrow is required for Parquet output')
+        partition = start_time.strftime('dt=%Y-%m-%d/hour=%H/%H%M.parquet')
+        self.links = ParquetTableWriter(
+            s3_client, bucket, '%s/links/%s' % (prefix, partition),
+            LINK_COLUMNS, row_group_rows=row_group_rows,
+            compression=compression)
+        self.comments = ParquetTableWriter(
+            s3_client, bucket, '%s/comments/%s' % (prefix, partition),
+            COMMENT_COLUMNS, row_group_rows=row_group_rows,
+            compression=compression)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            try:
+                self.links.close()
+                self.comments.close()
+            except Exception:
+                self.links.abort()
+                self.comments.abort()
+                raise
+        else:
+            self.links.abort()
+            self.comments.abort()
+        return False
+
+    def write(self, link_doc: dict):
+        self.links.append(link_doc['link']['data'])
+        link_name = link_doc['link']['data'].get('name')
+        for data in iter_comments(link_doc):
+            if data.get('link_id') is None:
+                data = dict(data, link_id=link_name)
+            self.comments.append(data)
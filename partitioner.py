@@ -0,0 +1,123 @@
+import logging
+import os
+import ujson
+
+from datetime import datetime, timezone
+
+
+class AdaptivePartitioner(object):
+    # Hands out search sub-windows over [start_uts, end_uts) whose size
+    # follows the density of links instead of being fixed:
+    #
+    # - a window that comes back with fewer than limit * low_fill results
+    #   doubles the size of the next one (up to max_size)
+    # - one with more than limit * high_fill results halves it
+    # - one that overflowed (the search returned an "after") is bisected and
+    #   both halves are searched again, down to min_size, below which the
+    #   caller has to fall back to paging
+    #
+    # initial_density (links per second, e.g. from the previous run) picks
+    # the starting size so that a window is expected to be target_fill full.
+    #
+    # done lists (start, end) windows that are already finished (e.g. from a
+    # checkpoint); no window handed out overlaps them.
+
+    def __init__(self, start_uts: int, end_uts: int, limit: int=100,
+                 initial_size: int=10, initial_density: float=None,
+                 min_size: int=1, max_size: int=3600, target_fill: float=0.5,
+                 low_fill: float=0.25, high_fill: float=0.75,
+                 done: list=None):
+        self.cursor = start_uts
+        self.done = sorted(done or [])
+        self.end_uts = end_uts
+        self.limit = limit
+        self.min_size = max(min_size, 1)
+        self.max_size = max(max_size, self.min_size)
+        self.low_fill = low_fill
+        self.high_fill = high_fill
+        if initial_density is not None and initial_density > 0:
+            initial_size = target_fill * limit / initial_density
+        self.size = self.clamp(initial_size)
+        self.pending = []
+        self.links = 0
+        self.seconds = 0
+        self.windows = 0
+        self.splits = 0
+
+    def clamp(self, size: float) -> int:
+        return int(min(max(size, self.min_size), self.max_size))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> tuple:
+        if len(self.pending) > 0:
+            window = self.pending.pop()
+        else:
+            self.skip_done()
+            if self.cursor >= self.end_uts:
+                raise StopIteration()
+            end_uts = min(self.cursor + self.size - 1, self.end_uts - 1)
+            if len(self.done) > 0:
+                end_uts = min(end_uts, self.done[0][0] - 1)
+            window = (self.cursor, end_uts)
+            self.cursor = window[1] + 1
+
+        self.windows += 1
+        return window
+
+    def skip_done(self):
+        while len(self.done) > 0 and self.done[0][0] <= self.cursor:
+            self.cursor = max(self.cursor, self.done.pop(0)[1] + 1)
+
+    def overflow(self, window: tuple) -> bool:
+        # Returns True if window was bisected (so its results should be
+        # dropped), False if it is already as small as allowed.
+        start_uts, end_uts = window
+        length = end_uts - start_uts + 1
+        if length <= self.min_size:
+            return False
+
+        self.splits += 1
+        mid = start_uts + length // 2
+        self.pending.append((mid, end_uts))
+        self.pending.append((start_uts, mid - 1))
+        self.size = self.clamp(min(self.size, length // 2))
+        return True
+
+    def record(self, window: tuple, count: int):
+        length = window[1] - window[0] + 1
+        self.links += count
+        self.seconds += length
+        if count < self.limit * self.low_fill:
+            self.size = self.clamp(max(self.size, length) * 2)
+        elif count > self.limit * self.high_fill:
+            self.size = self.clamp(length // 2)
+
+    def density(self) -> float:
+        if self.seconds < 1:
+            return None
+        return self.links / self.seconds
+
+
+def load_density(path: str) -> float:
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return ujson.load(f).get('links_per_second')
+    except (OSError, ValueError) as e:
+        logging.warning('Unable to read search density from %s: %r' % (path, e))
+        return None
+
+
+def save_density(path: str, density: float):
+    if path is None or density is None:
+        return
+    # written to a temporary file first, since several coordinated processes
+    # may share path
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        ujson.dump({'links_per_second': density,
+                    'updated': datetime.now(timezone.utc).isoformat()}, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,174 @@
+import logging
+import queue
+import threading
+
+from time import perf_counter
+
+_END = object()
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class Stage(object):
+    __slots__ = ('name', 'fn', 'workers', 'items_in', 'items_out',
+                 'busy_seconds', 'lock', 'running')
+
+    def __init__(self, name: str, fn, workers: int=1):
+        self.name = name
+        self.fn = fn
+        self.workers = max(workers, 1)
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_seconds = 0.0
+        self.lock = threading.Lock()
+        self.running = self.workers
+
+
+class Pipeline(object):
+    # Runs a source iterable through a chain of stages, each with its own
+    # worker threads, connected by bounded queues.  Every stage function
+    # takes one item and returns an iterable (usually a generator) of items
+    # for the next stage; whatever the last stage returns is discarded.
+    #
+    # Because the queues hold at most queue_size items, a slow stage applies
+    # backpressure upstream and memory stays bounded by the queue sizes, while
+    # network-bound and CPU-bound stages overlap.
+    #
+    # The first exception raised anywhere (including SystemExit) stops every
+    # stage and is re-raised from run().
+    #
+    #   p = Pipeline(source=links(), queue_size=10)
+    #   p.add_stage('fetch', fetch, workers=4)
+    #   p.add_stage('write', write)
+    #   p.run()
+
+    def __init__(self, source, queue_size: int=10):
+        self.source = source
+        self.queue_size = max(queue_size, 1)
+        self.stages = []
+        self.stop = threading.Event()
+        self.error = None
+        self.lock = threading.Lock()
+        self.source_count = 0
+
+    def add_stage(self, name: str, fn, workers: int=1):
+        self.stages.append(Stage(name=name, fn=fn, workers=workers))
+        return self
+
+    def fail(self, e: BaseException):
+        with self.lock:
+            if self.error is None:
+                self.error = e
+        self.stop.set()
+
+    def put(self, q: queue.Queue, item):
+        while True:
+            if self.stop.is_set():
+                raise PipelineStopped()
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self, q: queue.Queue):
+        while True:
+            if self.stop.is_set():
+                raise PipelineStopped()
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def end(self, q: queue.Queue, stage_index: int):
+        # signal every worker of the next stage, if there is one
+        if stage_index < len(self.stages):
+            for _ in range(self.stages[stage_index].workers):
+                self.put(q, _END)
+
+    def run_source(self, q: queue.Queue):
+        try:
+            for item in self.source:
+                self.put(q, item)
+                self.source_count += 1
+            self.end(q, 0)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            self.fail(e)
+
+    def run_stage(self, index: int, q_in: queue.Queue, q_out: queue.Queue):
+        stage = self.stages[index]
+        try:
+            while True:
+                item = self.get(q_in)
+                if item is _END:
+                    break
+
+                st = perf_counter()
+                busy, n_out = 0.0, 0
+                results = stage.fn(item)
+                if results is not None:
+                    for result in results:
+                        n_out += 1
+                        if q_out is not None:
+                            # don't count time blocked on a full queue
+                            busy += perf_counter() - st
+                            self.put(q_out, result)
+                            st = perf_counter()
+                busy += perf_counter() - st
+                with stage.lock:
+                    stage.items_in += 1
+                    stage.items_out += n_out
+                    stage.busy_seconds += busy
+
+            with stage.lock:
+                stage.running -= 1
+                last = stage.running == 0
+            if last and q_out is not None:
+                self.end(q_out, index + 1)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            self.fail(e)
+
+    def run(self):
+        queues = [queue.Queue(maxsize=self.queue_size)
+                  for _ in range(len(self.stages))]
+        threads = [threading.Thread(target=self.run_source, args=(queues[0],),
+                                    name='pipeline-source', daemon=True)]
+        for i, stage in enumerate(self.stages):
+            q_out = queues[i + 1] if i + 1 < len(queues) else None
+            threads.extend(threading.Thread(target=self.run_stage,
+                                            args=(i, queues[i], q_out),
+                                            name='pipeline-%s-%d' %
+                                                 (stage.name, w),
+                                            daemon=True)
+                           for w in range(stage.workers))
+
+        for t in threads:
+            t.start()
+        try:
+            for t in threads:
+                while t.is_alive():
+                    t.join(timeout=0.5)
+        except BaseException as e:
+            # e.g. KeyboardInterrupt in the calling thread
+            self.fail(e)
+            raise
+
+        if self.error is not None:
+            raise self.error
+
+        for stage in self.stages:
+            logging.debug('Stage %s: %d in, %d out, %.1fs busy' %
+                          (stage.name, stage.items_in, stage.items_out,
+                           stage.busy_seconds))
+
+    def stats(self) -> dict:
+        return {stage.name: {'items_in': stage.items_in,
+                             'items_out': stage.items_out,
+                             'busy_seconds': stage.busy_seconds}
+                for stage in self.stages}
@@ -0,0 +1,147 @@
+import logging
+import threading
+
+from time import monotonic
+
+
+def header_number(headers, name: str, default=None):
+    # Reddit sends the X-Ratelimit-* values as strings such as '598.0', so
+    # they have to be parsed before they can be compared with anything.
+    value = headers.get(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class TokenBudget(object):
+    __slots__ = ('used', 'remaining', 'reset_at', 'next_request', 'in_flight')
+
+    def __init__(self, remaining: float, reset_at: float):
+        self.used = 0.0
+        self.remaining = remaining
+        self.reset_at = reset_at
+        self.next_request = 0.0
+        self.in_flight = 0
+
+    def available(self, now: float) -> bool:
+        return self.remaining - self.in_flight >= 1 or now >= self.reset_at
+
+    def ready_at(self, now: float) -> float:
+        if self.available(now):
+            return max(now, self.next_request)
+        return max(self.reset_at, self.next_request)
+
+
+class RateLimitScheduler(object):
+    # Tracks the X-Ratelimit-Used/Remaining/Reset budget of every token and
+    # hands out whichever token can be used soonest.  Callers only block when
+    # every token has spent its budget for the current reset window (or, if
+    # min_interval is set, when every token was used less than min_interval
+    # seconds ago).
+    #
+    # Usage:
+    #   token = scheduler.acquire()
+    #   response = ...
+    #   scheduler.update(token, response.headers)
+
+    def __init__(self, min_interval: float=0, default_remaining: float=60,
+                 default_reset: float=5):
+        self.min_interval = min_interval or 0
+        self.default_remaining = default_remaining
+        self.default_reset = default_reset
+        self.budgets = {}
+        self.sleep_seconds = 0.0
+        self.cond = threading.Condition()
+
+    def set_tokens(self, tokens: list):
+        with self.cond:
+            now = monotonic()
+            for token in tokens:
+                if token not in self.budgets:
+                    self.budgets[token] = TokenBudget(
+                        remaining=self.default_remaining,
+                        reset_at=now + self.default_reset)
+            for token in list(self.budgets):
+                if token not in tokens:
+                    del self.budgets[token]
+            self.cond.notify_all()
+
+    def acquire(self) -> str:
+        with self.cond:
+            warned = False
+            while True:
+                if len(self.budgets) < 1:
+                    raise ValueError('No tokens to schedule.')
+
+                now = monotonic()
+                token, budget = min(self.budgets.items(),
+                                    key=lambda tb: tb[1].ready_at(now))
+                ready = budget.ready_at(now)
+                if ready <= now:
+                    if budget.remaining - budget.in_flight < 1:
+                        # the reset window passed without a response telling
+                        # us the new budget, so assume a fresh default one
+                        budget.remaining = self.default_remaining
+                        budget.reset_at = now + self.default_reset
+                    budget.in_flight += 1
+                    budget.next_request = now + self.min_interval
+                    return token
+
+                wait = ready - now
+                if not budget.available(now) and not warned:
+                    # once per wait: every response wakes the waiters early
+                    logging.warning(
+                        'Rate limit exhausted on all %d tokens, sleeping %.1fs'
+                        % (len(self.budgets), wait))
+                    warned = True
+                self.cond.wait(wait)
+                # only the time actually slept, however early it woke
+                self.sleep_seconds += monotonic() - now
+
+    def update(self, token: str, headers=None):
+        # Record the outcome of a request made with token.  headers may be
+        # None (or lack the rate limit headers) when the request failed, in
+        # which case the local estimate is decremented instead.
+        with self.cond:
+            budget = self.budgets.get(token)
+            if budget is None:
+                return
+
+            now = monotonic()
+            budget.in_flight = max(budget.in_flight - 1, 0)
+            headers = headers if headers is not None else {}
+            remaining = header_number(headers, 'X-Ratelimit-Remaining')
+            if remaining is None:
+                budget.used += 1
+                budget.remaining = max(budget.remaining - 1, 0)
+            else:
+                budget.used = header_number(headers, 'X-Ratelimit-Used',
+                                            budget.used + 1)
+                budget.remaining = remaining
+                budget.reset_at = now + header_number(
+                    headers, 'X-Ratelimit-Reset', self.default_reset)
+            self.cond.notify_all()
+
+    def penalize(self, token: str, seconds: float):
+        # Take token out of rotation for seconds (e.g. after a 429 with no
+        # usable rate limit headers) so other tokens are used meanwhile.
+        with self.cond:
+            budget = self.budgets.get(token)
+            if budget is not None:
+                budget.remaining = 0
+                budget.reset_at = max(budget.reset_at, monotonic() + seconds)
+                self.cond.notify_all()
+
+    def stats(self) -> dict:
+        with self.cond:
+            now = monotonic()
+            return {
+                token[-4:]: {
+                    'used': budget.used,
+                    'remaining': budget.remaining,
+                    'reset': max(budget.reset_at - now, 0)
+                } for token, budget in self.budgets.items()
+            }
@@ -0,0 +1,97 @@
+import ujson
+
+# fields of a comment's data kept as attributes; the rest of it stays
+# serialized until it is needed
+HOT_FIELDS = ('id', 'name', 'parent_id', 'link_id', 'created_utc', 'author',
+              'score', 'body')
+HOT = frozenset(HOT_FIELDS)
+
+# key orders seen so far, so comments with the same keys share one tuple
+key_orders = {}
+
+
+class CommentRecord(object):
+    # A t1 thing in a fraction of the memory of its dict: the hot fields as
+    # slots, everything else in its data as JSON bytes, and the order of its
+    # keys, so thing() gives back an identical thing.
+    #
+    # get() and [] work for "kind" and "data" like on the thing itself, so
+    # code that only reads things (iter_comments, the delta index, Parquet
+    # output) works on either.  "data" is rebuilt on every call.
+    __slots__ = HOT_FIELDS + ('keys', 'extra')
+
+    def __init__(self, data: dict):
+        keys = tuple(data)
+        self.keys = key_orders.setdefault(keys, keys)
+        for field in HOT_FIELDS:
+            setattr(self, field, data.get(field))
+        self.extra = ujson.dumps({k: v for k, v in data.items()
+                                  if k not in HOT}).encode('utf8')
+
+    def to_data(self) -> dict:
+        extra = ujson.loads(self.extra)
+        return {k: getattr(self, k) if k in HOT else extra[k]
+                for k in self.keys}
+
+    def thing(self) -> dict:
+        return {'kind': 't1', 'data': self.to_data()}
+
+    def get(self, key: str, default=None):
+        if key == 'kind':
+            return 't1'
+        if key == 'data':
+            return self.to_data()
+        return default
+
+    def __getitem__(self, key: str):
+        if key not in ('kind', 'data'):
+            raise KeyError(key)
+        return self.get(key)
+
+
+def compact(thing):
+    # a CommentRecord for a t1 thing, anything else as it is
+    if isinstance(thing, dict) and thing.get('kind') == 't1' and \
+            len(thing) == 2 and isinstance(thing.get('data'), dict):
+        return CommentRecord(thing['data'])
+    return thing
+
+
+def plain(thing):
+    return thing.thing() if isinstance(thing, CommentRecord) else thing
+
+
+def plain_response(response):
+    # a /api/morechildren response as stored in a "more" node's children
+    if not isinstance(response, dict):
+        return response
+    json_j = response.get('json', dict())
+    data = json_j.get('data', dict())
+    if 'things' not in data:
+        return response
+    return dict(response, json=dict(json_j, data=dict(
+        data, things=[plain(t) for t in data['things']])))
+
+
+def plain_comment(comment):
+    # a flattened comment with any records in it (itself or, for a "more"
+    # node, the things fetched into it) turned back into things
+    if isinstance(comment, CommentRecord):
+        return comment.thing()
+    if comment.get('kind') != 'more':
+        return comment
+    data = comment.get('data', dict())
+    return dict(comment, data=dict(
+        data, children=[plain_response(r) for r in data.get('children', [])]))
+
+
+def plain_comments(comments: list) -> list:
+    return [plain_comment(c) for c in comments]
+
+
+def dumps(link_doc: dict) -> str:
+    # JSON of a link document exactly as if it had been built of dicts
+    if 'flattened_comments' in link_doc:
+        link_doc = dict(link_doc, flattened_comments=plain_comments(
+            link_doc['flattened_comments']))
+    return ujson.dumps(link_doc)
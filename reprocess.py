@@ -0,0 +1,293 @@
+import argparse
+import boto3
+import gzip
+import io
+import logging
+import multiprocessing
+import os
+import ujson
+
+from contextlib import closing
+from datetime import datetime, timezone
+from ringest import flatten_comments
+from s3sink import S3GzipSink, S3ZstdSink
+from time import perf_counter
+from urllib.parse import urlsplit
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Rewrites an existing archive of link documents (the
+# reddit/links/YYYY-MM-DD/HHMM.json.gz objects do_search_nibble writes)
+# through a transform, without calling the Reddit API, e.g.
+#
+#   python reprocess.py s3://cortico-data/reddit/links/2018-04 \
+#       s3://cortico-data/reddit/links-v2/2018-04 \
+#       --manifest 2018-04.progress.json --transform compact
+#
+# Sources and destinations are s3://bucket/prefix URIs or local directories.
+# Every file under the source is streamed, decompressed, transformed line by
+# line and streamed to the same relative path under the destination by one
+# of a pool of processes (one per core by default), so many files are
+# reprocessed at once.  Finished files are recorded in the progress manifest,
+# and a rerun with the same manifest skips them.
+
+SUFFIXES = {'.json.gz': 'gzip', '.json.zst': 'zstd'}
+
+
+def flatten(link_doc: dict) -> dict:
+    # flattened_comments redone from the nested "comments" tree, e.g. after
+    # a change to flatten_comments; documents without one are left as is
+    if 'comments' not in link_doc:
+        return link_doc
+    link_doc.pop('flattened_comments', None)
+    return flatten_comments(link_doc, copy=False)
+
+
+def compact(link_doc: dict) -> dict:
+    # flatten, then drop the nested tree like --stream-comments output
+    link_doc = flatten(link_doc)
+    link_doc.pop('comments', None)
+    return link_doc
+
+
+TRANSFORMS = {'flatten': flatten, 'compact': compact}
+
+
+def split_suffix(name: str) -> tuple:
+    for suffix in SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)], suffix
+    return name, None
+
+
+class LocalWriter(object):
+    # writes text to a gzip or zstd file at path, which only appears once it
+    # is complete
+    def __init__(self, path: str, codec: str):
+        self.path = path
+        self.tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.raw = open(self.tmp_path, 'wb')
+        if codec == 'zstd':
+            self.out = zstandard.ZstdCompressor(level=3).stream_writer(
+                self.raw, closefd=False)
+        else:
+            self.out = gzip.GzipFile(fileobj=self.raw, mode='wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.out.close()
+        self.raw.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+        return False
+
+    def write(self, s: str):
+        self.out.write(s.encode('utf8'))
+
+
+class Location(object):
+    # An archive prefix: s3://bucket/prefix or a local directory.  Files are
+    # named by their path relative to it.
+
+    def __init__(self, uri: str, s3_client=None):
+        parts = urlsplit(uri)
+        self.uri = uri
+        if parts.scheme == 's3':
+            self.bucket = parts.netloc
+            self.prefix = parts.path.strip('/')
+        else:
+            self.bucket = None
+            self.prefix = uri
+        self.client = s3_client
+
+    @property
+    def s3_client(self):
+        if self.client is None:
+            self.client = boto3.client('s3')
+        return self.client
+
+    def list(self) -> list:
+        names = []
+        if self.bucket is None:
+            for root, _, files in os.walk(self.prefix):
+                names.extend(os.path.relpath(os.path.join(root, f),
+                                             self.prefix) for f in files)
+        else:
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket,
+                                           Prefix=self.prefix + '/'):
+                names.extend(o['Key'][len(self.prefix) + 1:]
+                             for o in page.get('Contents', []))
+        return sorted(n for n in names if split_suffix(n)[1] is not None)
+
+    def open(self, name: str):
+        # a binary file of name's decompressed lines, read as it streams in
+        if self.bucket is None:
+            f = open(os.path.join(self.prefix, name), 'rb')
+        else:
+            f = self.s3_client.get_object(
+                Bucket=self.bucket, Key=self.prefix + '/' + name)['Body']
+        if SUFFIXES[split_suffix(name)[1]] == 'zstd':
+            if zstandard is None:
+                raise ImportError('zstandard is required to read %s' % name)
+            # one frame per uploaded part
+            return io.BufferedReader(zstandard.ZstdDecompressor().
+                                     stream_reader(f, read_across_frames=True))
+        return gzip.GzipFile(fileobj=f, mode='rb')
+
+    def create(self, name: str):
+        codec = SUFFIXES[split_suffix(name)[1]]
+        if self.bucket is None:
+            return LocalWriter(os.path.join(self.prefix, name), codec)
+        sink_class = S3ZstdSink if codec == 'zstd' else S3GzipSink
+        return sink_class(s3_client=self.s3_client, bucket=self.bucket,
+                          key=self.prefix + '/' + name)
+
+
+# per worker process, so boto3 clients are never shared across a fork
+worker_locations = None
+
+
+def init_worker():
+    global worker_locations
+    worker_locations = {}
+
+
+def worker_location(uri: str) -> Location:
+    if uri not in worker_locations:
+        worker_locations[uri] = Location(uri)
+    return worker_locations[uri]
+
+
+def reprocess_file(task: tuple) -> dict:
+    # runs in a worker process: transforms one file, returning its manifest
+    # entry
+    source_uri, dest_uri, name, output_name, transform = task
+    st = perf_counter()
+    fn = TRANSFORMS[transform]
+    records = 0
+    with closing(worker_location(source_uri).open(name)) as f, \
+            worker_location(dest_uri).create(output_name) as out:
+        for line in f:
+            if not line.strip():
+                continue
+            out.write('%s\n' % ujson.dumps(fn(ujson.loads(line))))
+            records += 1
+    return {'name': name, 'output': output_name, 'records': records,
+            'seconds': perf_counter() - st}
+
+
+class ProgressManifest(object):
+    # JSON file of the files reprocessed so far, by name, rewritten after
+    # each one finishes.  A manifest is only reused for the same source,
+    # destination, transform and codec.
+
+    def __init__(self, path: str, source: str, dest: str, transform: str,
+                 codec: str=None):
+        self.path = path
+        self.state = {'source': source, 'dest': dest, 'transform': transform,
+                      'codec': codec, 'files': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                state = ujson.load(f)
+            if [state.get(k) for k in ('source', 'dest', 'transform',
+                                       'codec')] != \
+                    [source, dest, transform, codec]:
+                raise ValueError('%s is the manifest of another reprocessing '
+                                 'run' % path)
+            self.state = state
+
+    def done(self, name: str) -> bool:
+        return name in self.state['files']
+
+    def add(self, result: dict):
+        self.state['files'][result['name']] = dict(
+            result, finished=datetime.now(timezone.utc).isoformat())
+
+    def save(self):
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            ujson.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class Reprocessor(object):
+
+    def __init__(self, source: str, dest: str, manifest_path: str,
+                 transform: str='flatten', codec: str=None,
+                 processes: int=None, s3_client=None):
+        if transform not in TRANSFORMS:
+            raise ValueError('Unknown transform %r' % transform)
+        if source.rstrip('/') == dest.rstrip('/'):
+            raise ValueError("Can't reprocess %s in place" % source)
+        self.source = Location(source, s3_client=s3_client)
+        self.dest = dest
+        self.transform = transform
+        # codec None keeps each file's own
+        self.codec = codec
+        self.processes = processes or os.cpu_count()
+        self.manifest = ProgressManifest(manifest_path, source=source,
+                                         dest=dest, transform=transform,
+                                         codec=codec)
+
+    def output_name(self, name: str) -> str:
+        if self.codec is None:
+            return name
+        return split_suffix(name)[0] + ('.json.zst' if self.codec == 'zstd' else '.json.gz')
+
+    def run(self) -> dict:
+        names = self.source.list()
+        tasks = [(self.source.uri, self.dest, name, self.output_name(name),
+                  self.transform)
+                 for name in names if not self.manifest.done(name)]
+        logging.info('Reprocessing %d of %d files in %s with %d processes' %
+                     (len(tasks), len(names), self.source.uri,
+                      self.processes))
+        st = perf_counter()
+        records = 0
+        with multiprocessing.Pool(processes=self.processes,
+                                  initializer=init_worker) as pool:
+            # a file per task: they're large, and finish in any order
+            for i, result in enumerate(pool.imap_unordered(reprocess_file,
+                                                           tasks)):
+                self.manifest.add(result)
+                self.manifest.save()
+                records += result['records']
+                logging.info('%d/%d %s: %d records in %.1fs' %
+                             (i + 1, len(tasks), result['name'],
+                              result['records'], result['seconds']))
+        elapsed = perf_counter() - st
+        logging.info('Reprocessed %d files, %d records in %.1fs' %
+                     (len(tasks), records, elapsed))
+        return {'files': len(tasks), 'skipped': len(names) - len(tasks),
+                'records': records, 'elapsed_seconds': elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', type=str)
+    parser.add_argument('dest', type=str)
+    parser.add_argument('--manifest', type=str, required=True)
+    parser.add_argument('--transform', type=str, default='flatten',
+                        choices=sorted(TRANSFORMS))
+    parser.add_argument('--codec', type=str, default=None,
+                        choices=['gzip', 'zstd'])
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    Reprocessor(args.source, args.dest, manifest_path=args.manifest,
+                transform=args.transform, codec=args.codec,
+                processes=args.processes).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import random
+import threading
+
+from ratelimit import header_number
+from time import monotonic
+
+# statuses worth retrying; anything else other than 200 fails straight away
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class RequestError(Exception):
+
+    def __init__(self, message: str, url: str=None, status: int=None):
+        super().__init__(message)
+        self.url = url
+        self.status = status
+
+
+class UriTooLongError(RequestError):
+    pass
+
+
+class RetriesExhaustedError(RequestError):
+    pass
+
+
+class CircuitOpenError(RequestError):
+    pass
+
+
+class SkippedLinksError(RequestError):
+    pass
+
+
+class CircuitBreaker(object):
+    __slots__ = ('failures', 'opened_at', 'trial')
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+
+class RetryPolicy(object):
+    # Decides whether and how long to wait before retrying a failed request:
+    #
+    # - exponential backoff with full jitter, base_delay * 2 ** attempt
+    #   capped at max_delay, unless the response says how long to wait
+    #   (Retry-After, or X-Ratelimit-Reset on a 429)
+    # - a retry budget per endpoint: every request adds budget_ratio retries
+    #   (up to budget_max) and every retry spends one, so a storm of failures
+    #   can't turn into an unbounded amount of retrying
+    # - a circuit breaker per endpoint that opens after breaker_threshold
+    #   consecutive failures, fails requests fast for breaker_cooldown
+    #   seconds, then lets a single trial request through; callers may wait
+    #   out open_seconds() for up to breaker_max_wait instead of failing
+    #
+    # Failures surface as RequestError subclasses for callers to handle.
+
+    def __init__(self, base_delay: float=1, max_delay: float=60,
+                 budget_ratio: float=0.2, budget_min: float=10,
+                 budget_max: float=100, breaker_threshold: int=10,
+                 breaker_cooldown: float=30, breaker_max_wait: float=120,
+                 rng: random.Random=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_min = budget_min
+        self.budget_max = budget_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.breaker_max_wait = breaker_max_wait
+        self.rng = rng or random.Random()
+        self.budgets = {}
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def before_request(self, endpoint: str, url: str=None):
+        with self.lock:
+            breaker = self.breakers.setdefault(endpoint, CircuitBreaker())
+            self.budgets[endpoint] = min(
+                self.budgets.get(endpoint, self.budget_min) + self.budget_ratio,
+                self.budget_max)
+            if breaker.opened_at is None:
+                return
+            if monotonic() - breaker.opened_at < self.breaker_cooldown or \
+                    breaker.trial:
+                raise CircuitOpenError(
+                    'Circuit open for %s after %d consecutive failures' %
+                    (endpoint, breaker.failures), url=url)
+            # half open: let one request through to test the endpoint
+            breaker.trial = True
+
+    def open_seconds(self, endpoint: str) -> float:
+        # how long until endpoint's breaker might let a request through: the
+        # rest of its cooldown, or a moment while another request is its
+        # trial
+        with self.lock:
+            breaker = self.breakers.get(endpoint)
+            if breaker is None or breaker.opened_at is None:
+                return 0.0
+            left = self.breaker_cooldown - (monotonic() - breaker.opened_at)
+            if left > 0:
+                return left
+            return 0.1 if breaker.trial else 0.0
+
+    def record_success(self, endpoint: str):
+        with self.lock:
+            breaker = self.breakers.setdefault(endpoint, CircuitBreaker())
+            breaker.failures = 0
+            breaker.opened_at = None
+            breaker.trial = False
+
+    def record_failure(self, endpoint: str):
+        with self.lock:
+            breaker = self.breakers.setdefault(endpoint, CircuitBreaker())
+            breaker.failures += 1
+            if breaker.trial or breaker.failures >= self.breaker_threshold:
+                breaker.opened_at = monotonic()
+                breaker.trial = False
+
+    def release(self, endpoint: str):
+        # the trial request never got an answer (e.g. no token could be had),
+        # so the next request gets to be the trial instead
+        with self.lock:
+            breaker = self.breakers.get(endpoint)
+            if breaker is not None:
+                breaker.trial = False
+
+    def consume_retry(self, endpoint: str) -> bool:
+        with self.lock:
+            budget = self.budgets.get(endpoint, self.budget_min)
+            if budget < 1:
+                return False
+            self.budgets[endpoint] = budget - 1
+            return True
+
+    def retryable(self, status: int) -> bool:
+        # status is None when the request itself failed (connection, timeout)
+        return status is None or status in RETRY_STATUSES
+
+    def delay(self, attempt: int, response=None) -> float:
+        if response is not None:
+            retry_after = header_number(response.headers, 'Retry-After')
+            if retry_after is None and response.status_code == 429:
+                retry_after = header_number(response.headers,
+                                            'X-Ratelimit-Reset')
+            if retry_after is not None:
+                return min(max(retry_after, 0), self.max_delay)
+
+        with self.lock:
+            jitter = self.rng.random()
+        return jitter * min(self.max_delay, self.base_delay * 2 ** attempt)
@@ -1,19 +1,73 @@
 import boto3
-import gzip
 import logging
+import records
 import requests
-import psycopg2
-import sys
-import tempfile
+import threading
 import ujson
 
-from collections import namedtuple
-from contextlib import closing
+from checkpoint import Checkpoint
+from collections import Counter, deque, namedtuple
+from comment_stream import iter_comments, parse_comments
+from contextlib import closing, contextmanager
+from credentials import ConnectionPool, CredentialLeaser
 from datetime import datetime, timedelta, timezone
-from requests.auth import HTTPBasicAuth
-from time import sleep
+from dedupe import DedupeIndex
+from delta import DeltaIndex, comment_state
+from link_ids import IdRange, IdRangeError, base36, fullnames, is_deleted
+from metrics import Metrics, endpoint_for
+from parquet_sink import ParquetOutput
+from partitioner import AdaptivePartitioner, load_density, save_density
+from pipeline import Pipeline
+from ratelimit import RateLimitScheduler
+from retry import CircuitOpenError, RequestError, RetriesExhaustedError, \
+    RetryPolicy, SkippedLinksError, UriTooLongError
+from s3sink import S3GzipSink, S3ZstdSink, UploadError
+from sharded import ShardedSink
+from sessions import SessionPool
+from thread_cache import ThreadCache
+from time import perf_counter, sleep
+from tokens import TokenManager
+
+def iter_flattened_comments(link_doc):
+    # Generator behind flatten_comments: yields the comments of link_doc in
+    # the same depth-first order, one at a time, without building the list.
+    #
+    # The tree is walked with an explicit stack of listing iterators, so
+    # arbitrarily deep reply chains can't hit the recursion limit.  Each
+    # yielded comment shares everything with the input except its "data"
+    # dict, which is shallow copied only when it has a "replies" key to drop.
+    comments = link_doc["comments"]
+
+    # Expect the first element of comments to be "Listing" type with length 1,
+    # and the type of the first element in the Listing to be "t3" (link)
+    assert comments[0]["kind"] == "Listing" and \
+        len(comments[0]["data"]["children"]) == 1 and \
+        comments[0]["data"]["children"][0]["kind"] == "t3"
+
+    def listing_children(comment_listing):
+        assert comment_listing["kind"] == "Listing"
+        return iter(comment_listing["data"]["children"])
+
+    stack = [listing_children(cl) for cl in reversed(comments[1:])]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            continue
+
+        data = child["data"]
+        if "replies" in data:
+            replies = data["replies"]
+            data = data.copy()
+            del data["replies"]
+            yield dict(child, data=data)
+            if replies:
+                stack.append(listing_children(replies))
+        else:
+            yield child
+
 
-def flatten_comments(link_doc):
+def flatten_comments(link_doc, copy: bool=True):
     # This function takes the link document as produced in
     # do_search_nibble and transforms the comment tree into
     # a flat list that is more amenable to querying with 
@@ -23,32 +77,71 @@ def flatten_comments(link_doc):
     # - removes the link itself from the comments listing (kind="t3")
     # - traverses the "replies" tree and puts each document into the top level 
     # - "flattened_comments" array
-    comments = link_doc["comments"]
-    flattened_comments = []
-    
-    # Expect the first element of comments to be "Listing" type with length 1,
-    # and the type of the first element in the Listing to be "t3" (link)
-    assert comments[0]["kind"] == "Listing" and \
-        len(comments[0]["data"]["children"]) == 1 and \
-        comments[0]["data"]["children"][0]["kind"] == "t3"
-    
-    def traverse(comment_listing):
-        assert comment_listing["kind"] == "Listing"
-        for child in comment_listing["data"]["children"]:
-            clone = dict(child)
-            clone["data"] = {k:v for (k,v) in clone["data"].items() if k != "replies"}
-            flattened_comments.append(clone)
-            if child["data"].get("replies"):
-                traverse(child["data"]["replies"])
-    
-    for cl in comments[1:]:
-        traverse(cl)
-    
+    #
+    # With copy=False the "flattened_comments" key is added to link_doc
+    # itself instead of to a shallow copy of it.
+    flattened_comments = list(iter_flattened_comments(link_doc))
+    if not copy:
+        link_doc["flattened_comments"] = flattened_comments
+        return link_doc
+
     return dict(link_doc,flattened_comments=flattened_comments)
 
 class Ringest(object):
     ChildPaths = namedtuple('ChildPaths', ['link_name', 'child_ids'])
     bad_ids = (None, '', '_', '__')
+    password_map = {
+        'Faahes23QZg7Fw': 'SeQC4OK7gpSb4i4k837GMo_ains',
+        'laAeq4H1xGpxIQ': 'Vn9bPKzZxcJnEYnKg6AEe52cy7A',
+        'EzDWhK39JN7hOg': 'UgQV1Z-PNSWEspqvu6wSuXVBmUs',
+        'sOSbsk4n7hP5ew': '7WZOJLhEeVW2tuu81DLuTbDLvKk',
+        'AiVR0xcW7FZHDQ': 'q8dY0rknQGe4WoUi7hCwRvL8mRM',
+        '1SF9q6doBTM7Xw': 'zOaYHcQF5Y4Y3pM4XY0LjSyDae4',
+        'Pp1SYjBTFJPxXg': 'pphvk1Ld3U71jJbbgFZNfoWVlu0',
+        'SinbCmDX2Y3dTg': 'EA5H78qxHwjlhdxBjLq0bBFyax8',
+        'i6zXuvsjCYcW2w': '6iygaqQzUbln1Cc2mq1y1X-B0mQ',
+        'BKpMuC6ZaYYBSQ': 'xLn99WdorXD8OSoWZDU8zbau_1o',
+        'fpAqd_Cvu6lGww': 'kQ-f0AETHs7WpMMDb4Vasz09T48',
+        'UmYc7VkTTN-GOA': 'ZE4y2FpwtcrY1wHBE98NH8MLiUQ',
+        'hYgy3w8D0ExVYA': 'R3-CyxTt1IE_NR9r7tD0ka2pmic',
+        'H-dfuCXGJPDibQ': 'ansVAsyLZeUHa42ztZkPavxS89E',
+        'CSudDHcTD31xMg': 'C2V0pnm9K5WB3JUaZS6ypBR8prc',
+        'GVSHiTvtT2NtYg': 'DRRhNTTNdLuXeUQCE63CUn3eaIQ',
+
+        'jsgT2jZhMoTdpw': 'lZ7N_XICirw-woP5embX4EVXW5g',
+        'PrExSJoSJF8Odg': 'YeR4QyU9ze7fgnn6IiSQXBcl84I',
+        'c1GfGn-W5mwhMA': 'XKulAY-_l_y8MiaKGGUhak2f01c',
+        'kN5xZ8e84C_ZLg': 'fmcC30ebMlCRiNwmO4pZij5oAZE',
+        'pRyF07D9qgwkrA': 'FukIx78hSUEwBXcSxbvQpS90-w4',
+        'NmQTUgPrEDwVfQ': 'XdO4LiyMIAmhpbnfFYjEOG5YVtQ',
+        '4Tl1srQyzWQq9Q': 'LO7Jp13-cZMLl91XD9b21wm4Ry0',
+        'DikErd-RK9a6dg': '8inRSMyU53Uoo_p_-9uN3rvE71E',
+        'uLVSduDxuUnVlQ': 'LdgBzU-SgXbR3iEe2U2RMdlejAw',
+        '8lQHB4s4J3eo4g': 'zReYzMB2wDxli2mlHU9_zxVcvzY',
+        '7j0Kf7Stx2wz8g': 'OUAVUU0jm6NOz64fgX3r07n2x9Y',
+        'tOg3MYyAiVZ9SQ': 'D57oOXJwweGU2uwRPHSqy1B2sAA',
+        'qmih4x-Ds_asag': '9xvb5imgI30I50BGOxYJccxZWxI',
+        '6vxCFKJnuNYlkA': 'uOLoHpZFC84YlH52SvUgEryRWOg',
+        'fhNxav9h2jBEqg': 'iTNVB0QUWIGRUOSBYzHWv1VBNCs',
+        'OMlZ4Dm_MO2kdg': '9wucDKW7X4S7ef1urxxR7OWc6cg',
+
+        '-2BIjqi2Y1R1uw': 'CABnoXVq9zBu4yEvwM1TZbR6PUU',
+        'BYHPd1zPGMIqow': '5C2UirejH9hp10d5awYfiBwmccI',
+        'ZTDeQZolrFOGkQ': 'gQmnaW__xk7Wd9kis6CJQTi8pu0',
+        'FwxYSFBwmksGqw': 'fNmiYjMHEVqxjz_U3yD66xoKrYM',
+        '4hpmrTmGS3Fpog': 'yshVS1jhy8z3VYKa4iHxbh_rsGY',
+        'OigG49ol-B8iyg': 'ox1XCCTSblqaUDjl7Kd2OnhRu3g',
+        'ZDKBeFrJTHYjaw': 'MFpzpMQuK7SYciF6eqVPjHP_EIY',
+        'YEKCtuleUbofxw': 'OPCUEMDou-8266OFjfTicYW61CE',
+        'fI9TvhYG1aLyWg': '6pzzPxQ7SltfGnp4zuKGxbncvKI',
+        '6nM3QgAyT0pFew': 't2TUX7cmkVLTaxwhEAB54bPpFno',
+        'd6IVDISzsp0OGA': 'i336d-A3zr6UFHDnjSS0Q6Bcg1A',
+        'dOCeG8cp27s3CQ': 'Gbqa5b_jW3yoFalwINbm743ZmR0',
+        'JYhur3ostoTExw': '6WR8mBolNoYl3J4v55Y0NggnPdU',
+        'FJEh0N3Ue-2uMA': 'KGTNfJDoAyeFnGspfk2dimxkk4w',
+        'o9Y0u9aX9eDylw': 'o1bfyaUMdoxXHBTC3J6ba7BvAGQ',
+        'WndOVZdQQtr4WQ': 'HcLHk9cCQtCfFQwoRnRkop_WyzY'
+    }
 
     @property
     def default_rate_limit_remaining(self):
@@ -58,47 +151,212 @@ class Ringest(object):
     def default_rate_limit_reset(self):
         return 5
 
-    def __init__(self, component_credentials, bucket_name='cortico-data'):
+    def __init__(self, component_credentials, bucket_name='cortico-data',
+                 pool_size: int=10, request_timeout: float=30,
+                 api_url: str='https://oauth.reddit.com',
+                 auth_url: str='https://www.reddit.com',
+                 credential_leaser: CredentialLeaser=None,
+                 token_cache_path: str=None, token_cache_key: bytes=None):
         self.component_credentials = component_credentials
         self.bucket_name = bucket_name
+        self.api_url = api_url
+        self.auth_url = auth_url
         self.unames = []
+        self.leaser = credential_leaser
+        self.owns_leaser = False
+        self.credential_lease = None
         self.tokens = []
-        self.request_sleep = 1
-        self.rate_limit_used = 0
-        self.rate_limit_remaining = self.default_rate_limit_remaining
-        self.rate_limit_reset = 0
+        self.tokens_manager = None
+        self.token_cache_path = token_cache_path
+        self.token_cache_key = token_cache_key
+        self.request_sleep = 0
+        self.scheduler = RateLimitScheduler(
+            min_interval=self.request_sleep,
+            default_remaining=self.default_rate_limit_remaining,
+            default_reset=self.default_rate_limit_reset)
         self.last_request_time = None
         self.request_count = 0
         self.sleep_every = 3
+        # ids per /api/morechildren call, shrunk whenever a 414 comes back
+        self.morechildren_batch_size = 100
+        self.max_url_length = 2048
+        self.lock = threading.RLock()
+        # backoff, retry budgets and circuit breakers for request()
+        self.retry_policy = RetryPolicy()
+        self.search_density = None
+        self.checkpoint = None
+        self.metrics = Metrics()
+        self.metrics.gauge('rate_limit_sleep_seconds',
+                           lambda: self.scheduler.sleep_seconds)
+        self.metrics.gauge('tokens', lambda: len(self.tokens))
+        self.dedupe = DedupeIndex()
+        self.metrics.gauge('duplicate_links',
+                           lambda: self.dedupe.duplicates['link'])
+        self.metrics.gauge('duplicate_comments',
+                           lambda: self.dedupe.duplicates['comment'])
+        self.thread_cache = None
+        self.delta_index = None
+        # links put aside by skipping_failures
+        self.skipped_links = []
+        self.stream_comments = False
+        self.compact_records = False
+        self.sessions = SessionPool(headers=Ringest.base_headers(),
+                                    pool_size=pool_size,
+                                    timeout=(5, request_timeout))
 
     def do_ringest(self, start_time: datetime, end_time: datetime,
-                   token_count: int=2, request_sleep: int=1,
+                   token_count: int=2, request_sleep: float=0,
                    reservation_hours: int=0, reservation_minutes: int=10,
-                   limit=100):
+                   limit=100, workers: int=None, density_path: str=None,
+                   checkpoint_path: str=None, resume: bool=False,
+                   cache_path: str=None, cache_ttl_seconds: float=3600,
+                   cache_max_bytes: int=1024 * 1024 * 1024,
+                   s3_client=None, metrics_path: str=None,
+                   metrics_port: int=None, output_format: str='json',
+                   stream_comments: bool=False, compact_records: bool=False,
+                   delta_index_path: str=None,
+                   delta: bool=False, dedupe_bloom_path: str=None,
+                   shards: int=None, codec: str='gzip',
+                   shard_max_bytes: int=None, shard_max_records: int=None,
+                   discovery: str='search'):
         # Fetching data within a time range entails querying three separate
         # endpoints:
         #
         # 1) /search -- to get links posted within the time frame
         # 2) /comments -- to get the first n top-level comments on a link
         # 3) /api/morechildren -- to get the rest of the comments on a link
+        #
+        # delta_index_path keeps the comments seen on every link, and
+        # delta=True revisits the known links created in the time range for
+        # just their new and changed comments instead (see do_delta_nibble).
+        #
+        # discovery='ids' finds the links by walking link ids with
+        # /api/info instead of searching (see id_links).
+        #
+        # Links are fetched and written once per run however often the
+        # search returns them; with dedupe_bloom_path also only once across
+        # runs of different hours (see DedupeIndex).
         st = datetime.now(timezone.utc)
-        s3 = boto3.client("s3")
+        s3 = s3_client if s3_client is not None else boto3.client("s3")
+        if discovery not in ('search', 'ids'):
+            raise ValueError('Unknown discovery %r' % discovery)
+        if codec not in ('gzip', 'zstd'):
+            raise ValueError('Unknown codec %r' % codec)
         search_key = 'reddit/links/' +\
-                     start_time.strftime('%Y-%m-%d/%H%M.json.gz')
-        self.unames = self.lock_creds(count=token_count,
-                                      reservation_hours=reservation_hours,
-                                      reservation_minutes=reservation_minutes)
-        self.request_sleep = request_sleep
-        # self.do_search_experiment(start_time=start_time, part_size_seconds=2,
-        #                           limit=limit)
-        self.do_search_nibble(s3_client=s3, s3_key=search_key,
-                              start_time=start_time, end_time=end_time,
-                              part_size_seconds=10,
-                              limit=limit)
-        et = datetime.now(timezone.utc)
-        # really should clean up credential reservation to be cleaner
-        self.release_creds()
-        logging.info('%d calls in %s.' % (self.request_count, str(et - st)))
+                     start_time.strftime('%Y-%m-%d/%H%M') +\
+                     ('.json.zst' if codec == 'zstd' else '.json.gz')
+        # With checkpoint_path every uploaded part, the links in it and each
+        # searched window are journaled; resume=True continues from there.
+        if output_format not in ('json', 'parquet'):
+            raise ValueError('Unknown output format %r' % output_format)
+        if output_format == 'parquet' and checkpoint_path is not None:
+            raise ValueError("Parquet output can't be checkpointed")
+        if shards is not None and (output_format != 'json' or
+                                   checkpoint_path is not None):
+            raise ValueError("Sharded output is JSON only and can't be "
+                             "checkpointed")
+        if delta and (delta_index_path is None or
+                      checkpoint_path is not None or
+                      output_format != 'json' or stream_comments):
+            raise ValueError('Delta runs need a delta index, and only write '
+                             'uncheckpointed JSON')
+        if compact_records and not stream_comments:
+            raise ValueError('Compact records need streamed comments')
+        # stream_comments parses comment responses as they arrive, and
+        # leaves the nested "comments" tree out of the output;
+        # compact_records then keeps comments as CommentRecords until they
+        # are written
+        self.stream_comments = stream_comments
+        self.compact_records = compact_records
+        self.checkpoint = None
+        if checkpoint_path is not None:
+            self.checkpoint = Checkpoint(path=checkpoint_path, key=search_key).\
+                open(resume=resume)
+            if self.checkpoint.complete:
+                logging.info('s3://%s/%s is already complete per %s' %
+                             (self.bucket_name, search_key, checkpoint_path))
+                self.checkpoint.close()
+                return
+        # cache_path keeps fetched comment trees across runs (see
+        # ThreadCache), so threads that haven't changed aren't refetched
+        if cache_path is not None:
+            self.thread_cache = ThreadCache(path=cache_path,
+                                            ttl_seconds=cache_ttl_seconds,
+                                            max_bytes=cache_max_bytes)
+        if delta_index_path is not None:
+            self.delta_index = DeltaIndex(path=delta_index_path)
+        self.dedupe = DedupeIndex(bloom_path=dedupe_bloom_path,
+                                  scope=search_key)
+        try:
+            # metrics_port serves Prometheus text while the run is going
+            # (stopped in the finally, so the port is free for the next
+            # run); metrics_path gets a JSON summary once it is done
+            if metrics_port is not None:
+                self.metrics.serve(port=metrics_port)
+            with self.reserved_creds(count=token_count,
+                                     reservation_hours=reservation_hours,
+                                     reservation_minutes=reservation_minutes):
+                # request_sleep is now only an optional per-token minimum
+                # spacing; the scheduler already waits whenever the rate
+                # limit requires it
+                self.request_sleep = request_sleep
+                self.scheduler.min_interval = request_sleep or 0
+                if workers is None:
+                    # one worker per token keeps every token busy without
+                    # making workers queue up behind each other's pacing
+                    workers = token_count
+                if delta:
+                    self.do_delta_nibble(
+                        s3_client=s3, start_time=start_time,
+                        end_time=end_time, limit=limit, workers=workers)
+                    return
+                # self.do_search_experiment(start_time=start_time,
+                #                           part_size_seconds=2, limit=limit)
+                # density_path keeps the links/second seen by the last run,
+                # which seeds the size of the first search windows of the
+                # next one
+                self.do_search_nibble(
+                    s3_client=s3, s3_key=search_key,
+                    start_time=start_time, end_time=end_time,
+                    part_size_seconds=10, limit=limit, workers=workers,
+                    initial_density=load_density(density_path),
+                    output_format=output_format, codec=codec,
+                    shards=shards, shard_max_bytes=shard_max_bytes,
+                    shard_max_records=shard_max_records,
+                    discovery=discovery)
+                save_density(density_path, self.search_density)
+                # only once the output is complete, so a failed run's links
+                # aren't skipped by the next one
+                self.dedupe.save()
+        finally:
+            # runs on RequestError too, so a failed hour still gives back its
+            # credentials and leaves a resumable checkpoint behind
+            if self.checkpoint is not None:
+                self.checkpoint.close()
+            if self.thread_cache is not None:
+                self.thread_cache.close()
+                self.thread_cache = None
+            if self.delta_index is not None:
+                self.delta_index.close()
+                self.delta_index = None
+            self.sessions.close()
+            et = datetime.now(timezone.utc)
+            logging.info('%d calls in %s.' % (self.request_count,
+                                              str(et - st)))
+            logging.info('Duplicates: %r' % self.dedupe.stats())
+            if len(self.metrics.skipped) > 0:
+                logging.warning('Skipped after request errors: %r' %
+                                dict(self.metrics.skipped))
+            self.write_metrics(metrics_path)
+            self.metrics.stop()
+
+    def write_metrics(self, path: str=None) -> dict:
+        summary = self.metrics.summary()
+        logging.info('Metrics: %s' % ujson.dumps(summary))
+        if path is not None:
+            with open(path, 'w') as f:
+                ujson.dump(summary, f, indent=2)
+        return summary
 
     @staticmethod
     def base_headers():
@@ -106,208 +364,186 @@ class Ringest(object):
             'User-Agent': 'Linux:ai.cortico.rProbe:v0.1 (by /u/cortico-ai)'
         }
 
-    def release_creds(self, unames=None, conn=None):
-        if unames is None:
-            unames = self.unames
-
-        if len(unames) > 0:
-            logging.info('Releasing auth creds...')
-
-            ustr = '(' + ','.join(["'" + u + "'" for u in unames]) + ')'
-            now = datetime.now(tz=timezone.utc)
-            q1 = """   UPDATE auth_library
-                          SET available = CURRENT_TIMESTAMP
-                        WHERE platform = 'reddit' AND uname in %s
-                    RETURNING uname""" % ustr
-            if conn is None:
-                with closing(self.component_credentials.get_db_connection()) as conn, \
-                        conn.cursor() as curs:
-                    curs.execute(q1)
-                    conn.commit()
-            else:
-                with conn.cursor() as curs:
-                    curs.execute(q1)
-                    conn.commit()
-
-            logging.info('Done.')
+    def credential_leaser(self) -> CredentialLeaser:
+        # made on first use unless one was passed in, e.g. by a Coordinator
+        # worker sharing its connection pool between jobs
+        if self.leaser is None:
+            self.leaser = CredentialLeaser(ConnectionPool(
+                self.component_credentials.get_db_connection))
+            self.owns_leaser = True
+        return self.leaser
 
     def lock_creds(self, count: int=2, reservation_hours: int=0,
-                   reservation_minutes: int=10, conn=None):
-        q = """   UPDATE auth_library
-                     SET available = '%s'
-                   WHERE platform = 'reddit' AND available < '%s'
-               RETURNING uname"""
-
-        def lock_loop(_conn):
-            _unames = []
-
-            max_attempts = 2
-            attempts = 0
-            with conn.cursor() as curs:
-                while len(_unames) < count and attempts < max_attempts:
-                    attempts += 1
-                    sleep(1)
-                    logging.info('Reserving auth creds...')
-                    # if we have any, it's not enough, so release the ones we got
-                    self.release_creds(unames=_unames, conn=_conn)
-                    now = datetime.now(tz=timezone.utc)
-                    available = now + timedelta(hours=reservation_hours,
-                                                minutes=reservation_minutes)
-                    curs.execute(q % (available.isoformat(sep=' '),
-                                      now.isoformat(sep=' ')))
-                    _conn.commit()
-                    _unames = [r[0] for r in curs.fetchall()]
-                    logging.info('Done.')
-                    if len(_unames) > count:
-                        self.release_creds(unames=_unames[count:], conn=_conn)
-                        _unames = _unames[:count]
-
-                        curs.execute('select * from auth_library')
-
-            if len(_unames) < count:
-                raise ConnectionError("Unable to reserve credentials.")
-
-            return _unames
-
-        unames = []
-        if conn is None:
-            with closing(self.component_credentials.get_db_connection()) as conn:
-                unames = lock_loop(_conn=conn)
-        else:
-            unames = lock_loop(_conn=conn)
+                   reservation_minutes: int=10) -> list:
+        # Reserves count credentials for reservation_hours and
+        # reservation_minutes, renewed for as long as they are held, and
+        # returns their unames.  Raises ConnectionError if count can't be
+        # reserved.
+        lease_seconds = timedelta(hours=reservation_hours,
+                                  minutes=reservation_minutes).total_seconds()
+        self.credential_lease = self.credential_leaser().lease(
+            count=count, lease_seconds=lease_seconds)
+        return self.credential_lease.unames
+
+    def release_creds(self):
+        if self.credential_lease is not None:
+            self.credential_lease.release()
+            self.credential_lease = None
+        self.unames = []
 
-        return unames
+    @contextmanager
+    def reserved_creds(self, count: int=2, reservation_hours: int=0,
+                       reservation_minutes: int=10):
+        self.unames = self.lock_creds(count=count,
+                                      reservation_hours=reservation_hours,
+                                      reservation_minutes=reservation_minutes)
+        try:
+            yield self.unames
+        finally:
+            self.release_creds()
+            if self.owns_leaser:
+                self.leaser.pool.close()
+                self.leaser = None
+                self.owns_leaser = False
+
+    def token_manager(self) -> TokenManager:
+        # made on first use, with the sessions and credentials of the run
+        if self.tokens_manager is None:
+            self.tokens_manager = TokenManager(
+                sessions=self.sessions, auth_url=self.auth_url,
+                password_map=self.password_map, metrics=self.metrics,
+                cache_path=self.token_cache_path,
+                cache_key=self.token_cache_key,
+                retry_policy=self.retry_policy)
+        return self.tokens_manager
 
     def fetch_tokens(self):
-        password_map = {
-            'Faahes23QZg7Fw': 'SeQC4OK7gpSb4i4k837GMo_ains',
-            'laAeq4H1xGpxIQ': 'Vn9bPKzZxcJnEYnKg6AEe52cy7A',
-            'EzDWhK39JN7hOg': 'UgQV1Z-PNSWEspqvu6wSuXVBmUs',
-            'sOSbsk4n7hP5ew': '7WZOJLhEeVW2tuu81DLuTbDLvKk',
-            'AiVR0xcW7FZHDQ': 'q8dY0rknQGe4WoUi7hCwRvL8mRM',
-            '1SF9q6doBTM7Xw': 'zOaYHcQF5Y4Y3pM4XY0LjSyDae4',
-            'Pp1SYjBTFJPxXg': 'pphvk1Ld3U71jJbbgFZNfoWVlu0',
-            'SinbCmDX2Y3dTg': 'EA5H78qxHwjlhdxBjLq0bBFyax8',
-            'i6zXuvsjCYcW2w': '6iygaqQzUbln1Cc2mq1y1X-B0mQ',
-            'BKpMuC6ZaYYBSQ': 'xLn99WdorXD8OSoWZDU8zbau_1o',
-            'fpAqd_Cvu6lGww': 'kQ-f0AETHs7WpMMDb4Vasz09T48',
-            'UmYc7VkTTN-GOA': 'ZE4y2FpwtcrY1wHBE98NH8MLiUQ',
-            'hYgy3w8D0ExVYA': 'R3-CyxTt1IE_NR9r7tD0ka2pmic',
-            'H-dfuCXGJPDibQ': 'ansVAsyLZeUHa42ztZkPavxS89E',
-            'CSudDHcTD31xMg': 'C2V0pnm9K5WB3JUaZS6ypBR8prc',
-            'GVSHiTvtT2NtYg': 'DRRhNTTNdLuXeUQCE63CUn3eaIQ',
-
-            'jsgT2jZhMoTdpw': 'lZ7N_XICirw-woP5embX4EVXW5g',
-            'PrExSJoSJF8Odg': 'YeR4QyU9ze7fgnn6IiSQXBcl84I',
-            'c1GfGn-W5mwhMA': 'XKulAY-_l_y8MiaKGGUhak2f01c',
-            'kN5xZ8e84C_ZLg': 'fmcC30ebMlCRiNwmO4pZij5oAZE',
-            'pRyF07D9qgwkrA': 'FukIx78hSUEwBXcSxbvQpS90-w4',
-            'NmQTUgPrEDwVfQ': 'XdO4LiyMIAmhpbnfFYjEOG5YVtQ',
-            '4Tl1srQyzWQq9Q': 'LO7Jp13-cZMLl91XD9b21wm4Ry0',
-            'DikErd-RK9a6dg': '8inRSMyU53Uoo_p_-9uN3rvE71E',
-            'uLVSduDxuUnVlQ': 'LdgBzU-SgXbR3iEe2U2RMdlejAw',
-            '8lQHB4s4J3eo4g': 'zReYzMB2wDxli2mlHU9_zxVcvzY',
-            '7j0Kf7Stx2wz8g': 'OUAVUU0jm6NOz64fgX3r07n2x9Y',
-            'tOg3MYyAiVZ9SQ': 'D57oOXJwweGU2uwRPHSqy1B2sAA',
-            'qmih4x-Ds_asag': '9xvb5imgI30I50BGOxYJccxZWxI',
-            '6vxCFKJnuNYlkA': 'uOLoHpZFC84YlH52SvUgEryRWOg',
-            'fhNxav9h2jBEqg': 'iTNVB0QUWIGRUOSBYzHWv1VBNCs',
-            'OMlZ4Dm_MO2kdg': '9wucDKW7X4S7ef1urxxR7OWc6cg',
-
-            '-2BIjqi2Y1R1uw': 'CABnoXVq9zBu4yEvwM1TZbR6PUU',
-            'BYHPd1zPGMIqow': '5C2UirejH9hp10d5awYfiBwmccI',
-            'ZTDeQZolrFOGkQ': 'gQmnaW__xk7Wd9kis6CJQTi8pu0',
-            'FwxYSFBwmksGqw': 'fNmiYjMHEVqxjz_U3yD66xoKrYM',
-            '4hpmrTmGS3Fpog': 'yshVS1jhy8z3VYKa4iHxbh_rsGY',
-            'OigG49ol-B8iyg': 'ox1XCCTSblqaUDjl7Kd2OnhRu3g',
-            'ZDKBeFrJTHYjaw': 'MFpzpMQuK7SYciF6eqVPjHP_EIY',
-            'YEKCtuleUbofxw': 'OPCUEMDou-8266OFjfTicYW61CE',
-            'fI9TvhYG1aLyWg': '6pzzPxQ7SltfGnp4zuKGxbncvKI',
-            '6nM3QgAyT0pFew': 't2TUX7cmkVLTaxwhEAB54bPpFno',
-            'd6IVDISzsp0OGA': 'i336d-A3zr6UFHDnjSS0Q6Bcg1A',
-            'dOCeG8cp27s3CQ': 'Gbqa5b_jW3yoFalwINbm743ZmR0',
-            'JYhur3ostoTExw': '6WR8mBolNoYl3J4v55Y0NggnPdU',
-            'FJEh0N3Ue-2uMA': 'KGTNfJDoAyeFnGspfk2dimxkk4w',
-            'o9Y0u9aX9eDylw': 'o1bfyaUMdoxXHBTC3J6ba7BvAGQ',
-            'WndOVZdQQtr4WQ': 'HcLHk9cCQtCfFQwoRnRkop_WyzY'
-        }
-
-        if len(self.tokens) < 1:
-            unames = self.unames
-            logging.info('Requesting tokens...')
-            client_auths = [HTTPBasicAuth(username=u, password=password_map[u])
-                            for u in unames]
-            # client_auths = [HTTPBasicAuth(username=u, password=p)
-            #                 for u, p in password_map.items()]
-            post_data = {
-                'grant_type': 'client_credentials'
-            }
-            headers = Ringest.base_headers()
-            responses = [
-                requests.post(url='https://www.reddit.com/api/v1/access_token',
-                              auth=client_auth,
-                              headers=headers,
-                              data=post_data) for client_auth in client_auths]
-
-            for response in responses:
-                if response.status_code != 200:
-                    logging.warning('Token request failed: %r' % response)
-
-            self.tokens =\
-                [response.json()['access_token'] for response in responses]
-            logging.info('Done.')
+        # cheap unless a token is missing; tokens close to expiring are
+        # refreshed in the background
+        with self.lock:
+            tokens = self.token_manager().tokens(self.unames)
+            if tokens != self.tokens:
+                self.tokens = tokens
+                self.scheduler.set_tokens(self.tokens)
 
         return self.tokens
 
-    def request(self, url: str, retries_left: int=5):
+    def request(self, url: str, retries_left: int=5, stream: bool=False):
+        # GETs url with the next available token, making up to retries_left
+        # attempts as allowed by self.retry_policy.  With stream=True the
+        # body of a 200 is left unread for the caller (who must close the
+        # response).  Raises UriTooLongError
+        # on a 414, RetriesExhaustedError once attempts or the endpoint's
+        # retry budget run out, CircuitOpenError if the endpoint's circuit
+        # breaker stays open for longer than the policy's breaker_max_wait,
+        # and RequestError for non-retryable statuses.
+        #
+        # A 429 benches the token that got it in the scheduler, so the retry
+        # goes out on another token if one has budget instead of sleeping.
         logging.info('Requesting url %s' % url)
-        if retries_left == 0:
-            logging.error("Retries exhausted, exiting.")
-            self.release_creds()
-            sys.exit(1)
-
-        if self.rate_limit_remaining == 0:
-            logging.warning('Rate limit exceeded, rate limit stats:\n' +
-                            (('Ratelimit-Used: %d\n' +
-                              'Ratelimit-Remaining: %d\n' +
-                              'Ratelimit-Reset: %d\n') %
-                             (self.rate_limit_used,
-                              self.rate_limit_remaining,
-                              self.rate_limit_reset)))
-            sleep(self.rate_limit_reset)
-
-        tokens = self.fetch_tokens()
-
-        headers = Ringest.base_headers()
-        headers['Authorization'] = \
-            'Bearer ' + tokens[self.request_count % len(tokens)]
-
-        # if self.request_count % self.sleep_every == 0:
-        if self.request_sleep is not None and self.request_sleep > 0:
-            sleep(self.request_sleep)
-        self.request_count += 1
-        response = requests.get(url, headers=headers)
-
-        self.rate_limit_used = response.headers.get('X-Ratelimit-Used', 0)
-        self.rate_limit_remaining =\
-            response.headers.get('X-Ratelimit-Remaining',
-                                 self.default_rate_limit_remaining)
-        self.rate_limit_reset =\
-            response.headers.get('X-Ratelimit-Reset',
-                                 self.default_rate_limit_reset)
-
-        if response.status_code == 414:
-            logging.warning('GOT 414, FIX LONG URIs')
-            self.release_creds()
-            sys.exit(1)
-        elif response.status_code != 200 and retries_left > 0:
-            logging.warning(('Got status code %d, will sleep and retry, ' +
-                             'response: %r') %
-                            (response.status_code, response))
-            sleep(10)
-            response = self.request(url, retries_left - 1)
-
-        return response
+        endpoint = endpoint_for(url)
+        policy = self.retry_policy
+        attempt = 0
+        breaker_wait = 0.0
+        while True:
+            try:
+                policy.before_request(endpoint, url=url)
+            except CircuitOpenError:
+                # opened by other requests' failures, or another request is
+                # its trial: wait for it like for a retry rather than give up
+                wait = policy.open_seconds(endpoint)
+                if breaker_wait + wait > policy.breaker_max_wait:
+                    raise
+                breaker_wait += wait
+                self.metrics.add_sleep('breaker', wait)
+                sleep(wait)
+                continue
+            try:
+                self.fetch_tokens()
+                # blocks only when every token has spent its rate limit
+                # budget
+                token = self.scheduler.acquire()
+            except BaseException:
+                policy.release(endpoint)
+                raise
+            with self.lock:
+                self.request_count += 1
+
+            headers = {'Authorization': 'Bearer ' + token}
+            response = None
+            error = None
+            rst = perf_counter()
+            try:
+                response = self.sessions.get(url, key=token, headers=headers,
+                                             stream=stream)
+            except requests.RequestException as e:
+                error = e
+            except BaseException:
+                policy.release(endpoint)
+                raise
+            finally:
+                self.scheduler.update(token, response.headers
+                                      if response is not None else None)
+                self.metrics.request(
+                    endpoint, perf_counter() - rst,
+                    status=response.status_code
+                    if response is not None else None,
+                    n_bytes=int(response.headers.get('Content-Length') or
+                                (0 if stream else len(response.content)))
+                    if response is not None else 0)
+
+            status = response.status_code if response is not None else None
+            if status == 200:
+                policy.record_success(endpoint)
+                return response
+            if stream and response is not None:
+                # nobody reads the body of a failed streamed request
+                response.close()
+            if status in (401, 414):
+                # the endpoint answered, it's the token or the URI that's
+                # wrong; this also ends a circuit breaker trial
+                policy.record_success(endpoint)
+            if status == 401:
+                # expired or revoked token: drop it, and the next attempt
+                # goes out with a fresh one from fetch_tokens
+                logging.warning('Got 401, replacing token')
+                self.token_manager().invalidate(token)
+                attempt += 1
+                if attempt >= retries_left:
+                    raise RetriesExhaustedError(
+                        'Gave up on %s after %d attempts, last: 401' %
+                        (url, attempt), url=url, status=status)
+                continue
+            elif status == 414:
+                # callers that build long URIs (do_morechildren) split and
+                # retry
+                raise UriTooLongError('Got 414 for url of length %d' %
+                                      len(url), url=url, status=status)
+
+            policy.record_failure(endpoint)
+            if not policy.retryable(status):
+                raise RequestError('Got status code %d for %s' % (status, url),
+                                   url=url, status=status)
+
+            attempt += 1
+            if attempt >= retries_left or not policy.consume_retry(endpoint):
+                raise RetriesExhaustedError(
+                    'Gave up on %s after %d attempts, last: %s' %
+                    (url, attempt, status if error is None else repr(error)),
+                    url=url, status=status)
+
+            delay = policy.delay(attempt - 1, response)
+            self.metrics.retry(endpoint)
+            if status == 429:
+                logging.warning('Got 429, benching token for %.1fs and '
+                                'retrying' % delay)
+                self.scheduler.penalize(token, delay)
+                continue
+
+            logging.warning('Got %s, will sleep %.1fs and retry' %
+                            (status if error is None else repr(error), delay))
+            self.metrics.add_sleep('retry', delay)
+            sleep(delay)
 
     @staticmethod
     def partition_window(start_time: datetime, end_time: datetime,
@@ -333,7 +569,7 @@ class Ringest(object):
             link_ids = []
             for j in range(n_intervals):
                 offset = j * part_size_seconds
-                url = 'https://oauth.reddit.com/search.json?type=link&' + \
+                url = self.api_url + '/search.json?type=link&' + \
                       'sort=new&t=all&syntax=cloudsearch&' + \
                       'q=%28and+timestamp%3A' + \
                       ('%d..%d%%29&' % (start_uts + offset,
@@ -355,9 +591,200 @@ class Ringest(object):
             print('interval %d distinct results = %d' %
                   (j, len(set([str(link_ids_map[i][j]) for i in range(n_trials)]))))
 
+    def search_links(self, start_time: datetime, end_time: datetime,
+                     part_size_seconds: int=5, limit: int=100,
+                     initial_density: float=None):
+        # Generates every link_thing the search endpoint returns for the
+        # time range, one sub-window (and page) at a time.
+        #
+        # since paging is broken, try to nibble in bites small enough not
+        # to get paged
+        # also calling anything is broken.  No matter what time window you
+        # specify, you're going to get back at most the last 2.5 minutes or
+        # so of links
+        #
+        # The sub-windows come from an AdaptivePartitioner starting at
+        # part_size_seconds (or at a size derived from initial_density): they
+        # widen while results are sparse and get bisected when a search
+        # overflows, so paging is only used for one-second windows that
+        # still overflow.
+        #
+        # When checkpointing, windows whose links were all uploaded already
+        # are skipped, as are individual links that were.
+        utc_offset = 28800
+        checkpoint = self.checkpoint
+        partitioner = AdaptivePartitioner(
+            start_uts=int(start_time.timestamp()) + utc_offset,
+            end_uts=int(end_time.timestamp()) + utc_offset,
+            limit=limit, initial_size=part_size_seconds,
+            initial_density=initial_density,
+            done=checkpoint.done_windows() if checkpoint is not None else None)
+        for window in partitioner:
+            start_uts, end_uts = window
+            url_base = self.api_url + '/search.json?type=link&' + \
+                       'sort=new&t=all&syntax=cloudsearch&' + \
+                       'q=%28and+timestamp%3A' + \
+                       ('%d..%d%%29&' % (start_uts, end_uts)) + \
+                       ('limit=%d' % limit)
+
+            started = False
+            after = None
+            url = url_base
+            link_ids = []
+            while (not started) or after is not None:
+                if after is not None:
+                    url = url_base + ('&after=%s' % after)
+                    logging.warning('Paging results...')
+
+                response = self.request(url=url, retries_left=20)
+
+                response_j = response.json()
+                after = response_j.get('data', dict()).get('after', None)
+
+                if not started and after is not None and \
+                        partitioner.overflow(window):
+                    logging.info('Search window %d..%d overflowed, bisecting' %
+                                 (start_uts, end_uts))
+                    break
+                started = True
+
+                for link_thing in response_j['data']['children']:
+                    link_id = link_thing['data']['id']
+                    link_ids.append(link_id)
+                    if checkpoint is not None and checkpoint.link_done(link_id):
+                        continue
+                    # pages and overlapping windows can repeat links
+                    if not self.dedupe.new_link(
+                            link_thing['data'].get('name') or 't3_' + link_id):
+                        continue
+                    yield link_thing
+            else:
+                partitioner.record(window, len(link_ids))
+                if checkpoint is not None:
+                    checkpoint.window_searched(window, link_ids)
+
+        self.search_density = partitioner.density()
+        logging.info('%d search windows (%d bisected), %.3f links/second' %
+                     (partitioner.windows, partitioner.splits,
+                      self.search_density or 0))
+
+    def probe_link_created(self, n: int, batch_size: int=100) -> float:
+        # created_utc of the oldest link among ids n..n+batch_size-1, or None
+        # if none of them exist
+        created = [thing['data']['created_utc']
+                   for thing in self.do_info(fullnames(n, batch_size))
+                   if thing.get('kind') == 't3']
+        return min(created) if len(created) > 0 else None
+
+    def find_link_id(self, uts: float, batch_size: int=100) -> int:
+        # An id at or before the first link created at or after uts, by
+        # exponential then binary search (see IdRange): about
+        # 2 * log2(id / batch_size) /api/info calls, plus one for each empty
+        # batch stepped over.
+        id_range = IdRange(uts=uts, batch_size=batch_size)
+        n = id_range.next()
+        while n is not None:
+            id_range.record(n, self.probe_link_created(n, batch_size))
+            n = id_range.next()
+        logging.info('Links from %d start around id %s (%d probes)' %
+                     (uts, base36(id_range.lo), id_range.probes))
+        return id_range.lo
+
+    def id_links(self, start_time: datetime, end_time: datetime,
+                 batch_size: int=100, max_empty_batches: int=50):
+        # Generates every link created in the time range by walking link
+        # ids instead of searching: from find_link_id on, /api/info for
+        # batch_size consecutive fullnames at a time, until a batch holds
+        # only newer links or max_empty_batches in a row hold none (the
+        # newest link was passed).  Ids that don't exist simply aren't
+        # returned, and deleted links are skipped.
+        #
+        # Unlike search this is complete and deterministic, and takes about
+        # (ids in range / batch_size) calls however the links are spread.
+        # If the walk never gets to a link created at or after start_time
+        # there's nothing to trust about the hour, and IdRangeError is
+        # raised instead of writing it out empty.
+        start_uts = start_time.timestamp()
+        end_uts = end_time.timestamp()
+        checkpoint = self.checkpoint
+        n = self.find_link_id(start_uts, batch_size=batch_size)
+        batches = 0
+        empty = 0
+        reached = False
+        while empty < max_empty_batches:
+            link_things = [thing for thing in
+                           self.do_info(fullnames(n, batch_size))
+                           if thing.get('kind') == 't3']
+            n += batch_size
+            batches += 1
+            if len(link_things) < 1:
+                empty += 1
+                continue
+            empty = 0
+            for link_thing in link_things:
+                data = link_thing['data']
+                reached = reached or data['created_utc'] >= start_uts
+                if not start_uts <= data['created_utc'] < end_uts or \
+                        is_deleted(data):
+                    continue
+                if checkpoint is not None and checkpoint.link_done(data['id']):
+                    continue
+                if not self.dedupe.new_link(
+                        data.get('name') or 't3_' + data['id']):
+                    continue
+                yield link_thing
+            if min(link_thing['data']['created_utc']
+                   for link_thing in link_things) >= end_uts:
+                break
+        logging.info('%d /api/info batches, up to id %s' %
+                     (batches, base36(n)))
+        if not reached:
+            raise IdRangeError('Walked %d batches of ids up to %s without '
+                               'reaching links created at %s' %
+                               (batches, base36(n), start_time))
+
+    @contextmanager
+    def skipping_failures(self, stage: str, link_thing: dict):
+        # A link whose requests fail is logged, counted and put aside for
+        # retry_skipped, so one bad thread doesn't abort the whole run.
+        # CircuitOpenError (the endpoint stayed down for everyone) and
+        # anything that isn't a RequestError still do.
+        try:
+            yield
+        except CircuitOpenError:
+            raise
+        except RequestError as e:
+            logging.warning('Skipping link %s: %r' %
+                            (link_thing['data'].get('id'), e))
+            self.metrics.skip(stage, type(e).__name__)
+            self.skipped_links.append(link_thing)
+
+    def retry_skipped(self, run):
+        # Links skipped after request errors get one more go through
+        # run(links) once the rest of the run is done, by when whatever
+        # failed them may have passed.  If any fail again SkippedLinksError
+        # is raised, so the hour isn't taken for complete: its output is
+        # aborted, or left open for a resumed run to fill in.
+        links = self.skipped_links
+        if len(links) < 1:
+            return
+        self.skipped_links = []
+        logging.info('Retrying %d skipped links' % len(links))
+        run(links)
+        if len(self.skipped_links) > 0:
+            raise SkippedLinksError('%d links failed twice' %
+                                    len(self.skipped_links))
+
     def do_search_nibble(self, s3_client, s3_key: str,
                          start_time: datetime, end_time: datetime,
-                         part_size_seconds: int=5, limit: int=100):
+                         part_size_seconds: int=5, limit: int=100,
+                         workers: int=1, queue_size: int=None,
+                         upload_part_size: int=8 * 1024 * 1024,
+                         initial_density: float=None,
+                         output_format: str='json', codec: str='gzip',
+                         shards: int=None, shard_max_bytes: int=None,
+                         shard_max_records: int=None,
+                         discovery: str='search'):
         # Critical reddit timestamp minutiae:
         # 1) The search endpoint date range field is called "timestamp".
         # 2) Reddit "things" (the root of the object model they return) have
@@ -365,63 +792,295 @@ class Ringest(object):
         # 3) "created" is in "local-epoch" time, by which they mean UTC+8.
         # 4) The search endpoint's "timestamp" field maps to thing's "created"
         #    field.
-        (_, path) = tempfile.mkstemp()
-        with gzip.open(path, 'wt', encoding='utf8') as f:
-            # since paging is broken, try to nibble in bites small enough not
-            # to get paged
-            # also calling anything is broken.  No matter what time window you
-            # specify, you're going to get back at most the last 2.5 minutes or
-            # so of links
-            for start_uts, end_uts in Ringest.\
-                    partition_window(start_time=start_time, end_time=end_time,
-                                     part_size_seconds=part_size_seconds,
-                                     utc_offset=28800):
-                url_base = 'https://oauth.reddit.com/search.json?type=link&' + \
-                           'sort=new&t=all&syntax=cloudsearch&' + \
-                           'q=%28and+timestamp%3A' + \
-                           ('%d..%d%%29&' % (start_uts, end_uts)) + \
-                           ('limit=%d' % limit)
-
-                started = False
-                after = None
-                url = url_base
-                while (not started) or after is not None:
-                    started = True
-
-                    if after is not None:
-                        url = url_base + ('&after=%s' % after)
-                        logging.warning('Paging results...')
-
-                    response = None
-                    try:
-                        response = self.request(url=url, retries_left=20)
-                    except Exception as e:
-                        logging.warning('Problem fetching url: %s' % url)
-                        logging.warning(str(e))
-                        self.release_creds()
-                        sys.exit(1)
-
-                    response_j = response.json()
-                    after = response_j.get('data', dict()).get('after', None)
-
-                    for link_thing in response_j['data']['children']:
-                        link_doc = flatten_comments({
-                            'link': link_thing,
-                            'comments':
-                                self.do_comments(link_id=link_thing['data']['id'],
-                                                 limit=limit)
-                        })
-                        f.write('%s\n' % ujson.dumps(link_doc))
+        #
+        # The work runs as a pipeline with bounded queues between stages:
+        #
+        #   search_links -> fetch (workers threads) -> flatten -> write
+        #
+        # (or id_links instead of search_links with discovery='ids')
+        #
+        # so searching, comment fetching, flattening and encoding/compressing
+        # all overlap, and at most queue_size items wait between any two
+        # stages.  Comments and morechildren for a link stay on one fetch
+        # worker, and each link is written exactly once (in completion
+        # order).
+        #
+        # Output is gzipped as it is written and streamed to S3 in
+        # upload_part_size multipart chunks, so nothing touches local disk
+        # and the upload overlaps with fetching.  If anything fails the
+        # upload is aborted, unless checkpointing, in which case it is left
+        # open to be continued by a resumed run, and UploadError is raised so
+        # the hour isn't taken for done.
+        #
+        # codec='zstd' compresses with zstd instead of gzip.
+        #
+        # With shards links are spread over that many objects under the key
+        # (without its extension), each compressed and uploaded by its own
+        # thread and rolled over at shard_max_bytes or shard_max_records,
+        # plus a manifest in reddit/manifests (see ShardedSink).  Sharded
+        # output can't be resumed.
+        #
+        # With output_format='parquet' links and their flattened comments go
+        # to two Parquet tables instead (see ParquetOutput), which can't be
+        # resumed either.
+        if queue_size is None:
+            queue_size = 2 * max(workers, 1)
+
+        def fetch(link_thing):
+            with self.skipping_failures('fetch', link_thing):
+                comments = self.cached_comments(link_thing=link_thing,
+                                                limit=limit)
+                if self.stream_comments:
+                    # already flattened while parsing, and without the
+                    # nested "comments" tree
+                    yield {'link': link_thing, 'flattened_comments': comments}
+                else:
+                    yield {'link': link_thing, 'comments': comments}
+
+        def flatten(link_doc):
+            if 'flattened_comments' not in link_doc:
+                with self.metrics.timer('flatten'):
+                    link_doc = flatten_comments(link_doc, copy=False)
+            yield link_doc
+
+        def recorded(write):
+            # links go into the delta and dedupe indexes once they have been
+            # written
+            def write_and_record(link_doc):
+                write(link_doc)
+                data = link_doc['link']['data']
+                self.dedupe.written(data.get('name') or 't3_' + data['id'])
+                if self.delta_index is not None:
+                    self.delta_index.record(link_doc)
+            return write_and_record
+
+        def run_pipeline(write):
+            if discovery == 'ids':
+                source = self.id_links(start_time=start_time,
+                                       end_time=end_time)
+            else:
+                source = self.search_links(
+                    start_time=start_time, end_time=end_time,
+                    part_size_seconds=part_size_seconds, limit=limit,
+                    initial_density=initial_density)
+
+            def run_links(links):
+                Pipeline(source=links, queue_size=queue_size).\
+                    add_stage('fetch', fetch, workers=workers).\
+                    add_stage('flatten', flatten).\
+                    add_stage('write', recorded(write)).\
+                    run()
+
+            self.skipped_links = []
+            run_links(source)
+            self.retry_skipped(run_links)
+
+        if output_format == 'parquet':
+            try:
+                with ParquetOutput(s3_client=s3_client,
+                                   bucket=self.bucket_name,
+                                   start_time=start_time) as output:
+
+                    def write(link_doc):
+                        with self.metrics.timer('encode'):
+                            output.write(link_doc)
+
+                    run_pipeline(write)
+                logging.info('Finished uploading %d links and %d comments to '
+                             's3://%s/%s' % (output.links.rows,
+                                             output.comments.rows,
+                                             self.bucket_name,
+                                             output.links.sink.key))
+            except UploadError as e:
+                logging.warning('Problem uploading Parquet output to '
+                                's3://%s: %r' % (self.bucket_name, e))
+                raise
+            return
+
+        if shards is not None:
+            key_prefix = s3_key.rsplit('/', 1)[0] + '/' + \
+                start_time.strftime('%H%M')
+            manifest_key = 'reddit/manifests/' + \
+                start_time.strftime('%Y-%m-%d/%H%M.json')
+            try:
+                with ShardedSink(s3_client=s3_client, bucket=self.bucket_name,
+                                 key_prefix=key_prefix,
+                                 manifest_key=manifest_key, shards=shards,
+                                 codec=codec, max_shard_bytes=shard_max_bytes,
+                                 max_shard_records=shard_max_records,
+                                 part_size=upload_part_size,
+                                 queue_size=queue_size,
+                                 encode=records.dumps,
+                                 metrics=self.metrics) as sink:
+
+                    def write(link_doc):
+                        sink.write(link_doc,
+                                   key=link_doc['link']['data']['id'])
+
+                    run_pipeline(write)
+            except UploadError as e:
+                logging.warning('Problem uploading shards to s3://%s/%s: %r' %
+                                (self.bucket_name, key_prefix, e))
+                raise
+            return
+
+        checkpoint = self.checkpoint
+        sink_args = dict()
+        if checkpoint is not None:
+            sink_args = dict(upload_id=checkpoint.upload_id,
+                             parts=checkpoint.parts,
+                             on_upload_started=checkpoint.upload_started,
+                             on_part=checkpoint.part_uploaded,
+                             abort_incomplete=False)
 
         try:
-            s3_client.upload_file(Filename=path, Bucket=self.bucket_name,
-                                  Key=s3_key)
+            sink_class = S3ZstdSink if codec == 'zstd' else S3GzipSink
+            with sink_class(s3_client=s3_client, bucket=self.bucket_name,
+                            key=s3_key, part_size=upload_part_size,
+                            **sink_args) as f:
+
+                def write(link_doc):
+                    with self.metrics.timer('encode'):
+                        line = '%s\n' % records.dumps(link_doc)
+                    with self.metrics.timer(codec):
+                        f.write(line, tag=link_doc['link']['data']['id'])
+
+                run_pipeline(write)
+            if checkpoint is not None:
+                checkpoint.finished()
             logging.info("Finished uploading to s3://%(bucket)s/%(key)s" %
                          {'bucket': self.bucket_name, 'key': s3_key})
-        except Exception as e:
+        except UploadError as e:
             logging.warning('Problem uploading to s3://%(bucket)s/%(key)s: %(ex)r' %
                             {'bucket': self.bucket_name, 'key': s3_key, 'ex': e})
-            self.release_creds()
+            raise
+
+    def do_delta_nibble(self, s3_client, start_time: datetime,
+                        end_time: datetime, limit: int=100, workers: int=1,
+                        queue_size: int=None,
+                        upload_part_size: int=8 * 1024 * 1024):
+        # Catches up on the links in the delta index created between
+        # start_time and end_time:
+        #
+        # 1) /api/info, 100 links per call, for their current num_comments;
+        #    links whose count hasn't grown are skipped
+        # 2) /comments sorted by new, so new comments come first and older
+        #    ones end up in "more" nodes
+        # 3) /api/morechildren for only the ids in those "more" nodes that
+        #    aren't in the index yet, i.e. up to the known frontier
+        #
+        # Each link with new or edited comments gets one compact record,
+        #
+        #   {"link": {...}, "fetched_utc": ..., "comments": [...]}
+        #
+        # holding just those comments' data, in
+        # reddit/deltas/YYYY-MM-DD/HHMM.<fetch time>.json.gz.
+        if queue_size is None:
+            queue_size = 2 * max(workers, 1)
+        s3_key = 'reddit/deltas/' + start_time.strftime('%Y-%m-%d/%H%M') + \
+            datetime.now(timezone.utc).strftime('.%Y%m%dT%H%M%S.json.gz')
+        known = self.delta_index.links(start_time.timestamp(),
+                                       end_time.timestamp())
+        counts = Counter()
+
+        def grown_links():
+            names = sorted(known)
+            for i in range(0, len(names), 100):
+                for link_thing in self.do_info(names[i:i + 100]):
+                    data = link_thing.get('data', dict())
+                    if (data.get('num_comments') or 0) > \
+                            (known.get(data.get('name')) or 0):
+                        counts['grown'] += 1
+                        yield link_thing
+                    else:
+                        counts['unchanged'] += 1
+
+        def fetch(link_thing):
+            with self.skipping_failures('fetch', link_thing):
+                yield self.do_comments_delta(link_thing=link_thing,
+                                             limit=limit)
+
+        try:
+            with S3GzipSink(s3_client=s3_client, bucket=self.bucket_name,
+                            key=s3_key, part_size=upload_part_size) as f:
+
+                def write(delta):
+                    record, comments = delta
+                    counts['comments'] += len(record['comments'])
+                    if len(record['comments']) > 0:
+                        counts['records'] += 1
+                        with self.metrics.timer('encode'):
+                            line = '%s\n' % ujson.dumps(record)
+                        with self.metrics.timer('gzip'):
+                            f.write(line)
+                    link = record['link']
+                    self.delta_index.put(link['name'],
+                                         created_utc=link['created_utc'],
+                                         num_comments=link['num_comments'],
+                                         comments=comments)
+
+                def run_links(links):
+                    Pipeline(source=links, queue_size=queue_size).\
+                        add_stage('fetch', fetch, workers=workers).\
+                        add_stage('write', write).\
+                        run()
+
+                self.skipped_links = []
+                run_links(grown_links())
+                self.retry_skipped(run_links)
+            logging.info('Delta of %d known links: %d unchanged, %d grown, '
+                         '%d new or edited comments in %d records at '
+                         's3://%s/%s' %
+                         (len(known), counts['unchanged'], counts['grown'],
+                          counts['comments'], counts['records'],
+                          self.bucket_name, s3_key))
+        except UploadError as e:
+            logging.warning('Problem uploading to s3://%(bucket)s/%(key)s: %(ex)r' %
+                            {'bucket': self.bucket_name, 'key': s3_key, 'ex': e})
+            raise
+
+    def do_info(self, fullnames: list) -> list:
+        # things for up to 100 fullnames (t3_..., t1_...) in one call
+        url = self.api_url + '/api/info?id=' + ','.join(fullnames)
+        response = self.request(url=url, retries_left=5)
+        return response.json().get('data', dict()).get('children', [])
+
+    def do_comments_delta(self, link_thing: dict, limit: int=100) -> tuple:
+        # Returns (delta record, {comment id: comment_state} of every comment
+        # now known) for link_thing; see do_delta_nibble.
+        data = link_thing['data']
+        name = data.get('name') or 't3_' + data['id']
+        known = self.delta_index.comments(name)
+        url = self.api_url + '/comments/%s.json?limit=%d&sort=new' % \
+            (data['id'], limit)
+        response = self.request(url=url, retries_left=5)
+        link_doc = flatten_comments({'link': link_thing,
+                                     'comments': response.json()}, copy=False)
+
+        more_things = []
+        for thing in link_doc['flattened_comments']:
+            if thing.get('kind') != 'more':
+                continue
+            more_data = thing.get('data', dict())
+            more_data['children'] = [i for i in more_data.get('children', [])
+                                     if i not in known and
+                                     i not in Ringest.bad_ids]
+            if len(more_data['children']) > 0:
+                more_things.append(thing)
+        self.do_morechildren(link_name=name, more_things=more_things,
+                             limit=limit, skip_ids=known)
+
+        changed = [c for c in iter_comments(link_doc) if 'id' in c and
+                   known.get(c['id']) != comment_state(c)]
+        known.update((c['id'], comment_state(c)) for c in changed)
+        record = {
+            'link': {'name': name, 'id': data['id'],
+                     'created_utc': data.get('created_utc'),
+                     'num_comments': data.get('num_comments')},
+            'fetched_utc': datetime.now(timezone.utc).timestamp(),
+            'comments': changed
+        }
+        return record, known
 
     @staticmethod
     def get_children_from_listing(d: dict) -> list:
@@ -432,33 +1091,53 @@ class Ringest(object):
 
         return d.get('data').get('children', [])
 
-    def populate_thing(self, d: dict, link_name: str):
-        kind = d.get('kind')
-
-        if kind == 'Listing':
-            children = d['data'].get('children', [])
-            if len(children) > 0:
-                d['data']['children'] =\
-                    [self.populate_thing(d=c, link_name=link_name)
-                     for c in children]
-        elif kind == 't1':
-            d['replies'] = self.populate_thing(d=d.get('replies', dict()),
-                                               link_name=link_name)
-        elif kind == 'more':
-            d['data']['children'] = self.\
-                do_morechildren(link_name=link_name,
-                                child_ids=d['data'].get('children', []))
-        elif kind == 't3':
-            pass
-        else:
-            pass
-            # logging.warning('Populate thing: Unrecognized type: %r' % d)
-
-        return d
+    @staticmethod
+    def collect_more_things(listings: list) -> list:
+        # Breadth-first list of every "more" node anywhere in the comment
+        # listings, including the ones nested in t1 replies.
+        more_things = []
+        things = deque(listings)
+        while things:
+            d = things.popleft()
+            if not isinstance(d, dict):
+                continue
+
+            kind = d.get('kind')
+            if kind == 'Listing':
+                things.extend(d.get('data', dict()).get('children', []))
+            elif kind == 't1':
+                things.append(d.get('data', dict()).get('replies'))
+            elif kind == 'more':
+                more_things.append(d)
+        return more_things
+
+    def cached_comments(self, link_thing: dict, limit: int=100) -> list:
+        # do_comments (or, with stream_comments, do_streamed_comments) for
+        # link_thing, served from the thread cache when the link's comment
+        # count hasn't changed since it was cached
+        link_data = link_thing['data']
+        fetch = self.do_comments
+        name = link_data.get('name') or 't3_' + link_data['id']
+        if self.stream_comments:
+            fetch = self.do_streamed_comments
+            # flattened entries mustn't be served as trees and vice versa
+            name += '/flattened'
+        if self.thread_cache is None:
+            return fetch(link_id=link_data['id'], limit=limit)
+
+        num_comments = link_data.get('num_comments')
+        comments = self.thread_cache.get(name, num_comments=num_comments)
+        if comments is None:
+            comments = fetch(link_id=link_data['id'], limit=limit)
+            self.thread_cache.put(name, records.plain_comments(comments)
+                                  if self.compact_records else comments,
+                                  num_comments=num_comments)
+        elif self.compact_records:
+            comments = [records.compact(c) for c in comments]
+        return comments
 
     def do_comments(self, link_id: str, limit: int=100) -> list:
-        url = 'https://oauth.reddit.com/comments/%s.json?limit=%d' % \
-              (link_id, limit)
+        url = self.api_url + '/comments/%s.json?limit=%d' % (link_id, limit)
 
         # SO WEIRD...
         #
@@ -527,17 +1206,39 @@ class Ringest(object):
         #      }
         #    }
         # ]
-        response = self.request(url=url, retries_left=2)
+        response = self.request(url=url, retries_left=5)
         response_j = response.json()
         link_name = response_j[0].get('data', dict()).get('children', [])[0].\
             get('data', dict()).get('name', None)
 
         if len(response_j) > 1:
-            return [self.populate_thing(d=listing, link_name=link_name)
-                    for listing in response_j]
+            self.do_morechildren(
+                link_name=link_name,
+                more_things=Ringest.collect_more_things(response_j[1:]),
+                limit=limit)
 
         return response_j
 
+    def do_streamed_comments(self, link_id: str, limit: int=100) -> list:
+        # do_comments, but the response is parsed as it is read and comes
+        # back already flattened (see parse_comments), so a large thread is
+        # never held as a nested tree plus its flattened copy.
+        url = self.api_url + '/comments/%s.json?limit=%d' % (link_id, limit)
+        response = self.request(url=url, retries_left=5, stream=True)
+        with closing(response):
+            # let urllib3 undo any Content-Encoding
+            response.raw.decode_content = True
+            link, flattened = parse_comments(
+                response.raw,
+                record=records.compact if self.compact_records else None)
+        link_name = (link or dict()).get('data', dict()).get('name', None)
+
+        self.do_morechildren(
+            link_name=link_name,
+            more_things=[c for c in flattened if c.get('kind') == 'more'],
+            limit=limit)
+        return flattened
+
     @staticmethod
     def get_child_ids_from_thing(d: dict) -> list:
         if not isinstance(d, dict):
@@ -562,29 +1263,94 @@ class Ringest(object):
         else:
             return []
 
-    def do_morechildren(self, link_name: str, child_ids: list, limit: int=100)\
-            -> list:
-        results = []
-        more_child_ids = child_ids
-        while len(more_child_ids) > 0:
-            url = 'https://oauth.reddit.com/api/morechildren?' + \
-                  ('link_id=%s&children=%s&' %
-                   (link_name, ','.join(more_child_ids[:10]))) + \
-                  'api_type=json&limit=%d&sort=old' % limit
-
-            response = self.request(url=url, retries_left=20)
-            response_j = response.json()
-
-            more_child_ids = more_child_ids[10:]
-            if isinstance(response_j, dict):
-                results.append(response_j)
-
-                for thing in response_j.\
-                        get('json', dict()).\
-                        get('data', dict()).\
-                        get('things', []):
-                    l = self.get_child_ids_from_thing(thing)
-                    if isinstance(l, list) and len(l) > 0:
-                        more_child_ids.extend(l)
+    def morechildren_url(self, link_name: str, child_ids: list,
+                         limit: int=100) -> str:
+        return self.api_url + '/api/morechildren?' + \
+               ('link_id=%s&children=%s&' % (link_name, ','.join(child_ids))) + \
+               'api_type=json&limit=%d&sort=old' % limit
+
+    def do_morechildren(self, link_name: str, more_things: list,
+                        limit: int=100, skip_ids=None):
+        # Expands the "more" nodes of one link in place: each node's
+        # data.children list of ids is replaced by the /api/morechildren
+        # responses holding those comments, as before.
+        #
+        # Ids from all of the link's more nodes (and from more nodes that
+        # come back in responses) go through one deduped queue, and each call
+        # packs as many of them as morechildren_batch_size and max_url_length
+        # allow, so a single call can serve several more nodes.  Returned
+        # things are attributed back to the node that asked for them (or for
+        # their parent).  A 414 halves the batch size for the rest of the
+        # run and the batch is retried.  Ids in skip_ids (e.g. comments a
+        # delta run already has) are never requested, wherever they come from.
+        skip_ids = skip_ids if skip_ids is not None else ()
+        owners = {}
+        seen = set()
+        returned = set()
+        pending = deque()
+        results = {id(m): [] for m in more_things}
+
+        def enqueue(child_ids, owner):
+            for i in child_ids:
+                if i not in Ringest.bad_ids and i not in seen and \
+                        i not in skip_ids:
+                    seen.add(i)
+                    owners[i] = owner
+                    pending.append(i)
+
+        for m in more_things:
+            enqueue(m.get('data', dict()).get('children', []), m)
+
+        while len(pending) > 0:
+            batch = [pending.popleft()]
+            url = self.morechildren_url(link_name, batch, limit)
+            while len(pending) > 0 and \
+                    len(batch) < self.morechildren_batch_size and \
+                    len(url) + len(pending[0]) + 1 <= self.max_url_length:
+                batch.append(pending.popleft())
+                url = self.morechildren_url(link_name, batch, limit)
+
+            try:
+                response = self.request(url=url, retries_left=20)
+            except UriTooLongError:
+                if len(batch) == 1:
+                    raise
+                self.morechildren_batch_size = max(len(batch) // 2, 1)
+                self.max_url_length = min(self.max_url_length, len(url) - 1)
+                logging.warning('Got 414, shrinking morechildren batches to %d'
+                                % self.morechildren_batch_size)
+                pending.extendleft(reversed(batch))
+                continue
 
-        return results
+            response_j = response.json()
+            if not isinstance(response_j, dict):
+                continue
+
+            json_j = response_j.get('json', dict())
+            groups = {}
+            for thing in json_j.get('data', dict()).get('things', []):
+                data = thing.get('data', dict())
+                # a thing can come back in more than one response
+                name = data.get('name') or data.get('id')
+                if name is not None:
+                    self.dedupe.record('comment', name in returned)
+                    if name in returned:
+                        continue
+                    returned.add(name)
+                parent_id = (data.get('parent_id') or '').partition('_')[2]
+                owner = owners.get(data.get('id')) or owners.get(parent_id) or \
+                    owners[batch[0]]
+                if data.get('id') not in Ringest.bad_ids:
+                    owners.setdefault(data.get('id'), owner)
+                groups.setdefault(id(owner), (owner, []))[1].append(
+                    records.compact(thing) if self.compact_records else thing)
+                enqueue(self.get_child_ids_from_thing(thing), owner)
+
+            for owner, things in groups.values():
+                results[id(owner)].append({
+                    'json': dict(json_j, data=dict(json_j.get('data', dict()),
+                                                   things=things))
+                })
+
+        for m in more_things:
+            m['data']['children'] = results[id(m)]
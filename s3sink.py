@@ -0,0 +1,266 @@
+import gzip
+import io
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# S3 rejects multipart parts smaller than 5MiB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+class S3Sink(object):
+    # File-like sink that streams the bytes written to it to s3://bucket/key
+    # as a multipart upload.
+    #
+    # Output is buffered in memory only until part_size bytes are ready, at
+    # which point the part is handed to a background uploader so the upload
+    # overlaps with whatever is producing records.  At most max_pending parts
+    # are in flight, which bounds memory at roughly
+    # (max_pending + 1) * part_size.  Output that never reaches part_size is
+    # sent with a single put_object.
+    #
+    # write() takes an optional tag (e.g. a link id); on_part is called with
+    # each uploaded part and the tags of the records in it, and
+    # on_upload_started with the upload id once one exists.
+    #
+    # Used as a context manager the upload is completed on a clean exit and
+    # aborted if the block raises, so no orphaned parts are left behind.
+    # With abort_incomplete=False the upload is left open instead (after
+    # waiting for parts already in flight) so that it can be resumed.
+
+    def __init__(self, s3_client, bucket: str, key: str,
+                 part_size: int=8 * 1024 * 1024, max_pending: int=2,
+                 upload_id: str=None, parts: list=None,
+                 on_upload_started=None, on_part=None,
+                 abort_incomplete: bool=True):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.max_pending = max(max_pending, 1)
+        self.buffer = io.BytesIO()
+        self.out = self.open_member()
+        self.tags = []
+        self.upload_id = upload_id
+        self.pending = []
+        self.parts = list(parts or [])
+        self.next_part_number = \
+            max([p['PartNumber'] for p in self.parts] or [0]) + 1
+        self.on_upload_started = on_upload_started
+        self.on_part = on_part
+        self.abort_incomplete = abort_incomplete
+        self.bytes_written = 0
+        self.bytes_uploaded = 0
+        self.closed = False
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def open_member(self):
+        # where the bytes of the next part are written; see S3GzipSink
+        return self.buffer
+
+    def close_member(self):
+        pass
+
+    def write(self, data: bytes, tag=None) -> int:
+        self.out.write(data)
+        self.bytes_written += len(data)
+        if tag is not None:
+            self.tags.append(tag)
+        if self.buffer.tell() >= self.part_size:
+            self.flush_part()
+        return len(data)
+
+    def tell(self) -> int:
+        return self.bytes_written
+
+    def flush(self):
+        pass
+
+    def flush_part(self):
+        self.close_member()
+        data = self.buffer.getvalue()
+        tags = self.tags
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.out = self.open_member()
+        self.tags = []
+
+        if self.upload_id is None:
+            try:
+                self.upload_id = self.s3_client.create_multipart_upload(
+                    Bucket=self.bucket, Key=self.key)['UploadId']
+            except Exception as e:
+                raise UploadError('Unable to start upload to s3://%s/%s: %r' %
+                                  (self.bucket, self.key, e))
+            if self.on_upload_started is not None:
+                self.on_upload_started(self.upload_id)
+
+        # wait for the oldest part if too many are already in flight
+        while len(self.pending) >= self.max_pending:
+            self.collect(*self.pending.pop(0))
+
+        part_number = self.next_part_number
+        self.next_part_number += 1
+        self.pending.append((self.executor.submit(self.upload_part,
+                                                  part_number, data), tags))
+
+    def upload_part(self, part_number: int, data: bytes) -> dict:
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key,
+                                              UploadId=self.upload_id,
+                                              PartNumber=part_number,
+                                              Body=data)
+        self.bytes_uploaded += len(data)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def collect(self, future, tags: list):
+        try:
+            part = future.result()
+        except Exception as e:
+            raise UploadError('Problem uploading part to s3://%s/%s: %r' %
+                              (self.bucket, self.key, e))
+        self.parts.append(part)
+        if self.on_part is not None:
+            self.on_part(part, tags)
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            if self.upload_id is None:
+                self.close_member()
+                data = self.buffer.getvalue()
+                try:
+                    self.s3_client.put_object(Bucket=self.bucket, Key=self.key,
+                                              Body=data)
+                except Exception as e:
+                    raise UploadError('Problem uploading to s3://%s/%s: %r' %
+                                      (self.bucket, self.key, e))
+                self.bytes_uploaded += len(data)
+            else:
+                self.flush_part()
+                while len(self.pending) > 0:
+                    self.collect(*self.pending.pop(0))
+                try:
+                    self.s3_client.complete_multipart_upload(
+                        Bucket=self.bucket, Key=self.key,
+                        UploadId=self.upload_id,
+                        MultipartUpload={'Parts': sorted(
+                            self.parts, key=lambda p: p['PartNumber'])})
+                except Exception as e:
+                    raise UploadError('Problem completing upload to '
+                                      's3://%s/%s: %r' %
+                                      (self.bucket, self.key, e))
+        except Exception:
+            self.abort()
+            raise
+
+        self.closed = True
+        self.executor.shutdown()
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        if not self.abort_incomplete:
+            # keep whatever made it to S3 so the upload can be resumed
+            for future, tags in self.pending:
+                try:
+                    self.collect(future, tags)
+                except UploadError as e:
+                    logging.warning(str(e))
+            self.pending = []
+            self.executor.shutdown()
+            if self.upload_id is not None:
+                logging.warning('Left upload %s to s3://%s/%s open with %d '
+                                'parts' % (self.upload_id, self.bucket,
+                                           self.key, len(self.parts)))
+            return
+
+        for future, _ in self.pending:
+            future.cancel()
+        self.executor.shutdown()
+        self.pending = []
+        if self.upload_id is not None:
+            try:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket,
+                                                      Key=self.key,
+                                                      UploadId=self.upload_id)
+                logging.warning('Aborted upload to s3://%s/%s' %
+                                (self.bucket, self.key))
+            except Exception as e:
+                logging.warning('Problem aborting upload to s3://%s/%s: %r' %
+                                (self.bucket, self.key, e))
+
+
+class S3GzipSink(S3Sink):
+    # S3Sink that gzips text as it is written.  Every part is a complete
+    # gzip member (the object is a valid multi-member gzip file), so an
+    # interrupted upload can be continued later by passing its upload_id and
+    # already uploaded parts back in.
+
+    def __init__(self, s3_client, bucket: str, key: str,
+                 compresslevel: int=9, **kwargs):
+        self.compresslevel = compresslevel
+        super().__init__(s3_client, bucket, key, **kwargs)
+
+    def open_member(self) -> gzip.GzipFile:
+        return gzip.GzipFile(fileobj=self.buffer, mode='wb',
+                             compresslevel=self.compresslevel)
+
+    def close_member(self):
+        self.out.close()
+
+    def write(self, s: str, tag=None) -> int:
+        super().write(s.encode('utf8'), tag=tag)
+        return len(s)
+
+
+class ZstdMember(object):
+    # file-like writer of one zstd frame into fileobj
+
+    def __init__(self, fileobj, compressor):
+        self.fileobj = fileobj
+        self.compressobj = compressor.compressobj()
+
+    def write(self, data: bytes):
+        self.fileobj.write(self.compressobj.compress(data))
+
+    def close(self):
+        self.fileobj.write(self.compressobj.flush())
+
+
+class S3ZstdSink(S3GzipSink):
+    # S3GzipSink with zstd instead of gzip: every part is a complete zstd
+    # frame, and the object is their concatenation.  Requires zstandard.
+
+    def __init__(self, s3_client, bucket: str, key: str,
+                 compresslevel: int=3, **kwargs):
+        if zstandard is None:
+            raise ImportError('zstandard is required for zstd output')
+        self.compressor = zstandard.ZstdCompressor(level=compresslevel)
+        super().__init__(s3_client, bucket, key, compresslevel=compresslevel,
+                         **kwargs)
+
+    def open_member(self) -> ZstdMember:
+        return ZstdMember(self.buffer, self.compressor)
@@ -0,0 +1,51 @@
+import requests
+import threading
+
+from requests.adapters import HTTPAdapter
+
+
+class SessionPool(object):
+    # One keep-alive requests.Session per key (normally a bearer token, or
+    # None for the token endpoint), so repeated calls to oauth.reddit.com
+    # reuse pooled connections instead of paying a TLS handshake each time.
+    #
+    # pool_size is the number of connections kept per host and should be at
+    # least the number of workers that can share a session.  timeout is
+    # passed straight to requests: either one number or (connect, read).
+
+    def __init__(self, headers: dict=None, pool_size: int=10,
+                 timeout=(5, 30)):
+        self.headers = dict(headers or {})
+        self.headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        self.headers.setdefault('Connection', 'keep-alive')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, key=None) -> requests.Session:
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                session.headers.update(self.headers)
+                adapter = HTTPAdapter(pool_connections=4,
+                                      pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.sessions[key] = session
+            return session
+
+    def get(self, url: str, key=None, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session(key).get(url, **kwargs)
+
+    def post(self, url: str, key=None, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session(key).post(url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
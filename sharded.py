@@ -0,0 +1,171 @@
+import logging
+import queue
+import threading
+import ujson
+import zlib
+
+from contextlib import nullcontext
+from s3sink import S3GzipSink, S3ZstdSink
+
+CODECS = {'gzip': (S3GzipSink, '.json.gz', 9),
+          'zstd': (S3ZstdSink, '.json.zst', 3)}
+
+
+class ShardedSink(object):
+    # Writes records as JSON lines to `shards` objects at once, each encoded,
+    # compressed and uploaded by its own thread (compression releases the
+    # GIL, so shards compress in parallel).  A record goes to the shard
+    # picked by a stable hash of its key (e.g. the link id).
+    #
+    # A shard rolls over to a new object once it has max_shard_bytes of
+    # compressed output or max_shard_records records, so objects are named
+    #
+    #   <key_prefix>/shard-SS-NNNN.json.gz (or .json.zst)
+    #
+    # and on close a manifest listing every object with its record and byte
+    # counts is put at manifest_key.  Used as a context manager everything
+    # is completed on a clean exit and aborted otherwise.
+
+    def __init__(self, s3_client, bucket: str, key_prefix: str,
+                 manifest_key: str, shards: int=4, codec: str='gzip',
+                 compresslevel: int=None, max_shard_bytes: int=None,
+                 max_shard_records: int=None, part_size: int=8 * 1024 * 1024,
+                 queue_size: int=64, encode=ujson.dumps, metrics=None):
+        if codec not in CODECS:
+            raise ValueError('Unknown codec %r' % codec)
+        self.sink_class, self.suffix, default_level = CODECS[codec]
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key_prefix = key_prefix
+        self.manifest_key = manifest_key
+        self.codec = codec
+        self.compresslevel = compresslevel if compresslevel is not None \
+            else default_level
+        self.max_shard_bytes = max_shard_bytes
+        self.max_shard_records = max_shard_records
+        self.part_size = part_size
+        self.encode = encode
+        self.metrics = metrics
+        self.objects = []
+        self.errors = []
+        self.aborting = False
+        self.lock = threading.Lock()
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(shards)]
+        self.threads = [threading.Thread(target=self.drain, args=(i,),
+                                         name='shard-%d' % i, daemon=True)
+                        for i in range(shards)]
+        for t in self.threads:
+            t.start()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def write(self, record: dict, key: str):
+        if len(self.errors) > 0:
+            raise self.errors[0]
+        shard = zlib.crc32(key.encode('utf8')) % len(self.queues)
+        self.queues[shard].put(record)
+
+    def timer(self, stage: str):
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.timer(stage)
+
+    def drain(self, shard: int):
+        sink = None
+        records = 0
+        sequence = 0
+        while True:
+            record = self.queues[shard].get()
+            if record is None:
+                break
+            if len(self.errors) > 0:
+                # keep consuming so writers never block on a dead shard
+                continue
+            try:
+                if sink is None:
+                    sequence += 1
+                    sink = self.sink_class(
+                        s3_client=self.s3_client, bucket=self.bucket,
+                        key='%s/shard-%02d-%04d%s' % (self.key_prefix, shard,
+                                                      sequence, self.suffix),
+                        compresslevel=self.compresslevel,
+                        part_size=self.part_size)
+                    records = 0
+                with self.timer('encode'):
+                    line = '%s\n' % self.encode(record)
+                with self.timer(self.codec):
+                    sink.write(line)
+                records += 1
+                compressed = sink.bytes_uploaded + sink.buffer.tell()
+                if (self.max_shard_records is not None and
+                        records >= self.max_shard_records) or \
+                        (self.max_shard_bytes is not None and
+                         compressed >= self.max_shard_bytes):
+                    self.finish(sink, shard, records)
+                    sink = None
+            except Exception as e:
+                logging.warning('Shard %d failed: %r' % (shard, e))
+                with self.lock:
+                    self.errors.append(e)
+                if sink is not None:
+                    sink.abort()
+                    sink = None
+
+        if sink is not None:
+            try:
+                if self.aborting or len(self.errors) > 0:
+                    sink.abort()
+                else:
+                    self.finish(sink, shard, records)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(e)
+
+    def finish(self, sink, shard: int, records: int):
+        sink.close()
+        with self.lock:
+            self.objects.append({'key': sink.key, 'shard': shard,
+                                 'records': records,
+                                 'bytes': sink.bytes_uploaded})
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stop()
+        if len(self.errors) > 0:
+            raise self.errors[0]
+        objects = sorted(self.objects, key=lambda o: o['key'])
+        manifest = {'codec': self.codec,
+                    'shards': len(self.queues),
+                    'records': sum(o['records'] for o in objects),
+                    'objects': objects}
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.manifest_key,
+                                  Body=ujson.dumps(manifest, indent=2).
+                                  encode('utf8'))
+        logging.info('Wrote %d records to %d objects, manifest at s3://%s/%s'
+                     % (manifest['records'], len(objects), self.bucket,
+                        self.manifest_key))
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.aborting = True
+        self.stop()
+
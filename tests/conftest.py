@@ -0,0 +1,42 @@
+import os
+import sys
+
+# the modules live flat in the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytest
+
+from bench_ringest import BenchRingest, MemoryS3
+from datetime import datetime, timezone
+from fake_reddit import FakeReddit
+
+FIXTURE = os.path.join(ROOT, 'flatten_comments_in.json')
+START_TIME = datetime(2018, 4, 1, 12, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def fake_reddit():
+    # factory for FakeReddit servers, all stopped after the test
+    servers = []
+
+    def start(**kwargs):
+        kwargs.setdefault('fixture_path', FIXTURE)
+        kwargs.setdefault('mean_comments', 5)
+        fake = FakeReddit(**kwargs).start()
+        servers.append(fake)
+        return fake
+
+    yield start
+    for fake in servers:
+        fake.stop()
+
+
+def bench_ringest(fake) -> BenchRingest:
+    return BenchRingest(None, bucket_name='bench', api_url=fake.url,
+                        auth_url=fake.url)
+
+
+def s3_lines(s3: MemoryS3, key: str) -> list:
+    import gzip
+    return gzip.decompress(s3.objects[('bench', key)]).splitlines()
@@ -0,0 +1,52 @@
+from conftest import START_TIME, bench_ringest, s3_lines
+from bench_ringest import MemoryS3
+from datetime import timedelta
+from dedupe import DedupeIndex
+
+KEY = 'reddit/links/2018-04-01/1200.json.gz'
+
+
+def test_rerun_keeps_links_of_the_same_output(tmp_path):
+    bloom_path = str(tmp_path / 'links.bloom')
+    first = DedupeIndex(bloom_path=bloom_path, scope='a')
+    assert first.new_link('t3_x')
+    first.written('t3_x')
+    first.save()
+
+    # the same output again: not a duplicate
+    assert DedupeIndex(bloom_path=bloom_path, scope='a').new_link('t3_x')
+    # another output: written before, so skipped
+    other = DedupeIndex(bloom_path=bloom_path, scope='b')
+    assert not other.new_link('t3_x')
+    assert other.stats()['link']['duplicates'] == 1
+
+
+def test_concurrent_jobs_keep_each_others_links(tmp_path):
+    # two jobs load the filter, then save it one after the other
+    bloom_path = str(tmp_path / 'links.bloom')
+    jobs = [DedupeIndex(bloom_path=bloom_path, capacity=1000, scope=scope)
+            for scope in ('a', 'b')]
+    for job, name in zip(jobs, ('t3_x', 't3_y')):
+        assert job.new_link(name)
+        job.written(name)
+    for job in jobs:
+        job.save()
+
+    later = DedupeIndex(bloom_path=bloom_path, capacity=1000, scope='c')
+    assert not later.new_link('t3_x')
+    assert not later.new_link('t3_y')
+
+
+def test_rerunning_an_hour_rewrites_all_of_its_links(fake_reddit, tmp_path):
+    fake = fake_reddit(density=0.2)
+    bloom_path = str(tmp_path / 'links.bloom')
+    s3 = MemoryS3()
+    runs = []
+    for _ in range(2):
+        bench_ringest(fake).do_ringest(
+            start_time=START_TIME,
+            end_time=START_TIME + timedelta(minutes=10), s3_client=s3,
+            dedupe_bloom_path=bloom_path)
+        runs.append(len(s3_lines(s3, KEY)))
+    assert runs[0] > 0
+    assert runs[1] == runs[0]
@@ -0,0 +1,96 @@
+import pytest
+import ujson
+
+from bench_ringest import BenchRingest, MemoryS3
+from conftest import START_TIME, bench_ringest, s3_lines
+from datetime import timedelta
+from retry import RequestError, RetryPolicy, SkippedLinksError
+
+KEY = 'reddit/links/2018-04-01/1200.json.gz'
+END_TIME = START_TIME + timedelta(minutes=10)
+
+
+class FlakyRingest(BenchRingest):
+    # fails the comments of every third link failures times
+
+    def __init__(self, *args, failures: int=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failures = failures
+        self.failed = {}
+
+    def cached_comments(self, link_thing: dict, limit: int=100) -> list:
+        link_id = link_thing['data']['id']
+        if int(link_id, 36) % 3 == 0 and \
+                self.failed.get(link_id, 0) < self.failures:
+            self.failed[link_id] = self.failed.get(link_id, 0) + 1
+            raise RequestError('flaky %s' % link_id)
+        return super().cached_comments(link_thing, limit=limit)
+
+
+def flaky_ringest(fake, failures: int) -> FlakyRingest:
+    return FlakyRingest(None, bucket_name='bench', api_url=fake.url,
+                        auth_url=fake.url, failures=failures)
+
+
+def link_ids(s3: MemoryS3) -> list:
+    return sorted(ujson.loads(line)['link']['data']['id']
+                  for line in s3_lines(s3, KEY))
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_request_errors_dont_lose_links(fake_reddit, tmp_path, seed):
+    # resumed like a coordinator job until it completes, the hour has every
+    # link a run without errors gets
+    fake = fake_reddit(seed=seed, density=0.2, error_rate=0.25)
+    checkpoint_path = str(tmp_path / 'checkpoint')
+    s3 = MemoryS3()
+    for _ in range(5):
+        r = bench_ringest(fake)
+        r.retry_policy = RetryPolicy(base_delay=0.001, max_delay=0.01)
+        try:
+            r.do_ringest(start_time=START_TIME, end_time=END_TIME,
+                         s3_client=s3, checkpoint_path=checkpoint_path,
+                         resume=True)
+            break
+        except SkippedLinksError:
+            assert not r.checkpoint.complete
+    assert r.checkpoint.complete
+
+    clean = MemoryS3()
+    bench_ringest(fake_reddit(seed=seed, density=0.2)).do_ringest(
+        start_time=START_TIME, end_time=END_TIME, s3_client=clean)
+    assert len(link_ids(clean)) > 0
+    assert link_ids(s3) == link_ids(clean)
+
+
+def test_skipped_links_are_retried(fake_reddit):
+    fake = fake_reddit(density=0.2)
+    s3 = MemoryS3()
+    r = flaky_ringest(fake, failures=1)
+    r.do_ringest(start_time=START_TIME, end_time=END_TIME, s3_client=s3)
+    assert len(r.failed) > 0
+    assert sum(r.metrics.skipped.values()) == len(r.failed)
+    assert len(s3_lines(s3, KEY)) == len(r.dedupe.links)
+
+
+def test_links_failing_twice_leave_the_hour_resumable(fake_reddit, tmp_path):
+    fake = fake_reddit(density=0.2)
+    checkpoint_path = str(tmp_path / 'checkpoint')
+    s3 = MemoryS3()
+    r = flaky_ringest(fake, failures=2)
+    with pytest.raises(SkippedLinksError):
+        r.do_ringest(start_time=START_TIME, end_time=END_TIME, s3_client=s3,
+                     checkpoint_path=checkpoint_path)
+    assert ('bench', KEY) not in s3.objects
+    assert not r.checkpoint.complete
+
+    # the resumed run fetches just the failed links
+    resumed = bench_ringest(fake)
+    resumed.do_ringest(start_time=START_TIME, end_time=END_TIME,
+                       s3_client=s3, checkpoint_path=checkpoint_path,
+                       resume=True)
+    assert resumed.checkpoint.complete
+    s3_all = MemoryS3()
+    bench_ringest(fake).do_ringest(start_time=START_TIME, end_time=END_TIME,
+                                   s3_client=s3_all)
+    assert sorted(s3_lines(s3, KEY)) == sorted(s3_lines(s3_all, KEY))
@@ -0,0 +1,72 @@
+import pytest
+import random
+
+from bench_ringest import MemoryS3
+from conftest import START_TIME, bench_ringest, s3_lines
+from datetime import datetime, timedelta, timezone
+from link_ids import IdRange, IdRangeError
+
+KEY = 'reddit/links/2018-04-01/1200.json.gz'
+
+
+def sparse_ids(n: int, fill: float, seed: int=0) -> list:
+    # sorted ids where id i was created at time i, with only fill of them
+    # existing
+    rng = random.Random(seed)
+    return [i for i in range(n) if rng.random() < fill]
+
+
+def search(ids: list, uts: float, batch_size: int=100) -> IdRange:
+    existing = set(ids)
+    id_range = IdRange(uts=uts, batch_size=batch_size)
+    n = id_range.next()
+    while n is not None:
+        found = [i for i in range(n, n + batch_size) if i in existing]
+        id_range.record(n, float(min(found)) if found else None)
+        n = id_range.next()
+    return id_range
+
+
+@pytest.mark.parametrize('fill', [1.0, 0.1, 0.003])
+def test_search_stops_at_or_before_the_first_link(fill):
+    ids = sparse_ids(2000000, fill)
+    uts = 1500000
+    target = min(i for i in ids if i >= uts)
+    id_range = search(ids, uts)
+    assert id_range.lo <= target
+    # close enough that walking from lo is cheap
+    assert target - id_range.lo < 100 * 100
+
+
+def test_empty_probes_are_stepped_over():
+    # nothing in the first 20 batches, and a third of the rest are empty
+    ids = [i for i in sparse_ids(500000, 0.01) if i >= 2000]
+    id_range = search(ids, 400000)
+    target = min(i for i in ids if i >= 400000)
+    assert 0 < target - id_range.lo < 100 * 100
+
+
+def ingest(fake, discovery: str) -> list:
+    s3 = MemoryS3()
+    bench_ringest(fake).do_ringest(
+        start_time=START_TIME, end_time=START_TIME + timedelta(minutes=10),
+        s3_client=s3, discovery=discovery)
+    return sorted(s3_lines(s3, KEY))
+
+
+@pytest.mark.parametrize('density', [0.2, 0.5])
+def test_id_discovery_finds_what_search_does(fake_reddit, density):
+    # 64 id slots a second: most ids don't exist
+    fake = fake_reddit(density=density, mean_comments=1, id_slots=64)
+    by_ids = ingest(fake, 'ids')
+    assert len(by_ids) > 0
+    assert by_ids == ingest(fake, 'search')
+
+
+def test_walk_that_never_reaches_the_hour_raises(fake_reddit):
+    fake = fake_reddit(density=0.2, mean_comments=1)
+    r = bench_ringest(fake)
+    # an hour that hasn't happened yet: the walk runs out of links first
+    start_time = datetime.now(timezone.utc) + timedelta(hours=1)
+    with r.reserved_creds(), pytest.raises(IdRangeError):
+        list(r.id_links(start_time, start_time + timedelta(minutes=10)))
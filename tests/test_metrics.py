@@ -0,0 +1,26 @@
+import socket
+
+from bench_ringest import MemoryS3
+from conftest import START_TIME, bench_ringest
+from datetime import timedelta
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_metrics_port_is_freed_after_every_run(fake_reddit, tmp_path):
+    # like a coordinator worker re-claiming an hour it already finished
+    fake = fake_reddit(density=0.2, mean_comments=1)
+    port = free_port()
+    s3 = MemoryS3()
+    for _ in range(3):
+        r = bench_ringest(fake)
+        r.do_ringest(start_time=START_TIME,
+                     end_time=START_TIME + timedelta(minutes=10),
+                     s3_client=s3, metrics_port=port,
+                     checkpoint_path=str(tmp_path / 'checkpoint'),
+                     resume=True)
+        assert r.metrics.server is None
@@ -0,0 +1,51 @@
+from ringest import Ringest
+from urllib.parse import parse_qs, urlsplit
+
+
+class JsonResponse(object):
+
+    def __init__(self, body: dict):
+        self.body = body
+
+    def json(self) -> dict:
+        return self.body
+
+
+def comment(i: str) -> dict:
+    return {'kind': 't1', 'data': {'id': i, 'name': 't1_' + i,
+                                   'parent_id': 't3_l', 'replies': ''}}
+
+
+def more(*child_ids) -> dict:
+    return {'kind': 'more', 'data': {'children': list(child_ids)}}
+
+
+class MoreChildrenRingest(Ringest):
+    # answers /api/morechildren with the comments asked for, and a "more"
+    # node of c3 and c4 along with c1
+
+    def __init__(self):
+        super().__init__(None, bucket_name='test', api_url='http://reddit.test')
+        self.requested = []
+
+    def request(self, url: str, **kwargs):
+        child_ids = parse_qs(urlsplit(url).query)['children'][0].split(',')
+        self.requested.extend(child_ids)
+        things = [comment(i) for i in child_ids]
+        if 'c1' in child_ids:
+            things.append(more('c3', 'c4'))
+        return JsonResponse({'json': {'data': {'things': things}}})
+
+
+def test_nested_more_nodes_skip_known_ids():
+    r = MoreChildrenRingest()
+    node = more('c1', 'c2')
+    r.do_morechildren(link_name='t3_l', more_things=[node],
+                      skip_ids={'c2', 'c3'})
+    assert sorted(r.requested) == ['c1', 'c4']
+
+
+def test_nested_more_nodes_are_expanded():
+    r = MoreChildrenRingest()
+    r.do_morechildren(link_name='t3_l', more_things=[more('c1', 'c2')])
+    assert sorted(r.requested) == ['c1', 'c2', 'c3', 'c4']
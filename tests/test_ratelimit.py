@@ -0,0 +1,33 @@
+import logging
+import threading
+
+from ratelimit import RateLimitScheduler
+from time import monotonic
+
+
+def test_early_wakeups_count_only_the_time_slept(caplog):
+    scheduler = RateLimitScheduler()
+    scheduler.set_tokens(['tokA'])
+    token = scheduler.acquire()
+    scheduler.update(token, {'X-Ratelimit-Remaining': '0',
+                             'X-Ratelimit-Reset': '0.5'})
+    stop = threading.Event()
+
+    def notify():
+        # like responses on other tokens arriving while acquire waits
+        while not stop.wait(0.02):
+            scheduler.set_tokens(['tokA'])
+
+    notifier = threading.Thread(target=notify)
+    notifier.start()
+    st = monotonic()
+    try:
+        with caplog.at_level(logging.WARNING):
+            assert scheduler.acquire() == 'tokA'
+    finally:
+        stop.set()
+        notifier.join()
+    waited = monotonic() - st
+    assert waited >= 0.4
+    assert abs(scheduler.sleep_seconds - waited) < 0.05
+    assert caplog.text.count('Rate limit exhausted') == 1
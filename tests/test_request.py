@@ -0,0 +1,145 @@
+import pytest
+
+from retry import CircuitOpenError, RequestError, RetryPolicy, \
+    UriTooLongError
+from ringest import Ringest
+
+
+class StubResponse(object):
+
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.headers = {'Content-Length': '2'}
+        self.content = b'{}'
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class StubSessions(object):
+    # answers each request with the next of statuses, or with the status
+    # given for its token
+    def __init__(self, statuses: list=None, by_token: dict=None):
+        self.statuses = list(statuses or [])
+        self.by_token = by_token or {}
+        self.calls = []
+        self.responses = []
+
+    def get(self, url, key=None, headers=None, stream=False):
+        self.calls.append((url, key))
+        if key in self.by_token:
+            response = StubResponse(self.by_token[key])
+        else:
+            response = StubResponse(self.statuses.pop(0))
+        self.responses.append(response)
+        return response
+
+
+class StubTokens(object):
+    # an invalidated token is replaced by the next spare one
+
+    def __init__(self, tokens: list, spares: list):
+        self.valid = list(tokens)
+        self.spares = list(spares)
+        self.invalidated = []
+
+    def tokens(self, unames: list) -> list:
+        return list(self.valid)
+
+    def invalidate(self, token: str):
+        self.invalidated.append(token)
+        self.valid.remove(token)
+        self.valid.append(self.spares.pop(0))
+
+
+def stub_ringest(sessions: StubSessions, tokens: list=('tokA',),
+                 spares: list=('tokB',)):
+    r = Ringest(None, bucket_name='test', api_url='http://reddit.test')
+    r.sessions = sessions
+    r.tokens_manager = StubTokens(tokens, spares)
+    r.retry_policy = RetryPolicy(base_delay=0, max_delay=0)
+    return r
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_401_replaces_the_token(stream):
+    sessions = StubSessions(by_token={'tokA': 401, 'tokB': 200})
+    r = stub_ringest(sessions)
+    response = r.request('http://reddit.test/comments/x.json', stream=stream)
+    assert response.status_code == 200
+    assert r.tokens_manager.invalidated == ['tokA']
+    if stream:
+        # the rejected response isn't left open
+        assert sessions.responses[0].closed
+
+
+def test_streamed_414_raises_uri_too_long():
+    sessions = StubSessions(statuses=[414])
+    r = stub_ringest(sessions)
+    with pytest.raises(UriTooLongError):
+        r.request('http://reddit.test/api/morechildren?children=a',
+                  stream=True)
+    assert sessions.responses[0].closed
+
+
+def test_414_ends_a_circuit_breaker_trial():
+    sessions = StubSessions(statuses=[503, 414, 200])
+    r = stub_ringest(sessions)
+    r.retry_policy = RetryPolicy(base_delay=0, max_delay=0,
+                                 breaker_threshold=1, breaker_cooldown=0)
+    url = 'http://reddit.test/api/morechildren?children=a'
+    with pytest.raises(RequestError):
+        r.request(url, retries_left=1)
+    # half open: the 414 is the trial
+    with pytest.raises(UriTooLongError):
+        r.request(url)
+    assert r.request(url).status_code == 200
+
+
+def test_401_ends_a_circuit_breaker_trial():
+    sessions = StubSessions(statuses=[503, 401, 200])
+    r = stub_ringest(sessions)
+    r.retry_policy = RetryPolicy(base_delay=0, max_delay=0,
+                                 breaker_threshold=1, breaker_cooldown=0)
+    url = 'http://reddit.test/comments/x.json'
+    with pytest.raises(RequestError):
+        r.request(url, retries_left=1)
+    # the trial gets a 401, and its retry with a fresh token goes through
+    assert r.request(url).status_code == 200
+
+
+def test_trial_without_an_answer_is_released():
+    policy = RetryPolicy(breaker_threshold=1, breaker_cooldown=0)
+    policy.record_failure('comments')
+    policy.before_request('comments')
+    with pytest.raises(CircuitOpenError):
+        policy.before_request('comments')
+    policy.release('comments')
+    policy.before_request('comments')
+
+
+def test_open_breaker_is_waited_out():
+    sessions = StubSessions(statuses=[503, 200])
+    r = stub_ringest(sessions)
+    r.retry_policy = RetryPolicy(base_delay=0, max_delay=0,
+                                 breaker_threshold=1, breaker_cooldown=0.05)
+    url = 'http://reddit.test/comments/x.json'
+    with pytest.raises(RequestError):
+        r.request(url, retries_left=1)
+    # another request's failure opened the breaker: wait, then be the trial
+    assert r.request(url).status_code == 200
+    assert r.metrics.sleep['breaker'] > 0
+
+
+def test_breaker_open_for_too_long_raises():
+    sessions = StubSessions(statuses=[503, 200])
+    r = stub_ringest(sessions)
+    r.retry_policy = RetryPolicy(base_delay=0, max_delay=0,
+                                 breaker_threshold=1, breaker_cooldown=60,
+                                 breaker_max_wait=1)
+    url = 'http://reddit.test/comments/x.json'
+    with pytest.raises(RequestError):
+        r.request(url, retries_left=1)
+    with pytest.raises(CircuitOpenError):
+        r.request(url)
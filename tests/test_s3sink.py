@@ -0,0 +1,134 @@
+import boto3
+import gzip
+import io
+import pytest
+import random
+import zstandard
+
+from checkpoint import Checkpoint
+from moto import mock_aws
+from s3sink import MIN_PART_SIZE, S3GzipSink, S3ZstdSink
+
+BUCKET = 'sink-test'
+KEY = 'reddit/links/2018-04-01/1200.json.gz'
+SINKS = [S3GzipSink, S3ZstdSink]
+# random hex compresses to about half, so this is a little over one
+# MIN_PART_SIZE part of output
+PART_LINES = 11000
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
+                 'AWS_SESSION_TOKEN'):
+        monkeypatch.setenv(name, 'testing')
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def lines(count: int, seed: int=0) -> list:
+    rng = random.Random(seed)
+    return ['%s\n' % rng.randbytes(512).hex() for _ in range(count)]
+
+
+def sink(sink_class, s3, **kwargs):
+    # fast levels and the smallest parts: the tests are about uploads, not
+    # compression
+    return sink_class(s3_client=s3, bucket=BUCKET, key=KEY, compresslevel=1,
+                      part_size=MIN_PART_SIZE, **kwargs)
+
+
+def read_lines(s3, sink_class) -> list:
+    data = s3.get_object(Bucket=BUCKET, Key=KEY)['Body'].read()
+    if sink_class is S3ZstdSink:
+        data = zstandard.ZstdDecompressor().stream_reader(
+            io.BytesIO(data), read_across_frames=True).read()
+    else:
+        data = gzip.decompress(data)
+    return data.decode('utf8').splitlines(keepends=True)
+
+
+def open_uploads(s3) -> list:
+    return s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads', [])
+
+
+def object_exists(s3) -> bool:
+    return s3.list_objects_v2(Bucket=BUCKET).get('KeyCount', 0) > 0
+
+
+@pytest.mark.parametrize('sink_class', SINKS)
+def test_small_output_is_put(s3, sink_class):
+    started = []
+    written = lines(100)
+    with sink(sink_class, s3, on_upload_started=started.append) as f:
+        for line in written:
+            f.write(line)
+    assert started == []
+    assert f.parts == []
+    assert read_lines(s3, sink_class) == written
+
+
+@pytest.mark.parametrize('sink_class', SINKS)
+def test_large_output_is_uploaded_in_parts(s3, sink_class):
+    started = []
+    uploaded = []
+    written = lines(PART_LINES)
+    with sink(sink_class, s3, on_upload_started=started.append,
+              on_part=lambda part, tags: uploaded.append((part, tags))) as f:
+        for i, line in enumerate(written):
+            f.write(line, tag=i)
+    assert len(started) == 1
+    assert [part['PartNumber'] for part, _ in uploaded] == [1, 2]
+    # every record's tag comes back with the part it went out in
+    assert sorted(t for _, tags in uploaded for t in tags) == \
+        list(range(PART_LINES))
+    assert open_uploads(s3) == []
+    assert read_lines(s3, sink_class) == written
+
+
+@pytest.mark.parametrize('sink_class', SINKS)
+def test_error_aborts_the_upload(s3, sink_class):
+    with pytest.raises(RuntimeError):
+        with sink(sink_class, s3) as f:
+            for line in lines(PART_LINES):
+                f.write(line)
+            assert f.upload_id is not None
+            raise RuntimeError('producer failed')
+    assert open_uploads(s3) == []
+    assert not object_exists(s3)
+
+
+@pytest.mark.parametrize('sink_class', SINKS)
+def test_left_open_upload_is_continued(s3, sink_class, tmp_path):
+    # the first run fails after a part; its checkpoint has the upload id and
+    # the part, and a second run picks up from there
+    path = str(tmp_path / 'checkpoint')
+    first = lines(PART_LINES, seed=1)
+    checkpoint = Checkpoint(path, KEY).open()
+    with pytest.raises(RuntimeError):
+        with sink(sink_class, s3, on_upload_started=checkpoint.upload_started,
+                  on_part=checkpoint.part_uploaded,
+                  abort_incomplete=False) as f:
+            for i, line in enumerate(first):
+                f.write(line, tag=str(i))
+            raise RuntimeError('interrupted')
+    checkpoint.close()
+    assert len(open_uploads(s3)) == 1
+    assert not object_exists(s3)
+
+    checkpoint = Checkpoint(path, KEY).open(resume=True)
+    assert len(checkpoint.parts) == 1
+    # only the records in the uploaded part are done
+    done = [line for i, line in enumerate(first)
+            if checkpoint.link_done(str(i))]
+    assert 0 < len(done) < len(first)
+    second = lines(100, seed=2)
+    with sink(sink_class, s3, upload_id=checkpoint.upload_id,
+              parts=checkpoint.parts) as f:
+        for line in second:
+            f.write(line)
+    checkpoint.close()
+    assert open_uploads(s3) == []
+    assert read_lines(s3, sink_class) == done + second
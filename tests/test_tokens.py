@@ -0,0 +1,93 @@
+import logging
+import pytest
+
+from cryptography.fernet import Fernet
+from retry import RetryPolicy
+from tokens import TokenManager
+
+AUTH_URL = 'https://auth.example'
+
+
+class TokenResponse(object):
+
+    def __init__(self, token: str, status_code: int=200):
+        self.status_code = status_code
+        self.body = {'access_token': token, 'expires_in': 3600} \
+            if status_code == 200 else {}
+        self.headers = {}
+        self.content = b'{}'
+
+    def json(self) -> dict:
+        return self.body
+
+
+class TokenSessions(object):
+    # hands out tok-<uname>-1, tok-<uname>-2, ... after failing the first
+    # failures requests with a 503
+
+    def __init__(self, failures: int=0):
+        self.issued = {}
+        self.failures = failures
+        self.posts = 0
+
+    def post(self, url, auth, data):
+        self.posts += 1
+        if self.posts <= self.failures:
+            return TokenResponse(None, status_code=503)
+        self.issued[auth.username] = self.issued.get(auth.username, 0) + 1
+        return TokenResponse('tok-%s-%d' % (auth.username,
+                                            self.issued[auth.username]))
+
+
+def token_manager(sessions, path: str, key: bytes) -> TokenManager:
+    return TokenManager(sessions, auth_url=AUTH_URL,
+                        password_map={'a': 'x', 'b': 'y'},
+                        cache_path=path, cache_key=key)
+
+
+def test_invalidated_tokens_leave_the_cache(tmp_path):
+    path = str(tmp_path / 'tokens')
+    key = Fernet.generate_key()
+    sessions = TokenSessions()
+    first = token_manager(sessions, path, key)
+    assert sorted(first.tokens(['a', 'b'])) == ['tok-a-1', 'tok-b-1']
+
+    # another process sharing the cache starts without requesting tokens
+    assert sorted(token_manager(sessions, path, key).tokens(['a', 'b'])) == \
+        ['tok-a-1', 'tok-b-1']
+
+    first.invalidate('tok-a-1')
+    later = token_manager(sessions, path, key)
+    assert sorted(later.tokens(['a', 'b'])) == ['tok-a-2', 'tok-b-1']
+
+
+def test_plaintext_cache_is_warned_about(tmp_path, caplog):
+    with caplog.at_level(logging.WARNING):
+        token_manager(TokenSessions(), str(tmp_path / 'tokens'), None)
+    assert 'not encrypted' in caplog.text
+
+
+def failing_token_manager(failures: int, **kwargs) -> TokenManager:
+    return TokenManager(TokenSessions(failures=failures), auth_url=AUTH_URL,
+                        password_map={'a': 'x'},
+                        retry_policy=RetryPolicy(base_delay=0, max_delay=0),
+                        **kwargs)
+
+
+def test_token_requests_are_retried():
+    tokens = failing_token_manager(failures=3)
+    assert tokens.tokens(['a']) == ['tok-a-1']
+    assert tokens.sessions.posts == 4
+
+
+def test_tokens_wait_for_a_credential_to_be_retried():
+    tokens = failing_token_manager(failures=3, attempts=2, retry_seconds=0.05,
+                                   wait_seconds=5)
+    assert tokens.tokens(['a']) == ['tok-a-1']
+
+
+def test_no_token_after_waiting_is_an_error():
+    tokens = failing_token_manager(failures=100, attempts=2,
+                                   retry_seconds=0.05, wait_seconds=0.2)
+    with pytest.raises(ConnectionError):
+        tokens.tokens(['a'])
@@ -0,0 +1,32 @@
+import os
+import pytest
+
+from bench_ringest import MemoryS3
+from conftest import START_TIME, bench_ringest
+from datetime import timedelta
+from s3sink import UploadError
+
+
+class FailingS3(MemoryS3):
+
+    def put_object(self, Bucket, Key, Body):
+        raise OSError('S3 is down')
+
+    def create_multipart_upload(self, Bucket, Key):
+        raise OSError('S3 is down')
+
+
+@pytest.mark.parametrize('shards', [None, 2])
+def test_failed_upload_fails_the_run(fake_reddit, tmp_path, shards):
+    fake = fake_reddit(density=0.2, mean_comments=1)
+    bloom_path = str(tmp_path / 'links.bloom')
+    density_path = str(tmp_path / 'density')
+    with pytest.raises(UploadError):
+        bench_ringest(fake).do_ringest(
+            start_time=START_TIME,
+            end_time=START_TIME + timedelta(minutes=10),
+            s3_client=FailingS3(), shards=shards,
+            dedupe_bloom_path=bloom_path, density_path=density_path)
+    # nothing was archived, so the next run mustn't skip these links
+    assert not os.path.exists(bloom_path)
+    assert not os.path.exists(density_path)
@@ -0,0 +1,129 @@
+import logging
+import sqlite3
+import threading
+import ujson
+import zlib
+
+from time import time
+
+
+class ThreadCache(object):
+    # Local SQLite cache of fetched comment trees, keyed by link fullname
+    # (t3_...), so adjacent runs and re-runs of a window don't spend rate
+    # limit budget refetching threads captured moments ago.
+    #
+    # An entry is served while it is younger than ttl_seconds and the link's
+    # current num_comments (from the search result, so checking costs no
+    # request) hasn't changed since it was stored.  Bodies are stored
+    # zlib-compressed, and the least recently used entries are evicted once
+    # the total exceeds max_bytes.
+
+    def __init__(self, path: str, ttl_seconds: float=3600,
+                 max_bytes: int=1024 * 1024 * 1024):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS threads (
+                    name TEXT PRIMARY KEY,
+                    num_comments INTEGER,
+                    fetched REAL,
+                    accessed REAL,
+                    size INTEGER,
+                    body BLOB)""")
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS threads_accessed
+                    ON threads (accessed)""")
+            self.conn.commit()
+            self.total_bytes = self.conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM threads').fetchone()[0]
+
+    def get(self, name: str, num_comments: int=None):
+        now = time()
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT num_comments, fetched, body FROM threads WHERE name = ?',
+                (name,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            cached_num_comments, fetched, body = row
+            if now - fetched > self.ttl_seconds or \
+                    (num_comments is not None and
+                     num_comments != cached_num_comments):
+                self.stale += 1
+                return None
+
+            self.hits += 1
+            self.conn.execute('UPDATE threads SET accessed = ? WHERE name = ?',
+                              (now, name))
+            self.conn.commit()
+        return ujson.loads(zlib.decompress(body))
+
+    def put(self, name: str, comments, num_comments: int=None):
+        body = zlib.compress(ujson.dumps(comments).encode('utf8'))
+        now = time()
+        with self.lock:
+            old = self.conn.execute('SELECT size FROM threads WHERE name = ?',
+                                    (name,)).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.conn.execute(
+                'INSERT OR REPLACE INTO threads VALUES (?, ?, ?, ?, ?, ?)',
+                (name, num_comments, now, now, len(body), body))
+            self.total_bytes += len(body)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        # Drops expired entries first, then least recently used ones until
+        # the cache is back under max_bytes.  Caller holds self.lock.
+        expired = self.conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM threads '
+            'WHERE fetched < ?', (time() - self.ttl_seconds,)).fetchone()
+        if expired[0] > 0:
+            self.conn.execute('DELETE FROM threads WHERE fetched < ?',
+                              (time() - self.ttl_seconds,))
+            self.evictions += expired[0]
+            self.total_bytes -= expired[1]
+
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                'SELECT name, size FROM threads ORDER BY accessed LIMIT 100'
+            ).fetchall()
+            if len(rows) < 1:
+                self.total_bytes = 0
+                break
+            for name, size in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.conn.execute('DELETE FROM threads WHERE name = ?', (name,))
+                self.total_bytes -= size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses + self.stale
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                'bytes': self.total_bytes
+            }
+
+    def close(self):
+        logging.info('Thread cache: %(hits)d hits, %(misses)d misses, '
+                     '%(stale)d stale, %(evictions)d evictions' % self.stats())
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,238 @@
+import logging
+import os
+import threading
+import ujson
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.auth import HTTPBasicAuth
+from retry import RetryPolicy
+from time import perf_counter, sleep, time
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+    InvalidToken = ValueError
+
+
+class TokenManager(object):
+    # OAuth tokens for a set of credentials (unames):
+    #
+    # - missing tokens are requested concurrently, one POST per credential
+    # - a token is refreshed in the background once it is within
+    #   refresh_margin seconds of expires_in, while the old one keeps being
+    #   used, so requests never wait on a refresh or go out with an expired
+    #   token
+    # - a token request that fails with a retryable status or a connection
+    #   error is retried up to attempts times, backing off as retry_policy
+    #   says
+    # - a credential whose token request still fails is dropped (and retried
+    #   no sooner than retry_seconds later) instead of failing the run;
+    #   while no credential has a token tokens() waits for those retries,
+    #   and only having none after wait_seconds is an error
+    # - with cache_path, tokens and their expiry are kept in a local file
+    #   (0600, and Fernet-encrypted when cache_key is given) so a new process
+    #   can start without requesting any
+    #
+    # tokens(unames) returns the current tokens; invalidate(token) drops one
+    # the API rejected, from the cache file too so other processes stop
+    # loading it.
+
+    def __init__(self, sessions, auth_url: str, password_map: dict,
+                 metrics=None, cache_path: str=None, cache_key: bytes=None,
+                 refresh_margin: float=300, retry_seconds: float=60,
+                 max_workers: int=8, retry_policy: RetryPolicy=None,
+                 attempts: int=5, wait_seconds: float=300):
+        self.sessions = sessions
+        self.auth_url = auth_url
+        self.password_map = password_map
+        self.metrics = metrics
+        self.cache_path = cache_path
+        self.fernet = None
+        if cache_key is not None:
+            if Fernet is None:
+                raise ImportError('cryptography is required to encrypt the '
+                                  'token cache')
+            self.fernet = Fernet(cache_key)
+        elif cache_path is not None:
+            logging.warning('Token cache %s is not encrypted; give a '
+                            'cache_key' % cache_path)
+        self.refresh_margin = refresh_margin
+        self.retry_seconds = retry_seconds
+        self.max_workers = max_workers
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.attempts = max(attempts, 1)
+        self.wait_seconds = wait_seconds
+        # uname -> {'access_token': ..., 'expires_at': ...}
+        self.entries = {}
+        # uname -> time before which a failed credential isn't retried
+        self.failed = {}
+        self.refreshing = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def tokens(self, unames: list) -> list:
+        deadline = time() + self.wait_seconds
+        while True:
+            now = time()
+            with self.lock:
+                missing = [u for u in unames if not self.usable(u, now) and
+                           self.failed.get(u, 0) <= now]
+                stale = [u for u in unames if u not in missing and
+                         u in self.entries and
+                         self.entries[u]['expires_at'] -
+                         self.refresh_margin <= now]
+            if len(missing) > 0:
+                self.fetch(missing)
+            if len(stale) > 0:
+                self.refresh_async(stale)
+
+            now = time()
+            with self.lock:
+                tokens = [self.entries[u]['access_token'] for u in unames
+                          if self.usable(u, now)]
+                retry_at = min([self.failed.get(u, now) for u in unames] or
+                               [deadline + 1])
+            if len(tokens) > 0:
+                return tokens
+            if retry_at > deadline:
+                raise ConnectionError('Unable to get a token for any of %d '
+                                      'credentials' % len(unames))
+            logging.warning('No tokens yet, retrying credentials in %.1fs' %
+                            max(retry_at - now, 0))
+            sleep(max(retry_at - now, 0))
+
+    def usable(self, uname: str, now: float) -> bool:
+        entry = self.entries.get(uname)
+        return entry is not None and entry['expires_at'] > now
+
+    def invalidate(self, token: str):
+        with self.lock:
+            for uname, entry in list(self.entries.items()):
+                if entry['access_token'] == token:
+                    del self.entries[uname]
+        self.save(invalidated=token)
+
+    def refresh_async(self, unames: list):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def refresh():
+            try:
+                self.fetch(unames)
+            finally:
+                with self.lock:
+                    self.refreshing = False
+
+        threading.Thread(target=refresh, name='token-refresh',
+                         daemon=True).start()
+
+    def fetch(self, unames: list):
+        logging.info('Requesting %d tokens...' % len(unames))
+        with ThreadPoolExecutor(max_workers=min(self.max_workers,
+                                                len(unames))) as executor:
+            results = list(executor.map(self.fetch_one, unames))
+        now = time()
+        with self.lock:
+            for uname, entry in zip(unames, results):
+                if entry is None:
+                    # keep a token that is still valid; drop the rest
+                    if not self.usable(uname, now):
+                        self.entries.pop(uname, None)
+                    self.failed[uname] = now + self.retry_seconds
+                else:
+                    self.entries[uname] = entry
+                    self.failed.pop(uname, None)
+        self.save()
+        logging.info('Done.')
+
+    def fetch_one(self, uname: str) -> dict:
+        for attempt in range(self.attempts):
+            entry, response = self.request_token(uname)
+            if entry is not None:
+                return entry
+            status = response.status_code if response is not None else None
+            if attempt + 1 >= self.attempts or \
+                    not self.retry_policy.retryable(status):
+                return None
+            delay = self.retry_policy.delay(attempt, response)
+            logging.warning('Token request for %s got %s, will sleep %.1fs '
+                            'and retry' % (uname, status, delay))
+            if self.metrics is not None:
+                self.metrics.retry('token')
+                self.metrics.add_sleep('retry', delay)
+            sleep(delay)
+
+    def request_token(self, uname: str) -> tuple:
+        # one token request: (entry or None, the response if there was one)
+        st = time()
+        rst = perf_counter()
+        response = None
+        try:
+            response = self.sessions.post(
+                url=self.auth_url + '/api/v1/access_token',
+                auth=HTTPBasicAuth(username=uname,
+                                   password=self.password_map[uname]),
+                data={'grant_type': 'client_credentials'})
+            body = response.json() if response.status_code == 200 else {}
+        except Exception as e:
+            logging.warning('Token request for %s failed: %r' % (uname, e))
+            body = {}
+        finally:
+            if self.metrics is not None:
+                self.metrics.request(
+                    'token', perf_counter() - rst,
+                    status=response.status_code
+                    if response is not None else None,
+                    n_bytes=len(response.content)
+                    if response is not None else 0)
+
+        if 'access_token' not in body:
+            logging.warning('Token request for %s failed: %r' %
+                            (uname, response))
+            return None, response
+        return {'access_token': body['access_token'],
+                'expires_at': st + float(body.get('expires_in', 3600))}, \
+            response
+
+    def load(self):
+        self.entries.update(self.read())
+
+    def read(self) -> dict:
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return dict()
+        try:
+            with open(self.cache_path, 'rb') as f:
+                data = f.read()
+            if self.fernet is not None:
+                data = self.fernet.decrypt(data)
+            cache = ujson.loads(data)
+        except (OSError, ValueError, InvalidToken) as e:
+            logging.warning('Unable to read token cache %s: %r' %
+                            (self.cache_path, e))
+            return dict()
+        # tokens are only good for the auth server that issued them
+        if cache.get('auth_url') != self.auth_url:
+            return dict()
+        return cache.get('tokens', dict())
+
+    def save(self, invalidated: str=None):
+        if self.cache_path is None:
+            return
+        # other processes may be caching the tokens of other credentials in
+        # the same file
+        cached = {uname: entry for uname, entry in self.read().items()
+                  if entry.get('access_token') != invalidated}
+        with self.lock:
+            cached.update(self.entries)
+            data = ujson.dumps({'auth_url': self.auth_url,
+                                'tokens': cached}).encode('utf8')
+        if self.fernet is not None:
+            data = self.fernet.encrypt(data)
+        tmp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.cache_path)